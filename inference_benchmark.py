@@ -0,0 +1,159 @@
+"""Banc d'essai des modes d'exécution du serveur : débit (tokens/s) et mémoire.
+
+Chaque mode est chargé dans un processus séparé (mémoire mesurée sans interférence)
+via les mêmes fonctions que `kaggle_server_script.py` (`InferenceConfig`, `load_llm`,
+`load_asr`). Un mode s'écrit `<dtype>[-<quantification>][+compile]` :
+
+    python inference_benchmark.py --stub                      # petits modèles, CPU
+    python inference_benchmark.py --modes float32 float32-int8 float32-int8+compile
+    python inference_benchmark.py --device cuda --modes float16 bfloat16 float16-int8 float16-4bit
+"""
+import argparse
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+DEFAULT_MODES = {
+    "cpu": ["float32", "bfloat16", "float32-int8", "float32-int8+compile"],
+    "cuda": ["float16", "bfloat16", "float16-int8", "float16-4bit"],
+}
+PROMPT = ("Patient de 45 ans, fièvre à 38,5 °C depuis deux jours, toux sèche et fatigue. "
+          "Pas d'antécédents notables. Quelles questions poser ?")
+
+
+def parse_mode(mode):
+    """`float32-int8+compile` → kwargs de `InferenceConfig`."""
+    compile_ = mode.endswith("+compile")
+    dtype, _, quantization = mode.removesuffix("+compile").partition("-")
+    return {"dtype": dtype, "quantization": quantization or "none", "compile": compile_}
+
+
+def memory_mb(device):
+    if device == "cuda":
+        import torch
+        return torch.cuda.memory_allocated() / 2**20
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def peak_memory_mb(device):
+    if device == "cuda":
+        import torch
+        return torch.cuda.max_memory_allocated() / 2**20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # Linux : Ko
+
+
+def run_mode(mode, device, stub, new_tokens, runs, asr_seconds):
+    """Mesures d'un mode, dans le processus courant (appelé par le processus fils)."""
+    import numpy as np
+    import torch
+    import kaggle_server_script as server
+
+    server.STUB_STEP_DELAY_S = 0.0
+    config = server.InferenceConfig(device=device, **parse_mode(mode))
+    result = {"mode": mode, "config": config.describe()}
+    base_mb = memory_mb(config.torch_device())
+
+    start = time.perf_counter()
+    tokenizer, model = server.load_llm(config, stub=stub)
+    result["llm_load_s"] = time.perf_counter() - start
+    result["llm_memory_mb"] = memory_mb(config.torch_device()) - base_mb
+
+    prompt = server.build_prompt("Tu es un assistant médical de triage.", PROMPT)
+    inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
+    gen_kwargs = dict(max_new_tokens=new_tokens, min_new_tokens=new_tokens, do_sample=False,
+                      pad_token_id=tokenizer.pad_token_id or tokenizer.eos_token_id)
+    with torch.inference_mode():
+        start = time.perf_counter()
+        model.generate(**inputs, **gen_kwargs)  # 1er appel : compilation / warmup
+        result["first_run_s"] = time.perf_counter() - start
+        rates = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            model.generate(**inputs, **gen_kwargs)
+            rates.append(new_tokens / (time.perf_counter() - start))
+    result["tokens_per_s"] = statistics.median(rates)
+    del model
+
+    if asr_seconds > 0:
+        before_mb = memory_mb(config.torch_device())
+        processor, asr_model = server.load_asr(config, stub=stub)
+        result["asr_memory_mb"] = memory_mb(config.torch_device()) - before_mb
+        audio = np.random.default_rng(0).normal(0, 0.1, int(asr_seconds * server.ASR_SAMPLE_RATE))
+        chunks = [c.astype(np.float32) for c in np.array_split(audio, max(1, int(asr_seconds // 10)))]
+        server.transcribe_chunks(chunks, processor, asr_model)  # warmup
+        start = time.perf_counter()
+        server.transcribe_chunks(chunks, processor, asr_model)
+        result["asr_realtime_x"] = asr_seconds / (time.perf_counter() - start)
+
+    result["peak_memory_mb"] = peak_memory_mb(config.torch_device())
+    return result
+
+
+def run_isolated(mode, args):
+    """Lance un mode dans un processus neuf ; renvoie ses mesures ou l'erreur."""
+    cmd = [sys.executable, __file__, "--worker", mode, "--device", args.device,
+           "--new-tokens", str(args.new_tokens), "--runs", str(args.runs),
+           "--asr-seconds", str(args.asr_seconds)]
+    if args.stub:
+        cmd.append("--stub")
+    proc = subprocess.run(cmd, capture_output=True, text=True)
+    for line in reversed(proc.stdout.splitlines()):
+        if line.startswith("{"):
+            return json.loads(line)
+    error = (proc.stderr.strip().splitlines() or ["échec sans message"])[-1]
+    return {"mode": mode, "error": error}
+
+
+def print_results(results):
+    def fmt(value, width=9, digits=1):
+        return f"{'-':>{width}}" if value is None else f"{value:{width}.{digits}f}"
+    print(f"{'Mode':<24}{'tok/s':>9}{'1er (s)':>9}{'LLM Mo':>9}{'ASR x':>9}{'ASR Mo':>9}{'pic Mo':>9}")
+    for r in results:
+        if "error" in r:
+            print(f"{r['mode']:<24}  ❌ {r['error']}")
+            continue
+        print(f"{r['mode']:<24}{fmt(r['tokens_per_s'])}{fmt(r['first_run_s'], digits=2)}"
+              f"{fmt(r['llm_memory_mb'])}{fmt(r.get('asr_realtime_x'))}"
+              f"{fmt(r.get('asr_memory_mb'))}{fmt(r['peak_memory_mb'])}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Débit et mémoire par mode d'exécution (device / précision / quantification).")
+    parser.add_argument("--modes", nargs="+", help="modes à comparer (défaut selon le device)")
+    parser.add_argument("--device", default="auto", help="auto | cuda | mps | cpu")
+    parser.add_argument("--stub", action="store_true", help="petits modèles aléatoires (aucun téléchargement)")
+    parser.add_argument("--new-tokens", type=int, default=64, help="tokens générés par mesure")
+    parser.add_argument("--runs", type=int, default=3, help="mesures par mode (médiane)")
+    parser.add_argument("--asr-seconds", type=float, default=20.0, help="durée audio pour MedASR (0 = ignoré)")
+    parser.add_argument("--json", dest="json_path", help="export JSON des mesures")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        print(json.dumps(run_mode(args.worker, args.device, args.stub, args.new_tokens,
+                                  args.runs, args.asr_seconds)))
+        return
+
+    import torch
+    device = args.device
+    if device == "auto":
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    modes = args.modes or DEFAULT_MODES.get(device, DEFAULT_MODES["cpu"])
+    results = []
+    for mode in modes:
+        print(f"⏱️  {mode}...", flush=True)
+        results.append(run_isolated(mode, args))
+    print()
+    print_results(results)
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
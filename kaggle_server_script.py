@@ -4,136 +4,2464 @@
 
 # 1. NETTOYAGE ET INSTALLATION (Exécuter cette cellule après un "Restart Session")
 import os
+import re
 import sys
+import time
 import subprocess
 import types
 
+PROCESS_START = time.perf_counter()
+# Durées des étapes du démarrage (s), exposées par /ready.
+STARTUP_TIMINGS = {}
+
 def run_command(command):
     subprocess.check_call(command, shell=True)
 
-print("🧹 Nettoyage des versions conflictuelles...")
-try:
-    # On désinstalle pour forcer une réinstallation propre
-    run_command("pip uninstall -y huggingface_hub transformers")
-except:
-    pass
-
-print("📦 Installation des versions compatibles...")
-# On force des versions récentes qui fonctionnent ensemble
-run_command("pip install -q -U huggingface_hub>=0.23.0 transformers>=4.41.0 flask flask-cors pyngrok accelerate bitsandbytes librosa soundfile")
-
-# --- 2. PATCHS DE COMPATIBILITÉ (CRUCIAL) ---
-# On applique ces patchs AVANT d'importer transformers
-print("🔧 Application des correctifs mémoire...")
-
-import huggingface_hub
-import huggingface_hub.errors
-import huggingface_hub.file_download
-
-# Patch 1 : DryRunError
-if not hasattr(huggingface_hub.errors, 'DryRunError'):
-    class DryRunError(Exception): pass
-    huggingface_hub.errors.DryRunError = DryRunError
-    sys.modules['huggingface_hub.errors'].DryRunError = DryRunError
-    print("  ✅ Patch DryRunError appliqué.")
-
-# Patch 2 : DryRunFileInfo (Nouvelle erreur que vous avez rencontrée)
-if not hasattr(huggingface_hub.file_download, 'DryRunFileInfo'):
-    class DryRunFileInfo:
-        def __init__(self, **kwargs): pass
-    huggingface_hub.file_download.DryRunFileInfo = DryRunFileInfo
-    # On l'injecte aussi dans le module s'il est importé directement
-    sys.modules['huggingface_hub.file_download'].DryRunFileInfo = DryRunFileInfo
-    print("  ✅ Patch DryRunFileInfo appliqué.")
+# Versions minimales ; `None` = présence suffisante.
+REQUIREMENTS = {
+    "huggingface_hub": "0.23.0",
+    "transformers": "4.41.0",
+    "flask": None,
+    "flask-cors": None,
+    "waitress": None,
+    "pyngrok": None,
+    "accelerate": None,
+    "bitsandbytes": None,
+    "librosa": None,
+    "soundfile": None,
+}
+# MEDGEMMA_FORCE_REINSTALL=1 : ancien comportement (désinstallation + réinstallation).
+FORCE_REINSTALL = os.getenv("MEDGEMMA_FORCE_REINSTALL") == "1"
+
+def version_tuple(version):
+    return tuple(int(part) for part in re.findall(r"\d+", version)[:3])
+
+def missing_requirements():
+    """Paquets absents ou trop anciens ; vide si l'environnement peut être réutilisé tel quel."""
+    from importlib.metadata import version, PackageNotFoundError
+    missing = []
+    for name, minimum in REQUIREMENTS.items():
+        try:
+            installed = version(name)
+        except PackageNotFoundError:
+            missing.append(name)
+            continue
+        if minimum and version_tuple(installed) < version_tuple(minimum):
+            missing.append(name)
+    return missing
+
+# Les étapes d'installation / chargement ne s'exécutent que lorsque le script est lancé
+# (cellule Kaggle ou `python kaggle_server_script.py`). Un simple `import` permet de
+# tester les composants (ex: BatchScheduler) sur CPU avec un petit modèle.
+# MEDGEMMA_STUB_MODELS=1 : petits modèles aléatoires sur CPU, sans installation ni
+# téléchargement ni ngrok, pour tester la charge du serveur en local.
+STUB_MODELS = os.getenv("MEDGEMMA_STUB_MODELS") == "1"
+
+if __name__ == "__main__" and not STUB_MODELS:
+    install_start = time.perf_counter()
+    missing = list(REQUIREMENTS) if FORCE_REINSTALL else missing_requirements()
+    if not missing:
+        print("✅ Dépendances déjà compatibles : installation ignorée.")
+    else:
+        if {"huggingface_hub", "transformers"} & set(missing):
+            print("🧹 Nettoyage des versions conflictuelles...")
+            try:
+                # On désinstalle pour forcer une réinstallation propre
+                run_command("pip uninstall -y huggingface_hub transformers")
+            except:
+                pass
+
+        print(f"📦 Installation des versions compatibles ({', '.join(missing)})...")
+        # On force des versions récentes qui fonctionnent ensemble
+        run_command("pip install -q -U huggingface_hub>=0.23.0 transformers>=4.41.0 flask flask-cors waitress pyngrok accelerate bitsandbytes librosa soundfile")
+    STARTUP_TIMINGS["install_s"] = round(time.perf_counter() - install_start, 3)
+
+    # --- 2. PATCHS DE COMPATIBILITÉ (CRUCIAL) ---
+    # On applique ces patchs AVANT d'importer transformers
+    print("🔧 Application des correctifs mémoire...")
+
+    import huggingface_hub
+    import huggingface_hub.errors
+    import huggingface_hub.file_download
+
+    # Patch 1 : DryRunError
+    if not hasattr(huggingface_hub.errors, 'DryRunError'):
+        class DryRunError(Exception): pass
+        huggingface_hub.errors.DryRunError = DryRunError
+        sys.modules['huggingface_hub.errors'].DryRunError = DryRunError
+        print("  ✅ Patch DryRunError appliqué.")
+
+    # Patch 2 : DryRunFileInfo (Nouvelle erreur que vous avez rencontrée)
+    if not hasattr(huggingface_hub.file_download, 'DryRunFileInfo'):
+        class DryRunFileInfo:
+            def __init__(self, **kwargs): pass
+        huggingface_hub.file_download.DryRunFileInfo = DryRunFileInfo
+        # On l'injecte aussi dans le module s'il est importé directement
+        sys.modules['huggingface_hub.file_download'].DryRunFileInfo = DryRunFileInfo
+        print("  ✅ Patch DryRunFileInfo appliqué.")
 
 # --- 3. LE RESTE DU SCRIPT (VOTRE CODE) ---
 import torch
+import numpy as np
 import librosa
 import io
-from flask import Flask, request, jsonify
+import atexit
+import copy
+import bisect
+import json
+import math
+import queue
+import signal
+import functools
+import contextlib
+import random
+import struct
+import threading
+from collections import defaultdict, deque, OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from dataclasses import dataclass, field, replace
+from flask import Flask, request, jsonify, Response, stream_with_context, g
 from flask_cors import CORS
 from pyngrok import ngrok
 from transformers import (
     AutoTokenizer,
     AutoModelForCausalLM,
     AutoProcessor,
-    AutoModelForCTC
+    AutoModelForCTC,
+    TextIteratorStreamer,
+    LogitsProcessor,
+    LogitsProcessorList,
+    StoppingCriteria,
+    StoppingCriteriaList
 )
-from huggingface_hub import login
+from huggingface_hub import login, list_repo_files, snapshot_download
 
 # === VOS TOKENS (RÉCUPÉRÉS DE VOTRE MESSAGES) ===
 NGROK_AUTH_TOKEN = "VOTRE_TOKEN_NGROK_ICI" 
 HF_TOKEN = "VOTRE_TOKEN_HF_ICI"
 
-# --- AUTHENTIFICATION ---
-if HF_TOKEN:
-    login(token=HF_TOKEN)
-
 # --- CHARGEMENT DES MODÈLES ---
 LLM_MODEL_ID = "google/gemma-2b-it" 
 ASR_MODEL_ID = "google/medasr"
 
-print("🔄 Chargement Gemma...")
-tokenizer = AutoTokenizer.from_pretrained(LLM_MODEL_ID)
-llm_model = AutoModelForCausalLM.from_pretrained(
-    LLM_MODEL_ID,
-    device_map="auto",
-    torch_dtype=torch.float16,
+# --- MÉTRIQUES (format texte Prometheus, exposées sur /metrics) ---
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+class Metric:
+    """Métrique étiquetée minimale : un dictionnaire par combinaison de labels, sous verrou."""
+    kind = "untyped"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name, self.help, self.labelnames = name, help, tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def _fmt_labels(self, key, extra=""):
+        pairs = [f'{n}="{v}"' for n, v in zip(self.labelnames, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{self._fmt_labels(key)} {value}")
+        return lines
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help, labelnames=(), collect=None):
+        super().__init__(name, help, labelnames)
+        self.collect = collect  # fonction appelée au scrape : {tuple(labels): valeur}
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def render(self):
+        if self.collect is not None:
+            for key, value in self.collect().items():
+                with self._lock:
+                    self._values[key] = value
+        return super().render()
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[i] += 1
+            counts[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for key, counts in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(float(bound))
+                    labels = self._fmt_labels(key, 'le="%s"' % le)
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                lines.append(f"{self.name}_sum{self._fmt_labels(key)} {counts[-1]}")
+                lines.append(f"{self.name}_count{self._fmt_labels(key)} {cumulative}")
+        return lines
+
+def device_memory():
+    """Mémoire allouée / réservée par device ; sur CPU, RSS du processus (mêmes métriques)."""
+    values = {}
+    if torch.cuda.is_available():
+        for i in range(torch.cuda.device_count()):
+            values[(f"cuda:{i}", "allocated")] = torch.cuda.memory_allocated(i)
+            values[(f"cuda:{i}", "reserved")] = torch.cuda.memory_reserved(i)
+    else:
+        try:
+            with open("/proc/self/statm") as f:
+                rss = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError):
+            rss = 0
+        values[("cpu", "allocated")] = values[("cpu", "reserved")] = rss
+    return values
+
+STAGE_SECONDS = Histogram(
+    "medgemma_stage_seconds",
+    "Durée par étape : queue_wait, swap_in, tokenize, prefill, decode, detokenize, audio_decode, vad, asr_forward.",
+    ["stage"],
+)
+INPUT_TOKENS = Counter("medgemma_input_tokens_total", "Tokens de prompt traités.")
+OUTPUT_TOKENS = Counter("medgemma_output_tokens_total", "Tokens générés.")
+REQUESTS = Counter("medgemma_requests_total", "Requêtes HTTP par endpoint.", ["endpoint"])
+ERRORS = Counter("medgemma_errors_total", "Réponses en erreur (5xx) par endpoint.", ["endpoint"])
+INFLIGHT = Gauge("medgemma_inflight_requests", "Requêtes HTTP en cours.", ["endpoint"])
+DEVICE_MEMORY = Gauge(
+    "medgemma_device_memory_bytes", "Mémoire du device (allocated / reserved).",
+    ["device", "kind"], collect=device_memory,
+)
+REJECTED = Counter(
+    "medgemma_rejected_total", "Requêtes refusées par le contrôle d'admission (429/503).", ["endpoint", "reason"],
+)
+MODEL_SWAP_SECONDS = Histogram(
+    "medgemma_model_swap_seconds", "Durée des déchargements (out) et rechargements (in) de modèles.",
+    ["model", "direction"],
+)
+MODEL_RESIDENT_BYTES = Gauge(
+    "medgemma_model_resident_bytes", "Poids résidents sur le device, par modèle (0 = déchargé).",
+    ["model"], collect=lambda: residency.resident_bytes(),
 )
+METRICS = [STAGE_SECONDS, INPUT_TOKENS, OUTPUT_TOKENS, REQUESTS, ERRORS, INFLIGHT, DEVICE_MEMORY, REJECTED,
+           MODEL_SWAP_SECONDS, MODEL_RESIDENT_BYTES]
+
+# --- TRAÇAGE (contexte W3C `traceparent`, spans au format OTLP/JSON) ---
+# Une requête est tracée si l'en-tête `traceparent` du client est échantillonné (drapeau 01),
+# sinon avec la probabilité MEDGEMMA_TRACE_SAMPLE. Les spans des étapes (attente en file,
+# tokenisation, pré-remplissage, décodage, ASR...) sont renvoyés au client dans la réponse
+# (`trace`) et exportés : JSONL (une ligne OTLP/JSON par requête, relisible par un
+# collecteur OpenTelemetry), OTLP/HTTP vers un collecteur, ou rien.
+TRACE_SAMPLE_RATE = float(os.getenv("MEDGEMMA_TRACE_SAMPLE", "0"))
+TRACE_EXPORTER = os.getenv("MEDGEMMA_TRACE_EXPORTER", "jsonl")  # jsonl | otlp | none
+TRACE_DIR = os.getenv("MEDGEMMA_TRACE_DIR", os.path.expanduser("~/.cache/medgemma/traces"))
+TRACE_FILE = os.getenv("MEDGEMMA_TRACE_FILE", os.path.join(TRACE_DIR, "medgemma_server_traces.jsonl"))
+OTLP_ENDPOINT = os.getenv("MEDGEMMA_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+TRACE_SERVICE = "medgemma-server"
+TRACEPARENT_RE = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+# Horloge murale d'un instant `perf_counter` (les spans sont en ns depuis l'epoch).
+PERF_EPOCH_OFFSET = time.time() - time.perf_counter()
+
+def otlp_attributes(attributes):
+    def value(v):
+        if isinstance(v, bool):
+            return {"boolValue": v}
+        if isinstance(v, int):
+            return {"intValue": str(v)}
+        if isinstance(v, float):
+            return {"doubleValue": v}
+        return {"stringValue": str(v)}
+    return [{"key": k, "value": value(v)} for k, v in attributes.items()]
+
+def otlp_payload(spans, service=TRACE_SERVICE):
+    """Requête d'export OTLP/JSON (`ExportTraceServiceRequest`) pour une liste de spans."""
+    return {"resourceSpans": [{
+        "resource": {"attributes": otlp_attributes({"service.name": service})},
+        "scopeSpans": [{"scope": {"name": "medgemma"}, "spans": spans}],
+    }]}
+
+class RequestTrace:
+    """Spans d'une requête tracée ; le span racine a pour parent le span HTTP du client."""
+
+    def __init__(self, trace_id, parent_id, name):
+        self.trace_id, self.parent_id = trace_id, parent_id
+        self.span_id = os.urandom(8).hex()
+        self.name = name
+        self.start = time.perf_counter()
+        self.spans = []
+        self.status_code = None
+
+    def add(self, name, start, end, **attributes):
+        self.spans.append(self._span(os.urandom(8).hex(), self.span_id, name, start, end, attributes))
+
+    def _span(self, span_id, parent_id, name, start, end, attributes, kind=1, error=False):
+        return {
+            "traceId": self.trace_id, "spanId": span_id, "parentSpanId": parent_id or "",
+            "name": name, "kind": kind,
+            "startTimeUnixNano": str(int((start + PERF_EPOCH_OFFSET) * 1e9)),
+            "endTimeUnixNano": str(int((end + PERF_EPOCH_OFFSET) * 1e9)),
+            "attributes": otlp_attributes(attributes),
+            "status": {"code": 2 if error else 0},
+        }
+
+    def export_spans(self, end=None):
+        """Racine (jusqu'à `end`, défaut maintenant) + spans des étapes, au format OTLP/JSON."""
+        root = self._span(self.span_id, self.parent_id, self.name, self.start, end or time.perf_counter(),
+                          {"service.name": TRACE_SERVICE, "http.status_code": self.status_code or 0}, kind=2,
+                          error=(self.status_code or 0) >= 500)
+        return [root, *self.spans]
+
+class JsonlTraceExporter:
+    """Une ligne OTLP/JSON par requête tracée, ajoutée au fichier."""
+
+    def __init__(self, path=TRACE_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, spans):
+        line = json.dumps(otlp_payload(spans), ensure_ascii=False)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+class OtlpHttpTraceExporter:
+    """Envoi OTLP/HTTP (JSON) à un collecteur OpenTelemetry, depuis un thread dédié."""
+
+    def __init__(self, endpoint=OTLP_ENDPOINT):
+        import urllib.request
+        self.endpoint, self._urllib = endpoint, urllib.request
+        self._queue = queue.Queue(maxsize=1000)
+        threading.Thread(target=self._loop, name="otlp-exporter", daemon=True).start()
+
+    def export(self, spans):
+        try:
+            self._queue.put_nowait(spans)
+        except queue.Full:
+            pass  # collecteur injoignable : on perd des traces plutôt que de ralentir les requêtes
+
+    def _loop(self):
+        while True:
+            body = json.dumps(otlp_payload(self._queue.get())).encode("utf-8")
+            req = self._urllib.Request(self.endpoint, body, {"Content-Type": "application/json"})
+            try:
+                self._urllib.urlopen(req, timeout=5).close()
+            except OSError as e:
+                print(f"⚠️ Export OTLP : {e}")
+
+class NullTraceExporter:
+    def export(self, spans):
+        pass
+
+def build_trace_exporter(kind=TRACE_EXPORTER):
+    return {"jsonl": JsonlTraceExporter, "otlp": OtlpHttpTraceExporter}.get(kind, NullTraceExporter)()
+
+trace_exporter = build_trace_exporter()
+# Traces actives du thread courant : la requête dans un thread HTTP, toutes les
+# requêtes tracées du batch dans le thread du scheduler.
+_active_traces = threading.local()
+
+def start_trace(headers, name):
+    """`RequestTrace` si la requête est échantillonnée, sinon None."""
+    match = TRACEPARENT_RE.match(headers.get("traceparent", "").strip().lower())
+    if match:
+        trace_id, parent_id, flags = match.groups()
+        if not int(flags, 16) & 1:
+            return None
+    elif TRACE_SAMPLE_RATE and random.random() < TRACE_SAMPLE_RATE:
+        trace_id, parent_id = os.urandom(16).hex(), None
+    else:
+        return None
+    return RequestTrace(trace_id, parent_id, name)
+
+@contextlib.contextmanager
+def active_traces(traces):
+    previous = getattr(_active_traces, "traces", ())
+    _active_traces.traces = [t for t in traces if t is not None]
+    try:
+        yield
+    finally:
+        _active_traces.traces = previous
+
+def record_stage(stage, start, end, **attributes):
+    """Durée d'une étape : histogramme Prometheus + span dans chaque trace active."""
+    STAGE_SECONDS.observe(end - start, stage=stage)
+    for trace in getattr(_active_traces, "traces", ()):
+        trace.add(stage, start, end, **attributes)
+
+class StageTimer:
+    """`with StageTimer("tokenize"):` → observe la durée du bloc (STAGE_SECONDS, traces actives)."""
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record_stage(self.stage, self.start, time.perf_counter())
+
+class FirstStepTimer(LogitsProcessor):
+    """Horodate la première étape de décodage pour séparer pré-remplissage et décodage."""
+
+    def __init__(self):
+        self.first_step = None
+
+    def __call__(self, input_ids, scores):
+        if self.first_step is None:
+            if scores.is_cuda:
+                torch.cuda.synchronize(scores.device)  # une seule synchro par génération
+            self.first_step = time.perf_counter()
+        return scores
+
+# --- CONTRÔLE D'ADMISSION (limites par endpoint, échéances, arrêt progressif) ---
+# Requêtes exécutées en parallèle par endpoint, et requêtes autorisées à attendre un
+# créneau au-delà. Le reste est refusé immédiatement (429) au lieu de laisser le client
+# attendre son propre timeout.
+ENDPOINT_LIMITS = {
+    "generate": int(os.getenv("MEDGEMMA_LIMIT_GENERATE", "16")),
+    "transcribe": int(os.getenv("MEDGEMMA_LIMIT_TRANSCRIBE", "2")),
+    "transcribe_batch": int(os.getenv("MEDGEMMA_LIMIT_TRANSCRIBE_BATCH", "1")),
+    "transcribe_stream": int(os.getenv("MEDGEMMA_LIMIT_TRANSCRIBE_STREAM", "4")),
+}
+ENDPOINT_MAX_WAITING = int(os.getenv("MEDGEMMA_MAX_WAITING", "16"))
+ADMISSION_WAIT_S = float(os.getenv("MEDGEMMA_ADMISSION_WAIT_S", "5"))
+# File d'inférence bornée du BatchScheduler ; au-delà : 503.
+INFERENCE_QUEUE_SIZE = int(os.getenv("MEDGEMMA_INFERENCE_QUEUE_SIZE", "64"))
+# Échéance par défaut d'une requête (en dessous du timeout de lecture de l'app, 60 s) ;
+# le client peut la raccourcir avec l'en-tête `X-Request-Timeout` (secondes).
+REQUEST_DEADLINE_S = float(os.getenv("MEDGEMMA_REQUEST_DEADLINE_S", "55"))
+DRAIN_TIMEOUT_S = float(os.getenv("MEDGEMMA_DRAIN_TIMEOUT_S", "30"))
+
+class ServiceUnavailable(Exception):
+    """Refus rapide : renvoyé au client en 429 / 503 avec un en-tête `Retry-After`."""
+
+    def __init__(self, message, status=503, retry_after=1, reason="overloaded"):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+        self.reason = reason
+
+class AdmissionController:
+    """Sémaphores par endpoint avec file d'attente bornée, échéances et drain à l'arrêt.
+
+    `Retry-After` est estimé à partir d'une moyenne glissante de la durée de service
+    de l'endpoint et du nombre de requêtes déjà en attente.
+    """
+
+    def __init__(self, limits=None, max_waiting=ENDPOINT_MAX_WAITING, wait_s=ADMISSION_WAIT_S):
+        self.limits = dict(ENDPOINT_LIMITS if limits is None else limits)
+        self.max_waiting = max_waiting
+        self.wait_s = wait_s
+        self.draining = False
+        self.active = defaultdict(int)
+        self.waiting = defaultdict(int)
+        self.service_s = defaultdict(lambda: 1.0)
+        self.stats = {"admitted": 0, "rejected": 0, "timed_out": 0}
+        self._cond = threading.Condition()
+
+    def retry_after(self, endpoint):
+        limit = self.limits.get(endpoint) or 1
+        return self.service_s[endpoint] * (self.waiting[endpoint] + 1) / limit
+
+    def _reject(self, endpoint, message, status, reason):
+        self.stats["timed_out" if reason == "timeout" else "rejected"] += 1
+        return ServiceUnavailable(message, status, self.retry_after(endpoint), reason)
+
+    def acquire(self, endpoint, deadline):
+        """Attend un créneau jusqu'à `deadline` (horloge `time.monotonic`) au plus ; renvoie l'instant d'admission."""
+        with self._cond:
+            if self.draining:
+                raise self._reject(endpoint, "Serveur en cours d'arrêt", 503, "draining")
+            limit = self.limits.get(endpoint)
+            if limit is not None and self.active[endpoint] >= limit:
+                if self.waiting[endpoint] >= self.max_waiting:
+                    raise self._reject(endpoint, "Trop de requêtes simultanées", 429, "queue_full")
+                wait_until = min(deadline, time.monotonic() + self.wait_s)
+                self.waiting[endpoint] += 1
+                try:
+                    while self.active[endpoint] >= limit:
+                        remaining = wait_until - time.monotonic()
+                        if self.draining:
+                            raise self._reject(endpoint, "Serveur en cours d'arrêt", 503, "draining")
+                        if remaining <= 0:
+                            raise self._reject(endpoint, "Capacité saturée, réessayez", 503, "timeout")
+                        self._cond.wait(remaining)
+                finally:
+                    self.waiting[endpoint] -= 1
+            self.active[endpoint] += 1
+            self.stats["admitted"] += 1
+            return time.monotonic()
+
+    def release(self, endpoint, admitted_at):
+        with self._cond:
+            self.active[endpoint] -= 1
+            elapsed = time.monotonic() - admitted_at
+            self.service_s[endpoint] = 0.8 * self.service_s[endpoint] + 0.2 * elapsed
+            self._cond.notify_all()
+
+    def drain(self, timeout=DRAIN_TIMEOUT_S):
+        """Refuse les nouvelles requêtes et attend la fin de celles en cours ; True si tout est terminé."""
+        end = time.monotonic() + timeout
+        with self._cond:
+            self.draining = True
+            self._cond.notify_all()
+            while sum(self.active.values()) > 0:
+                remaining = end - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def summary(self):
+        with self._cond:
+            return {
+                "draining": self.draining,
+                "limits": self.limits,
+                "active": {k: v for k, v in self.active.items() if v},
+                "waiting": {k: v for k, v in self.waiting.items() if v},
+                "service_s": {k: round(v, 3) for k, v in self.service_s.items()},
+                **self.stats,
+            }
+
+def request_deadline(headers):
+    """Échéance absolue (`time.monotonic`) : en-tête `X-Request-Timeout` borné par le défaut serveur."""
+    budget = REQUEST_DEADLINE_S
+    try:
+        budget = min(budget, float(headers.get("X-Request-Timeout", budget)))
+    except ValueError:
+        pass
+    return time.monotonic() + max(0.0, budget)
+
+# --- BATCHING DYNAMIQUE ---
+# Fenêtre de regroupement des requêtes concurrentes et taille max d'un batch.
+BATCH_WINDOW_MS = float(os.getenv("MEDGEMMA_BATCH_WINDOW_MS", "20"))
+BATCH_MAX_SIZE = int(os.getenv("MEDGEMMA_BATCH_MAX_SIZE", "8"))
+GENERATE_TIMEOUT_S = float(os.getenv("MEDGEMMA_GENERATE_TIMEOUT_S", "120"))
+
+# --- CACHE KV (préfixes système + conversations) ---
+# Budget mémoire des caches conservés entre les requêtes, et nombre max de sessions.
+KV_CACHE_MAX_MB = float(os.getenv("MEDGEMMA_KV_CACHE_MAX_MB", "1024"))
+KV_CACHE_MAX_SESSIONS = int(os.getenv("MEDGEMMA_KV_CACHE_MAX_SESSIONS", "64"))
+
+def cache_nbytes(cache):
+    """Taille mémoire d'un `DynamicCache` (API `layers` récente ou `key_cache` historique)."""
+    if hasattr(cache, "layers"):
+        tensors = [t for layer in cache.layers for t in (layer.keys, layer.values)]
+    else:
+        tensors = list(cache.key_cache) + list(cache.value_cache)
+    return sum(t.numel() * t.element_size() for t in tensors if t is not None)
+
+def common_prefix_len(a, b):
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+class KVCacheStore:
+    """Conserve des `past_key_values` réutilisables entre requêtes.
+
+    Deux types d'entrées : les préfixes d'instruction système (`prefix`), calculés une
+    fois, et les continuations de session (`session`), mises à jour après chaque tour.
+    Une requête réutilise l'entrée partageant le plus long préfixe de tokens avec son
+    prompt ; seule la suite est pré-remplie. Éviction LRU (sessions d'abord) au-delà de
+    `max_bytes` ou de `max_sessions`.
+    """
+
+    def __init__(self, max_bytes=KV_CACHE_MAX_MB * 2**20, max_sessions=KV_CACHE_MAX_SESSIONS):
+        self.max_bytes = max_bytes
+        self.max_sessions = max_sessions
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "prefill_tokens": 0, "reused_tokens": 0}
+        self._entries = OrderedDict()  # (kind, key) -> (token_ids, cache, nbytes)
+        self._lock = threading.Lock()
+
+    def has_prefix(self, text):
+        with self._lock:
+            return ("prefix", text) in self._entries
+
+    def put(self, kind, key, token_ids, cache):
+        with self._lock:
+            self._entries.pop((kind, key), None)
+            self._entries[(kind, key)] = (list(token_ids), cache, cache_nbytes(cache))
+            self._evict()
+
+    def lookup(self, token_ids, session_id=None):
+        """Renvoie `(copie du cache tronquée, nb de tokens réutilisés)` ou `(None, 0)`."""
+        with self._lock:
+            candidates = [k for k in self._entries if k[0] == "prefix" or k == ("session", session_id)]
+            best_key, best_len = None, 0
+            for key in candidates:
+                n = common_prefix_len(self._entries[key][0], token_ids)
+                if n > best_len:
+                    best_key, best_len = key, n
+            # Au moins un token doit rester à pré-remplir pour produire des logits.
+            best_len = min(best_len, len(token_ids) - 1)
+            self.stats["prefill_tokens"] += len(token_ids) - max(best_len, 0)
+            if best_key is None or best_len <= 0:
+                self.stats["misses"] += 1
+                return None, 0
+            self._entries.move_to_end(best_key)
+            cache = copy.deepcopy(self._entries[best_key][1])
+            self.stats["hits"] += 1
+            self.stats["reused_tokens"] += best_len
+        surplus = cache.get_seq_length() - best_len
+        if surplus > 0:
+            cache.crop(-surplus)  # forme négative : acceptée par toutes les versions
+        return cache, best_len
+
+    def summary(self):
+        with self._lock:
+            kinds = [k[0] for k in self._entries]
+            return {
+                **self.stats,
+                "prefixes": kinds.count("prefix"),
+                "sessions": kinds.count("session"),
+                "memory_mb": round(sum(e[2] for e in self._entries.values()) / 2**20, 1),
+            }
+
+    def _evict(self):
+        def total():
+            return sum(e[2] for e in self._entries.values())
+        sessions = [k for k in self._entries if k[0] == "session"]
+        while sessions and (len(sessions) > self.max_sessions or total() > self.max_bytes):
+            del self._entries[sessions.pop(0)]
+            self.stats["evictions"] += 1
+        while self._entries and total() > self.max_bytes:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+# --- PROFILS DE GÉNÉRATION PAR ÉTAPE ---
+# Budget de tokens et critères d'arrêt par étape du triage : la génération s'arrête dès
+# que la réponse attendue est complète au lieu d'aller jusqu'à `max_new_tokens`.
+MAX_NEW_TOKENS_LIMIT = int(os.getenv("MEDGEMMA_MAX_NEW_TOKENS_LIMIT", "1024"))
+MAX_STOP_SEQUENCES = 8
+
+@dataclass(frozen=True)
+class GenerationProfile:
+    """Budget et arrêt d'une étape. `item_pattern` repère le début d'une rubrique (ligne) :
+    la réponse est complète quand la `item_count`-ième rubrique se termine par `item_end`,
+    après au moins `item_min_chars` caractères (un titre seul ne clôt pas la rubrique)."""
+    name: str = "default"
+    max_new_tokens: int = 600
+    temperature: float = 0.4
+    stop: tuple = ()
+    item_pattern: str = None
+    item_count: int = 0
+    item_end: str = "\n"
+    item_min_chars: int = 0
+    schema: str = None  # schéma JSON (sérialisé) imposé à la sortie
+
+    def cut(self, text):
+        """Position de fin de la réponse utile dans `text`, ou None si elle n'est pas terminée."""
+        positions = [text.find(s) for s in self.stop if s in text]
+        if self.item_count:
+            starts = [m.start() for m in re.finditer(self.item_pattern, text, re.MULTILINE)]
+            if len(starts) >= self.item_count:
+                start = starts[self.item_count - 1]
+                end = text.find(self.item_end, start + self.item_min_chars)
+                if end != -1:
+                    positions.append(end)
+        return min(positions) if positions else None
+
+    def trim(self, text):
+        cut = self.cut(text)
+        return text if cut is None else text[:cut]
+
+    def override(self, options):
+        """Profil ajusté par le client : `max_new_tokens`, `stop`, `max_items` (bornés), `schema`."""
+        changes = {}
+        if options.get("max_new_tokens") is not None:
+            changes["max_new_tokens"] = max(1, min(int(options["max_new_tokens"]), MAX_NEW_TOKENS_LIMIT))
+        if options.get("stop"):
+            changes["stop"] = tuple(str(s) for s in options["stop"] if s)[:MAX_STOP_SEQUENCES]
+        if options.get("max_items") is not None and self.item_pattern:
+            changes["item_count"] = max(1, int(options["max_items"]))
+        if options.get("schema"):
+            schema = json.dumps(options["schema"], ensure_ascii=False, separators=(",", ":"))
+            if len(schema) > MAX_SCHEMA_CHARS:
+                raise ValueError("Schéma trop long")
+            check_schema(options["schema"])
+            # Le JSON se termine de lui-même : ni rubriques ni séquences d'arrêt.
+            changes.update(schema=schema, stop=(), item_count=0)
+        return replace(self, **changes) if changes else self
+
+BULLET_PATTERN = r"^[ \t]*(?:[-*•]|\d+[.)])[ \t]+"
+GENERATION_PROFILES = {
+    "default": GenerationProfile(),
+    # 3-4 questions à puces : arrêt à la fin de la 4e ligne de liste.
+    "questions": GenerationProfile(
+        "questions", int(os.getenv("MEDGEMMA_QUESTIONS_MAX_TOKENS", "200")),
+        item_pattern=BULLET_PATTERN, item_count=4,
+    ),
+    # Rapport en 4 rubriques numérotées : arrêt au premier paragraphe vide après la rubrique 4.
+    "final": GenerationProfile(
+        "final", int(os.getenv("MEDGEMMA_FINAL_MAX_TOKENS", "600")),
+        item_pattern=r"^[ \t#*]*4[.)]", item_count=1, item_end="\n\n", item_min_chars=40,
+    ),
+}
+
+def resolve_profile(options):
+    """Profil demandé par le client (`{"profile": ..., "max_new_tokens": ..., "stop": [...]}`)."""
+    options = options or {}
+    profile = GENERATION_PROFILES.get(options.get("profile") or "default")
+    if profile is None:
+        raise ValueError(f"Profil de génération inconnu : {options.get('profile')}")
+    return profile.override(options)
+
+@functools.lru_cache(maxsize=4)
+def newline_token_ids(tokenizer):
+    """Tokens contenant un saut de ligne : les rubriques ne peuvent se terminer que sur eux."""
+    vocab = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+    return frozenset(i for i, token in enumerate(vocab)
+                     if token and ("\n" in token or "Ċ" in token or token == "<0x0A>"))
+
+class ProfileStoppingCriteria(StoppingCriteria):
+    """Arrêt par séquence du batch selon le profil ; ne décode que la fin de la génération
+    (séquences d'arrêt) ou, aux sauts de ligne seulement, la partie générée (rubriques)."""
+
+    def __init__(self, tokenizer, profile, prompt_len):
+        self.tokenizer = tokenizer
+        self.profile = profile
+        self.prompt_len = prompt_len
+        self.newline_ids = newline_token_ids(tokenizer) if profile.item_count else frozenset()
+        # Un token produit au moins un caractère : autant de tokens que la plus longue séquence.
+        self.tail_tokens = max((len(s) for s in profile.stop), default=0) + 1
+
+    def __call__(self, input_ids, scores, **kwargs):
+        done = []
+        for row in input_ids:
+            generated = row[self.prompt_len:]
+            stop = False
+            if self.profile.stop:
+                tail = self.tokenizer.decode(generated[-self.tail_tokens:], skip_special_tokens=True)
+                stop = any(s in tail for s in self.profile.stop)
+            if not stop and len(generated) and int(generated[-1]) in self.newline_ids:
+                text = self.tokenizer.decode(generated, skip_special_tokens=True)
+                stop = self.profile.cut(text) is not None
+            done.append(stop)
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+# --- SORTIE STRUCTURÉE (décodage contraint par schéma JSON) ---
+# Le client joint un schéma JSON au profil (`generation.schema`) : le modèle ne peut
+# produire qu'un JSON compact conforme. Les clés, la ponctuation et la fin du document
+# sont imposées token par token ; le modèle ne choisit que les valeurs (énumérations,
+# booléens, textes courts). Sous-ensemble pris en charge : objets (toutes les propriétés,
+# dans l'ordre), chaînes (`enum`, `maxLength`), booléens, tableaux de chaînes (`maxItems`).
+# Chaque état connaît la plus courte fin possible du document : quand le budget restant
+# (tokens, ou temps jusqu'à l'échéance) n'en laisse plus que de quoi l'écrire, elle est imposée.
+MAX_SCHEMA_CHARS = 4096
+SCHEMA_STRING_MAX = 120
+SCHEMA_ARRAY_MAX = 8
+
+def check_schema(schema):
+    """Lève ValueError si le schéma sort du sous-ensemble pris en charge."""
+    kind = schema.get("type") if isinstance(schema, dict) else None
+    if kind == "object":
+        if not schema.get("properties"):
+            raise ValueError("Schéma : objet sans propriétés")
+        for sub in schema["properties"].values():
+            check_schema(sub)
+    elif kind == "array":
+        if (schema.get("items") or {}).get("type") != "string":
+            raise ValueError("Schéma : seuls les tableaux de chaînes sont pris en charge")
+        check_schema(schema["items"])
+    elif kind not in ("string", "boolean"):
+        raise ValueError(f"Schéma : type non pris en charge ({kind})")
+
+def _json_key(i, key):
+    return ("{" if i == 0 else ",") + json.dumps(key, ensure_ascii=False) + ":"
+
+def _json_options(schema):
+    if schema["type"] == "boolean":
+        return ["true", "false"]
+    return [json.dumps(v, ensure_ascii=False) for v in schema.get("enum") or ()]
+
+def json_minimal(schema):
+    """Plus court document conforme au schéma (chaînes vides, un élément par tableau)."""
+    kind = schema["type"]
+    if kind == "object":
+        return "".join(_json_key(i, key) + json_minimal(sub)
+                       for i, (key, sub) in enumerate(schema["properties"].items())) + "}"
+    if kind == "array":
+        return "[" + json_minimal(schema["items"]) + "]"
+    return min(_json_options(schema), key=len, default='""')
+
+# `after` : plus courte fin du document derrière la valeur en cours, ajoutée à chaque attente.
+def _json_literal(text, after):
+    for i in range(len(text)):
+        yield ("literal", text[i:], text[i:] + after)
+
+def _json_choice(options, after):
+    consumed = ""
+    while consumed not in options:
+        rests = [o[len(consumed):] for o in options if o.startswith(consumed)]
+        consumed += yield ("choice", rests, after, min(rests, key=len) + after)
+    return consumed
+
+def _json_string(schema, after):
+    if schema.get("enum"):
+        yield from _json_choice(_json_options(schema), after)
+        return
+    yield from _json_literal('"', '"' + after)
+    length, max_length = 0, schema.get("maxLength", SCHEMA_STRING_MAX)
+    while (yield ("string", length, max_length, '"' + after)) != '"':
+        length += 1
+
+def _json_value(schema, after=""):
+    kind = schema["type"]
+    if kind == "object":
+        items = list(schema["properties"].items())
+        for i, (key, sub) in enumerate(items):
+            rest = "".join(_json_key(j, k) + json_minimal(s) for j, (k, s) in enumerate(items) if j > i) + "}"
+            yield from _json_literal(_json_key(i, key), json_minimal(sub) + rest + after)
+            yield from _json_value(sub, rest + after)
+        yield from _json_literal("}", after)
+    elif kind == "array":
+        # Au moins un élément : un tableau vide n'apporte rien au rapport.
+        yield from _json_literal("[", json_minimal(schema["items"]) + "]" + after)
+        for i in range(max(1, schema.get("maxItems", SCHEMA_ARRAY_MAX))):
+            # "]" en premier : à longueur égale, c'est l'option qui termine le document.
+            if i and (yield from _json_choice(["]", ","], after)) == "]":
+                return
+            yield from _json_string(schema["items"], "]" + after)
+        yield from _json_literal("]", after)
+    elif kind == "boolean":
+        yield from _json_choice(_json_options(schema), after)
+    else:
+        yield from _json_string(schema, after)
+
+def json_grammar(schema):
+    """Automate du schéma : reçoit les caractères émis (`send`) et produit l'attente courante :
+    `("literal", reste, fin)`, `("choice", options, suite, fin)`, `("string", longueur, max, fin)` ou
+    `("end",)` ; `fin` est le plus court texte qui termine le document depuis cet état."""
+    yield from _json_value(schema)
+    while True:
+        yield ("end",)
+
+class SchemaVocab:
+    """Texte de chaque token et index dérivés, calculés une fois par tokenizer."""
+
+    def __init__(self, tokenizer, eos_ids):
+        # Texte d'un token isolé : décodé derrière un token d'ancrage pour garder l'espace initial.
+        anchor = tokenizer.encode("a", add_special_tokens=False)[:1]
+        prefix = tokenizer.decode(anchor)
+        special = set(tokenizer.all_special_ids)
+        decoded = tokenizer.batch_decode([anchor + [i] for i in range(len(tokenizer))])
+        self.texts = [None if i in special else text[len(prefix):] for i, text in enumerate(decoded)]
+        self.by_text = defaultdict(list)
+        for i, text in enumerate(self.texts):
+            if text:
+                self.by_text[text].append(i)
+        # Contenu de chaîne JSON sûr : ni guillemet, ni échappement, ni caractère de contrôle,
+        # ni fragment UTF-8 incomplet.
+        self.string_safe = torch.tensor([
+            bool(text) and not any(c in '"\\\ufffd' or ord(c) < 32 for c in text) for text in self.texts
+        ])
+        self.lengths = torch.tensor([len(text or "") for text in self.texts])
+        self.max_token_chars = int(self.lengths.max())
+        self.eos_ids = sorted(set(eos_ids))
+        self._tokenized = {}
+        self._string_masks = {}
+
+    def tokenize(self, text):
+        """Découpage glouton de `text` (plus long token à chaque pas), comme les littéraux imposés."""
+        ids = self._tokenized.get(text)
+        if ids is None:
+            ids, pos = [], 0
+            while pos < len(text):
+                for k in range(min(len(text) - pos, self.max_token_chars), 0, -1):
+                    if text[pos:pos + k] in self.by_text:
+                        ids.append(self.by_text[text[pos:pos + k]][0])
+                        pos += k
+                        break
+                else:
+                    raise ValueError(f"Aucun token pour {text[pos]!r}")
+            self._tokenized[text] = ids
+        return ids
+
+    def allowed(self, expect, budget=None):
+        """Tokens autorisés pour l'attente courante (liste d'ids ou masque booléen).
+
+        `budget` : tokens encore possibles (None : illimité). S'il ne reste que de quoi écrire
+        la plus courte fin du document, seul son premier token est autorisé ; un contenu de
+        chaîne ne rallonge pas cette fin, une option plus longue (`"medium"`) si.
+        """
+        kind = expect[0]
+        if kind == "end":
+            return self.eos_ids
+        if budget is not None and len(self.tokenize(expect[-1])) >= budget:
+            return self.tokenize(expect[-1])[:1]
+        if kind == "literal":
+            # Texte imposé : le plus long token qui en est un préfixe (un seul pas de décodage).
+            return self.tokenize(expect[1])[:1]
+        if kind == "choice":
+            # Budget serré : seuls les débuts d'option dont la fin tient encore dans le budget.
+            _, options, after, _ = expect
+            return [i for option in options for k in range(1, len(option) + 1)
+                    for i in self.by_text.get(option[:k], ())
+                    if budget is None or len(self.tokenize(option[k:] + after)) < budget]
+        _, length, max_length, _ = expect
+        if length >= max_length:
+            return self.by_text['"']
+        return self._string_mask(max_length - length, closable=length > 0)
+
+    def _string_mask(self, remaining, closable):
+        """Contenu de chaîne d'au plus `remaining` caractères (guillemet fermant si `closable`)."""
+        key = (min(remaining, self.max_token_chars), closable)
+        mask = self._string_masks.get(key)
+        if mask is None:
+            mask = self.string_safe & (self.lengths <= key[0])
+            if closable:
+                mask[self.by_text['"']] = True
+            self._string_masks[key] = mask
+        return mask
+
+@functools.lru_cache(maxsize=4)
+def schema_vocab(tokenizer, eos_ids):
+    return SchemaVocab(tokenizer, eos_ids)
+
+@functools.lru_cache(maxsize=32)
+def parse_schema(schema_json):
+    return json.loads(schema_json)
+
+class JsonSchemaLogitsProcessor(LogitsProcessor):
+    """Masque les logits hors grammaire, séquence par séquence du batch.
+
+    Le document est refermé à temps : avant `max_new_tokens`, et avant l'échéance
+    `deadline` (`time.monotonic`) d'après la durée moyenne d'un pas de décodage.
+    """
+
+    def __init__(self, vocab, schema_json, max_new_tokens=None, deadline=None):
+        self.vocab = vocab
+        self.schema = parse_schema(schema_json)
+        self.max_new_tokens = max_new_tokens
+        self.deadline = deadline
+        self.states = None
+        self.steps = 0
+        self.first_step_at = None
+
+    def budget(self):
+        """Tokens encore possibles, pas courant compris (None : illimité)."""
+        budgets = []
+        if self.max_new_tokens is not None:
+            budgets.append(self.max_new_tokens - self.steps)
+        if self.deadline is not None:
+            now = time.monotonic()
+            if self.steps:
+                step_s = (now - self.first_step_at) / self.steps
+                budgets.append(int((self.deadline - now) / step_s) if step_s > 0 else 0)
+            elif now >= self.deadline:
+                budgets.append(0)
+        return min(budgets, default=None)
+
+    def __call__(self, input_ids, scores):
+        if self.states is None:  # premier pas : rien n'a encore été généré
+            self.first_step_at = time.monotonic()
+            self.states = []
+            for _ in range(input_ids.shape[0]):
+                grammar = json_grammar(self.schema)
+                self.states.append([grammar, next(grammar)])
+        else:
+            for state, token in zip(self.states, input_ids[:, -1].tolist()):
+                grammar, expect = state
+                if expect[0] == "end":
+                    continue
+                for char in self.vocab.texts[token] or "":
+                    expect = grammar.send(char)
+                state[1] = expect
+            self.steps += 1
+        budget = self.budget()
+        mask = torch.full_like(scores, float("-inf"))
+        for row, (_, expect) in enumerate(self.states):
+            allowed = self.vocab.allowed(expect, budget)
+            if isinstance(allowed, torch.Tensor):
+                allowed = allowed.to(scores.device)[:scores.shape[1]]
+                mask[row, :len(allowed)][allowed] = 0
+            else:
+                mask[row, allowed] = 0
+        return scores + mask
+
+@dataclass
+class GenerationResult:
+    text: str
+    input_tokens: int
+    output_tokens: int
+
+    def usage(self):
+        return {"input_tokens": self.input_tokens, "output_tokens": self.output_tokens}
+
+@dataclass
+class GenerationRequest:
+    prompt: str
+    max_new_tokens: int = 600
+    temperature: float = 0.4
+    streamer: object = None
+    prefix: str = None       # début de prompt commun (instruction système) à garder en cache
+    session_id: str = None   # conversation dont on conserve le cache KV entre les étapes
+    deadline: float = None   # échéance (`time.monotonic`) au-delà de laquelle le calcul est inutile
+    profile: GenerationProfile = None  # critères d'arrêt de l'étape (budget : `max_new_tokens`)
+    trace: RequestTrace = None         # spans des étapes si la requête est tracée
+    future: Future = field(default_factory=Future)
+    enqueued_at: float = field(default_factory=time.perf_counter)
+
+    @property
+    def params(self):
+        """Paramètres de génération : seules les requêtes identiques partagent un batch."""
+        if self.streamer is not None:
+            return id(self)  # le streamer ne gère qu'une séquence : exécution seule
+        return (self.max_new_tokens, self.temperature, self.profile)
+
+class BatchScheduler:
+    """Regroupe les requêtes /generate concurrentes en un seul `generate` batché.
+
+    Un thread unique possède le modèle : il attend une première requête, collecte les
+    suivantes pendant `window_ms` (ou jusqu'à `max_batch_size`), les tokenise avec un
+    padding à gauche puis rend à chaque appelant sa propre tranche décodée.
+    """
+
+    def __init__(self, model, tokenizer, window_ms=BATCH_WINDOW_MS, max_batch_size=BATCH_MAX_SIZE, kv_cache=None,
+                 queue_size=INFERENCE_QUEUE_SIZE, slot=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        # Slot du modèle : chaque batch le rend résident s'il a été déchargé (ResidencyManager).
+        self.slot = slot
+        # Les requêtes seules (faible charge, streaming) réutilisent les caches KV ;
+        # au-delà, le batching prime et le prompt complet est pré-rempli.
+        self.kv_cache = kv_cache
+        self.window_ms = window_ms
+        self.max_batch_size = max_batch_size
+        # Padding à gauche : les tokens générés restent alignés en fin de séquence.
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.stats = {"requests": 0, "batches": 0, "max_batch_seen": 0, "expired": 0, "cancelled": 0}
+        self.batch_s = 1.0  # durée moyenne d'un batch, pour estimer `Retry-After`
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._deferred = deque()  # requêtes aux paramètres différents, pour le prochain tour
+        self._thread = threading.Thread(target=self._loop, name="batch-scheduler", daemon=True)
+        self._thread.start()
+
+    def submit(self, prompt, max_new_tokens=600, temperature=0.4, prefix=None, session_id=None, deadline=None,
+               profile=None, trace=None):
+        """Met une requête en file et renvoie un `Future` résolu avec un `GenerationResult`.
+
+        Lève `ServiceUnavailable` si la file d'inférence est pleine.
+        """
+        req = GenerationRequest(
+            prompt, max_new_tokens, temperature, prefix=prefix, session_id=session_id, deadline=deadline,
+            profile=profile, trace=trace,
+        )
+        self._enqueue(req)
+        return req.future
+
+    def submit_stream(self, prompt, max_new_tokens=600, temperature=0.4, prefix=None, session_id=None,
+                      deadline=None, profile=None, trace=None):
+        """Comme `submit`, mais renvoie aussi un itérateur de texte alimenté token par token."""
+        streamer = TextIteratorStreamer(
+            self.tokenizer, skip_prompt=True, skip_special_tokens=True, timeout=GENERATE_TIMEOUT_S
+        )
+        req = GenerationRequest(
+            prompt, max_new_tokens, temperature, streamer=streamer, prefix=prefix, session_id=session_id,
+            deadline=deadline, profile=profile, trace=trace,
+        )
+        self._enqueue(req)
+        return streamer, req.future
 
-print("🔄 Chargement MedASR...")
-try:
-    asr_processor = AutoProcessor.from_pretrained(ASR_MODEL_ID)
-    asr_model = AutoModelForCTC.from_pretrained(
-        ASR_MODEL_ID,
-        device_map="auto",
-        torch_dtype=torch.float16,
+    def _enqueue(self, req):
+        try:
+            self._queue.put_nowait(req)
+        except queue.Full:
+            retry_after = self.batch_s * self._queue.qsize() / max(1, self.max_batch_size)
+            raise ServiceUnavailable("File d'inférence pleine", 503, retry_after, reason="inference_queue_full")
+
+    def config(self):
+        return {"window_ms": self.window_ms, "max_batch_size": self.max_batch_size,
+                "queue_size": self._queue.maxsize, "queued": self._queue.qsize() + len(self._deferred)}
+
+    def stop(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _collect(self):
+        first = self._deferred.popleft() if self._deferred else self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        # On reprend d'abord les requêtes mises de côté compatibles avec la première.
+        for req in list(self._deferred):
+            if len(batch) >= self.max_batch_size:
+                break
+            if req.params == first.params:
+                self._deferred.remove(req)
+                batch.append(req)
+        deadline = time.monotonic() + self.window_ms / 1000
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                req = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if req is None:
+                self._queue.put(None)  # on termine ce batch puis on s'arrête
+                break
+            if req.params == first.params:
+                batch.append(req)
+            else:
+                self._deferred.append(req)
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            self._run(batch)
+
+    def _start(self, req):
+        """Écarte avant calcul les requêtes annulées par l'appelant ou déjà hors délai."""
+        if not req.future.set_running_or_notify_cancel():
+            self.stats["cancelled"] += 1
+        elif req.deadline is not None and time.monotonic() >= req.deadline:
+            self.stats["expired"] += 1
+            req.future.set_exception(
+                ServiceUnavailable("Échéance dépassée avant traitement", 503, self.batch_s, reason="deadline")
+            )
+        else:
+            return True
+        if req.streamer is not None:
+            req.streamer.end()
+        return False
+
+    def _run(self, batch):
+        batch = [req for req in batch if self._start(req)]
+        if not batch:
+            return
+        started = time.perf_counter()
+        for req in batch:
+            STAGE_SECONDS.observe(started - req.enqueued_at, stage="queue_wait")
+            if req.trace is not None:
+                req.trace.add("queue_wait", req.enqueued_at, started, batch_size=len(batch))
+        try:
+            manager = self.slot.residency if self.slot is not None else None
+            resident = manager.use(self.slot) if manager is not None else contextlib.nullcontext()
+            with active_traces([req.trace for req in batch]), resident, torch.inference_mode():
+                if len(batch) == 1 and self.kv_cache is not None:
+                    results = [self._generate_cached(batch[0])]
+                else:
+                    results = self._generate_batch(batch)
+            for req, result in zip(batch, results):
+                INPUT_TOKENS.inc(result.input_tokens)
+                OUTPUT_TOKENS.inc(result.output_tokens)
+                req.future.set_result(result)
+        except Exception as e:
+            for req in batch:
+                if not req.future.done():
+                    req.future.set_exception(e)
+                if req.streamer is not None:
+                    req.streamer.end()  # débloque le consommateur du flux
+        finally:
+            self.batch_s = 0.8 * self.batch_s + 0.2 * (time.perf_counter() - started)
+            self.stats["requests"] += len(batch)
+            self.stats["batches"] += 1
+            self.stats["max_batch_seen"] = max(self.stats["max_batch_seen"], len(batch))
+
+    def _generation_kwargs(self, batch, prompt_len):
+        req = batch[0]
+        kwargs = dict(
+            max_new_tokens=req.max_new_tokens,
+            temperature=req.temperature,
+            do_sample=True,
+            pad_token_id=self.tokenizer.pad_token_id,
+            streamer=req.streamer,
+        )
+        if req.profile is not None and (req.profile.stop or req.profile.item_count):
+            kwargs["stopping_criteria"] = StoppingCriteriaList(
+                [ProfileStoppingCriteria(self.tokenizer, req.profile, prompt_len)]
+            )
+        # Le batch s'arrête à l'échéance la plus lointaine : au-delà, personne n'attend plus.
+        deadlines = [r.deadline for r in batch if r.deadline is not None]
+        deadline = max(deadlines) if len(deadlines) == len(batch) else None
+        if req.profile is not None and req.profile.schema:
+            # Pas de coupure brutale d'un JSON : le processeur le referme avant le budget et
+            # l'échéance, puis n'autorise plus que la fin de séquence. Le plus court document
+            # conforme tient toujours dans le budget.
+            vocab = schema_vocab(self.tokenizer, self.eos_token_ids())
+            minimal = len(vocab.tokenize(json_minimal(parse_schema(req.profile.schema))))
+            kwargs["max_new_tokens"] = max(req.max_new_tokens, minimal + 1)
+            kwargs["logits_processor"] = [
+                JsonSchemaLogitsProcessor(vocab, req.profile.schema, kwargs["max_new_tokens"], deadline)
+            ]
+        elif deadline is not None:
+            kwargs["max_time"] = max(0.0, deadline - time.monotonic())
+        return kwargs
+
+    def eos_token_ids(self):
+        eos = self.model.generation_config.eos_token_id
+        eos = eos if isinstance(eos, (list, tuple)) else [eos]
+        return tuple(sorted({i for i in (*eos, self.tokenizer.eos_token_id) if i is not None}))
+
+    def _timed_generate(self, **kwargs):
+        """`generate` instrumenté : pré-remplissage jusqu'à la 1re étape, puis décodage."""
+        timer = FirstStepTimer()
+        processors = LogitsProcessorList([timer, *kwargs.pop("logits_processor", ())])
+        start = time.perf_counter()
+        outputs = self.model.generate(**kwargs, logits_processor=processors)
+        end = time.perf_counter()
+        first_step = timer.first_step or end
+        record_stage("prefill", start, first_step)
+        record_stage("decode", first_step, end)
+        return outputs
+
+    def _generate_batch(self, batch):
+        with StageTimer("tokenize"):
+            inputs = self.tokenizer(
+                [req.prompt for req in batch], return_tensors="pt", padding=True
+            ).to(self.model.device)
+        outputs = self._timed_generate(**inputs, **self._generation_kwargs(batch, inputs["input_ids"].shape[1]))
+        # Chaque ligne = [padding + prompt | tokens générés] : on ne décode que la fin.
+        new_tokens = outputs[:, inputs["input_ids"].shape[1]:]
+        with StageTimer("detokenize"):
+            texts = self.tokenizer.batch_decode(new_tokens, skip_special_tokens=True)
+        input_counts = inputs["attention_mask"].sum(dim=1).tolist()
+        output_counts = (new_tokens != self.tokenizer.pad_token_id).sum(dim=1).tolist()
+        return [
+            GenerationResult(self._finish(req, text), n_in, n_out)
+            for req, text, n_in, n_out in zip(batch, texts, input_counts, output_counts)
+        ]
+
+    @staticmethod
+    def _finish(req, text):
+        """Texte rendu : coupé à la fin de la réponse utile selon le profil de l'étape."""
+        if req.profile is not None:
+            text = req.profile.trim(text)
+        return text.strip()
+
+    def _generate_cached(self, req):
+        """Génération d'une seule séquence en reprenant le cache KV le plus long disponible."""
+        if req.prefix and not self.kv_cache.has_prefix(req.prefix):
+            prefix_ids = self.tokenizer(req.prefix, return_tensors="pt").input_ids.to(self.model.device)
+            with StageTimer("prefill"):
+                out = self.model(input_ids=prefix_ids, use_cache=True)
+            self.kv_cache.put("prefix", req.prefix, prefix_ids[0].tolist(), out.past_key_values)
+        with StageTimer("tokenize"):
+            input_ids = self.tokenizer(req.prompt, return_tensors="pt").input_ids.to(self.model.device)
+        cache, _ = self.kv_cache.lookup(input_ids[0].tolist(), req.session_id)
+        outputs = self._timed_generate(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            past_key_values=cache,
+            return_dict_in_generate=True,
+            **self._generation_kwargs([req], input_ids.shape[1]),
+        )
+        sequence = outputs.sequences[0]
+        if req.session_id and outputs.past_key_values is not None:
+            # Le dernier token généré n'est pas encore dans le cache.
+            cached_len = outputs.past_key_values.get_seq_length()
+            self.kv_cache.put("session", req.session_id, sequence[:cached_len].tolist(), outputs.past_key_values)
+        new_tokens = sequence[input_ids.shape[1]:]
+        with StageTimer("detokenize"):
+            text = self.tokenizer.decode(new_tokens, skip_special_tokens=True)
+        return GenerationResult(self._finish(req, text), input_ids.shape[1], len(new_tokens))
+
+def build_prompt(system_instruction, prompt, history=None):
+    """Format de chat Gemma. `history` : tours précédents de la conversation de triage,
+    `{"role": "user"|"model", "content": ..., "system_instruction": ...}`."""
+    turns = ""
+    for turn in history or []:
+        content = turn.get("content", "")
+        if turn.get("role") == "user" and turn.get("system_instruction"):
+            content = f"{turn['system_instruction']}\n\n{content}"
+        turns += f"<start_of_turn>{turn.get('role', 'user')}\n{content}<end_of_turn>\n"
+    return turns + f"<start_of_turn>user\n{system_instruction}\n\n{prompt}<end_of_turn>\n<start_of_turn>model\n"
+
+def build_prompt_context(system_instruction, history=None):
+    """Tout ce qui précède la saisie du prochain tour : historique + instruction système."""
+    return build_prompt(system_instruction, "", history).rsplit("<end_of_turn>", 1)[0]
+
+def build_prompt_prefix(system_instruction, history=None):
+    """Début de prompt fixe (instruction système du premier tour) mis en cache une fois."""
+    if history:
+        system_instruction = history[0].get("system_instruction", "") if history[0].get("role") == "user" else ""
+    if not system_instruction:
+        return None
+    return f"<start_of_turn>user\n{system_instruction}\n\n"
+
+# --- TRANSCRIPTION LONGUE : SEGMENTATION VAD + BATCHING CTC ---
+ASR_SAMPLE_RATE = 16000
+ASR_MAX_CHUNK_S = float(os.getenv("MEDGEMMA_ASR_MAX_CHUNK_S", "20"))
+ASR_BATCH_SIZE = int(os.getenv("MEDGEMMA_ASR_BATCH_SIZE", "8"))
+VAD_FRAME_MS = 30
+VAD_MIN_SILENCE_MS = int(os.getenv("MEDGEMMA_VAD_MIN_SILENCE_MS", "300"))
+VAD_PAD_MS = 150
+VAD_MIN_RMS = 1e-3
+
+def vad_segments(speech, sr=ASR_SAMPLE_RATE, max_chunk_s=ASR_MAX_CHUNK_S,
+                 min_silence_ms=VAD_MIN_SILENCE_MS, frame_ms=VAD_FRAME_MS, pad_ms=VAD_PAD_MS):
+    """Découpe un signal mono en segments de parole `(début, fin)` (en échantillons).
+
+    Détection par énergie RMS par trame avec seuil adaptatif (bruit de fond / pics),
+    fusion des silences plus courts que `min_silence_ms`, puis découpe des segments
+    trop longs au creux d'énergie le plus bas : chaque segment dure au plus `max_chunk_s`.
+    """
+    frame = max(1, int(sr * frame_ms / 1000))
+    n_frames = -(-len(speech) // frame)
+    if n_frames == 0:
+        return []
+    frames = np.pad(speech, (0, n_frames * frame - len(speech))).reshape(n_frames, frame)
+    energy = np.sqrt(np.mean(frames.astype(np.float32) ** 2, axis=1))
+    noise, peak = np.percentile(energy, 10), np.percentile(energy, 95)
+    voiced = energy > max(VAD_MIN_RMS, noise + 0.1 * (peak - noise))
+
+    regions = []
+    min_gap = max(1, min_silence_ms // frame_ms)
+    idx = np.flatnonzero(voiced)
+    if len(idx) == 0:
+        return []
+    start = prev = idx[0]
+    for i in idx[1:]:
+        if i - prev > min_gap:
+            regions.append((start, prev + 1))
+            start = i
+        prev = i
+    regions.append((start, prev + 1))
+
+    pad = pad_ms // frame_ms
+    max_frames = max(1, int(max_chunk_s * 1000 / frame_ms))
+    segments = []
+    for start, end in regions:
+        start, end = max(0, start - pad), min(n_frames, end + pad)
+        while end - start > max_frames:
+            # Coupure au point le plus calme de la seconde moitié de la fenêtre.
+            window = energy[start + max_frames // 2:start + max_frames]
+            cut = start + max_frames // 2 + int(np.argmin(window)) + 1
+            segments.append((start, cut))
+            start = cut
+        segments.append((start, end))
+    return [(s * frame, min(e * frame, len(speech))) for s, e in segments]
+
+def transcribe_chunks(chunks, processor, model, batch_size=ASR_BATCH_SIZE):
+    """Inférence CTC batchée : renvoie une transcription par chunk, dans l'ordre d'entrée.
+
+    Les chunks sont triés par longueur pour limiter le padding ; la mémoire maximale ne
+    dépend que de `batch_size` × `ASR_MAX_CHUNK_S`, pas de la durée totale de l'audio.
+    """
+    order = sorted(range(len(chunks)), key=lambda i: len(chunks[i]))
+    texts = [""] * len(chunks)
+    for b in range(0, len(order), batch_size):
+        ids = order[b:b + batch_size]
+        inputs = processor(
+            [chunks[i] for i in ids], sampling_rate=ASR_SAMPLE_RATE,
+            return_tensors="pt", padding=True, return_attention_mask=True,
+        )
+        inputs = {
+            k: v.to(model.device, dtype=model.dtype) if v.is_floating_point() else v.to(model.device)
+            for k, v in inputs.items()
+        }
+        with torch.inference_mode(), StageTimer("asr_forward"):
+            logits = model(**inputs).logits
+            if logits.is_cuda:
+                torch.cuda.synchronize(logits.device)
+        predicted_ids = torch.argmax(logits, dim=-1)
+        for i, text in zip(ids, processor.batch_decode(predicted_ids)):
+            texts[i] = text.strip()
+    return texts
+
+def transcribe_waveforms(waveforms, processor, model, batch_size=ASR_BATCH_SIZE):
+    """Segmente plusieurs signaux, transcrit tous leurs segments ensemble, puis recolle
+    les morceaux de chaque signal dans l'ordre."""
+    chunks, owners = [], []
+    for w, speech in enumerate(waveforms):
+        with StageTimer("vad"):
+            segments = vad_segments(speech)
+        for start, end in segments:
+            chunks.append(speech[start:end])
+            owners.append(w)
+    texts = transcribe_chunks(chunks, processor, model, batch_size)
+    results = [[] for _ in waveforms]
+    for w, text in zip(owners, texts):
+        if text:
+            results[w].append(text)
+    return [" ".join(parts) for parts in results]
+
+# Format compact envoyé par l'app : en-tête b"MGPC" | fréquence | canaux | format, puis
+# les échantillons PCM bruts (1 = int16, 3 = float32), déjà en 16 kHz mono.
+PCM_MAGIC = b"MGPC"
+PCM_HEADER = struct.Struct("<4sIHH")
+PCM_FORMATS = {1: np.int16, 3: np.float32}
+
+def load_audio(file_bytes):
+    """Signal float32 à 16 kHz : PCM compact enveloppé sans copie ni décodage, sinon librosa."""
+    with StageTimer("audio_decode"):
+        return _load_audio(file_bytes)
+
+def _load_audio(file_bytes):
+    if file_bytes[:4] == PCM_MAGIC:
+        _, rate, channels, fmt = PCM_HEADER.unpack_from(file_bytes)
+        if channels != 1 or fmt not in PCM_FORMATS:
+            raise ValueError("En-tête PCM invalide")
+        speech = np.frombuffer(file_bytes, dtype=PCM_FORMATS[fmt], offset=PCM_HEADER.size)
+        if fmt == 1:
+            speech = speech.astype(np.float32) / 32768.0
+        if rate != ASR_SAMPLE_RATE:
+            speech = librosa.resample(speech, orig_sr=rate, target_sr=ASR_SAMPLE_RATE)
+        return speech
+    speech, _ = librosa.load(io.BytesIO(file_bytes), sr=ASR_SAMPLE_RATE)
+    return speech
+
+# --- TRANSCRIPTION EN DIRECT (fenêtre glissante + fusion CTC) ---
+# L'app envoie l'audio du micro par petits morceaux PCM (requêtes courtes sur une même
+# connexion keep-alive) ; chaque morceau renvoie la transcription partielle.
+STREAM_STEP_MS = int(os.getenv("MEDGEMMA_STREAM_STEP_MS", "300"))        # audio nouveau avant re-décodage
+STREAM_LEFT_CONTEXT_MS = int(os.getenv("MEDGEMMA_STREAM_LEFT_MS", "800"))  # contexte déjà transcrit
+STREAM_MARGIN_MS = int(os.getenv("MEDGEMMA_STREAM_MARGIN_MS", "500"))      # fin de fenêtre : tokens provisoires
+STREAM_TTL_S = float(os.getenv("MEDGEMMA_STREAM_TTL_S", "60"))
+STREAM_MAX_SESSIONS = int(os.getenv("MEDGEMMA_STREAM_MAX_SESSIONS", "32"))
+STREAM_MIN_SAMPLES = 400  # champ réceptif minimal de l'encodeur convolutif
+
+def ctc_frame_labels(speech, processor, model):
+    """Label argmax de chaque trame CTC pour un signal (une seule séquence, sans padding)."""
+    inputs = processor(speech, sampling_rate=ASR_SAMPLE_RATE, return_tensors="pt", return_attention_mask=True)
+    inputs = {
+        k: v.to(model.device, dtype=model.dtype) if v.is_floating_point() else v.to(model.device)
+        for k, v in inputs.items()
+    }
+    with torch.inference_mode(), StageTimer("asr_forward"):
+        labels = torch.argmax(model(**inputs).logits[0], dim=-1)
+    return labels.cpu().numpy()
+
+class StreamingTranscriber:
+    """Transcription incrémentale d'un flux audio par fenêtre glissante.
+
+    Chaque décodage couvre [position engagée − contexte gauche, fin du flux] : le contexte
+    gauche, déjà transcrit, donne au modèle l'acoustique de la jonction mais ses trames sont
+    ignorées. Les tokens des `margin_ms` finales restent provisoires (re-décodés au morceau
+    suivant avec plus de contexte droit) ; les autres sont engagés définitivement. Le
+    regroupement CTC (répétitions, blancs) reprend depuis le label de la dernière trame
+    engagée : un caractère à cheval sur deux fenêtres n'est ni doublé ni perdu. Le coût
+    par morceau est borné par la taille de la fenêtre, pas par la durée de la dictée.
+    """
+
+    def __init__(self, processor, model, step_ms=STREAM_STEP_MS, left_ms=STREAM_LEFT_CONTEXT_MS,
+                 margin_ms=STREAM_MARGIN_MS):
+        self.processor, self.model = processor, model
+        self.tokenizer = getattr(processor, "tokenizer", processor)
+        self.blank = self.tokenizer.pad_token_id
+        self.step = ASR_SAMPLE_RATE * step_ms // 1000
+        self.left = ASR_SAMPLE_RATE * left_ms // 1000
+        self.margin = ASR_SAMPLE_RATE * margin_ms // 1000
+        # Pas d'une trame CTC en échantillons (320 pour Wav2Vec2) : les fenêtres démarrent
+        # sur cette grille, donc une même trame garde la même frontière d'une fenêtre à l'autre.
+        self.hop = getattr(getattr(model, "config", None), "inputs_to_logits_ratio", None)
+        if self.hop:
+            self.left -= self.left % self.hop
+        self.audio = np.zeros(0, dtype=np.float32)
+        self.offset = 0          # position (en échantillons) de audio[0] dans le flux
+        self.committed_pos = 0   # tokens engagés jusqu'à cette position
+        self.decoded_pos = 0     # fin du dernier décodage
+        self.committed_ids = []
+        self.partial_ids = []
+        self.last_label = self.blank
+        self.closed = False
+        self.decodes = 0
+        self.decode_s = 0.0
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+
+    @property
+    def end(self):
+        return self.offset + len(self.audio)
+
+    def feed(self, speech, final=False, offset=None):
+        """Ajoute un morceau (float32, 16 kHz) ; re-décode si assez d'audio nouveau ou en fin de flux.
+
+        `offset` : position du morceau dans le flux ; la partie déjà reçue est ignorée, ce
+        qui rend le renvoi d'un morceau (retry client) sans effet.
+        """
+        with self.lock:
+            self.last_used = time.monotonic()
+            if offset is not None:
+                speech = speech[max(0, self.end - offset):]
+            if len(speech):
+                self.audio = np.concatenate([self.audio, speech.astype(np.float32, copy=False)])
+            if final or self.end - self.decoded_pos >= self.step:
+                self._decode(final)
+            self.closed = final
+            return self.result()
+
+    def _decode(self, final):
+        start = max(self.offset, self.committed_pos - self.left)
+        pending = self.audio[self.committed_pos - self.offset:]
+        if len(pending) and np.sqrt(np.mean(pending ** 2)) < VAD_MIN_RMS and not self.partial_ids:
+            # Silence depuis le dernier token engagé : rien à décoder, la fenêtre avance.
+            self.committed_pos = start + self._grid(self.end - start)
+            self.last_label = self.blank
+        elif self.end - start >= STREAM_MIN_SAMPLES:
+            t0 = time.perf_counter()
+            labels = ctc_frame_labels(self.audio[start - self.offset:], self.processor, self.model)
+            self.decode_s += time.perf_counter() - t0
+            self.decodes += 1
+            stride = self.hop or (self.end - start) / max(1, len(labels))
+            first = min(len(labels), math.ceil((self.committed_pos - start) / stride))
+            limit = len(labels) if final else max(first, int((self.end - self.margin - start) / stride))
+            self.committed_ids += self._collapse(labels[first:limit], self.last_label)
+            if limit > first:
+                self.last_label = int(labels[limit - 1])
+                self.committed_pos = start + self._grid(round(limit * stride))
+            self.partial_ids = self._collapse(labels[limit:], self.last_label)
+        self.decoded_pos = self.end
+        # Seul le contexte gauche de la prochaine fenêtre est conservé.
+        keep = max(self.offset, self.committed_pos - self.left)
+        self.audio = self.audio[keep - self.offset:]
+        self.offset = keep
+
+    def _grid(self, n):
+        return n - n % self.hop if self.hop else n
+
+    def _collapse(self, labels, prev):
+        ids = []
+        for label in labels.tolist():
+            if label != prev and label != self.blank:
+                ids.append(label)
+            prev = label
+        return ids
+
+    def _text(self, ids):
+        # Ids déjà regroupés : un nouveau regroupement fusionnerait les lettres doublées.
+        try:
+            return self.tokenizer.decode(ids, group_tokens=False).strip()
+        except TypeError:
+            return self.tokenizer.decode(ids).strip()
+
+    def result(self):
+        return {
+            "transcription": self._text(self.committed_ids + self.partial_ids),
+            "committed": self._text(self.committed_ids),
+            "final": self.closed,
+            "audio_s": self.end / ASR_SAMPLE_RATE,
+            "decodes": self.decodes,
+            "decode_ms": 1000 * self.decode_s / max(1, self.decodes),
+        }
+
+class StreamSessions:
+    """Transcriptions en direct ouvertes, par identifiant ; les sessions abandonnées expirent."""
+
+    def __init__(self, ttl_s=STREAM_TTL_S, max_sessions=STREAM_MAX_SESSIONS):
+        self.ttl_s, self.max_sessions = ttl_s, max_sessions
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def open(self, factory):
+        with self._lock:
+            self._expire()
+            if len(self._sessions) >= self.max_sessions:
+                raise ServiceUnavailable("Trop de transcriptions en direct", 429, 1, reason="streams")
+            stream_id = os.urandom(8).hex()
+            self._sessions[stream_id] = factory()
+            return stream_id, self._sessions[stream_id]
+
+    def get(self, stream_id):
+        with self._lock:
+            self._expire()
+            return self._sessions.get(stream_id)
+
+    def close(self, stream_id):
+        with self._lock:
+            self._sessions.pop(stream_id, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+    def _expire(self):
+        now = time.monotonic()
+        for stream_id in [s for s, t in self._sessions.items() if now - t.last_used > self.ttl_s]:
+            del self._sessions[stream_id]
+
+# --- DEVICE, PRÉCISION ET QUANTIFICATION ---
+# "auto" : CUDA, sinon MPS, sinon CPU ; précision adaptée au device choisi.
+DEVICE = os.getenv("MEDGEMMA_DEVICE", "auto")          # auto | cuda | mps | cpu
+DTYPE = os.getenv("MEDGEMMA_DTYPE", "auto")            # auto | float16 | bfloat16 | float32
+QUANTIZATION = os.getenv("MEDGEMMA_QUANT", "none")     # none | int8 | 4bit
+COMPILE = os.getenv("MEDGEMMA_COMPILE") == "1"         # torch.compile du forward (long au 1er appel)
+CPU_THREADS = int(os.getenv("MEDGEMMA_CPU_THREADS", "0"))  # 0 = valeur par défaut de PyTorch
+
+@dataclass
+class InferenceConfig:
+    """Où et comment exécuter un modèle ; partagé par Gemma et MedASR."""
+    device: str = DEVICE
+    dtype: str = DTYPE
+    quantization: str = QUANTIZATION
+    compile: bool = COMPILE
+
+    def torch_device(self):
+        if self.device != "auto":
+            return self.device
+        if torch.cuda.is_available():
+            return "cuda"
+        if torch.backends.mps.is_available():
+            return "mps"
+        return "cpu"
+
+    def torch_dtype(self):
+        device = self.torch_device()
+        if device == "cpu" and self.quantization != "none":
+            return torch.float32  # la quantification dynamique part de poids float32
+        if self.dtype != "auto":
+            return getattr(torch, self.dtype)
+        if device == "cuda":
+            return torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+        if device == "mps":
+            return torch.float16
+        return torch.float32  # float16 n'est pas accéléré sur CPU
+
+    def load_kwargs(self):
+        """Arguments de `from_pretrained` : placement et quantification des poids au chargement."""
+        kwargs = {"torch_dtype": self.torch_dtype(), "low_cpu_mem_usage": True}
+        if self.torch_device() == "cuda":
+            kwargs["device_map"] = "auto"
+            if self.quantization in ("int8", "4bit"):
+                from transformers import BitsAndBytesConfig
+                kwargs["quantization_config"] = BitsAndBytesConfig(
+                    load_in_8bit=self.quantization == "int8",
+                    load_in_4bit=self.quantization == "4bit",
+                    bnb_4bit_quant_type="nf4",
+                    bnb_4bit_compute_dtype=kwargs["torch_dtype"],
+                )
+        return kwargs
+
+    def prepare(self, model):
+        """Placement hors CUDA, quantification CPU et compilation, après chargement."""
+        device = self.torch_device()
+        if device != "cuda":
+            model = model.to(device)
+        if self.quantization != "none" and device == "cpu":
+            # bitsandbytes cible le GPU : sur CPU, quantification dynamique int8 des
+            # nn.Linear (poids int8, activations quantifiées à la volée). "4bit" retombe sur int8.
+            if self.quantization == "4bit":
+                print("⚠️ 4 bits non disponible sur CPU : quantification int8 à la place.")
+            model = torch.ao.quantization.quantize_dynamic(
+                model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+            )
+        elif self.quantization != "none" and device != "cuda":
+            print(f"⚠️ Quantification {self.quantization} non supportée sur {device} : ignorée.")
+        if self.compile:
+            model.forward = torch.compile(model.forward, dynamic=True)
+        return model.eval()
+
+    def describe(self):
+        dtype = str(self.torch_dtype()).replace("torch.", "")
+        quant = "" if self.quantization == "none" else f"/{self.quantization}"
+        return f"{self.torch_device()}/{dtype}{quant}{'+compile' if self.compile else ''}"
+
+INFERENCE = InferenceConfig()
+
+# --- MODÈLES FACTICES (tests de charge locaux) ---
+STUB_STEP_DELAY_S = float(os.getenv("MEDGEMMA_STUB_STEP_MS", "10")) / 1000
+
+def _stub_delay(model, step_delay_s=None):
+    """Simule la durée d'une passe avant du vrai modèle."""
+    if step_delay_s is None:
+        step_delay_s = STUB_STEP_DELAY_S
+    if step_delay_s > 0:
+        model.register_forward_hook(lambda *_: time.sleep(step_delay_s))
+    return model
+
+def load_stub_llm(step_delay_s=None):
+    """Petit Gemma aléatoire (même architecture, quelques Mo) ; le texte produit n'a pas de sens."""
+    from tokenizers import Tokenizer, models, pre_tokenizers, decoders
+    from transformers import GemmaConfig, GemmaForCausalLM, PreTrainedTokenizerFast
+    # Tokenizer caractère par caractère (latin étendu, pour les accents).
+    vocab = {chr(i): len(range(32, i)) for i in range(32, 0x180)}
+    vocab["\n"] = len(vocab)
+    vocab["<eos>"] = len(vocab)
+    backend = Tokenizer(models.WordLevel(vocab=vocab, unk_token=" "))
+    backend.pre_tokenizer = pre_tokenizers.Split("", "isolated")
+    backend.decoder = decoders.Fuse()
+    stub_tokenizer = PreTrainedTokenizerFast(tokenizer_object=backend, eos_token="<eos>")
+    stub_llm = GemmaForCausalLM(GemmaConfig(
+        vocab_size=len(vocab), hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+        num_attention_heads=2, num_key_value_heads=1, head_dim=32, max_position_embeddings=4096,
+        eos_token_id=vocab["<eos>"], bos_token_id=vocab["<eos>"], pad_token_id=vocab["<eos>"],
+    )).eval()
+    return stub_tokenizer, _stub_delay(stub_llm, step_delay_s)
+
+def load_stub_asr(step_delay_s=None):
+    """Petit Wav2Vec2 CTC aléatoire (CPU) avec la même API que MedASR."""
+    import tempfile
+    from transformers import (
+        Wav2Vec2Config, Wav2Vec2ForCTC, Wav2Vec2CTCTokenizer, Wav2Vec2FeatureExtractor, Wav2Vec2Processor,
     )
-    print("✅ Modèles chargés !")
-except Exception as e:
-    print(f"⚠️ Erreur MedASR : {e}")
+    vocab_dir = tempfile.mkdtemp(prefix="medgemma-stub-")
+    asr_vocab = {"<pad>": 0, "|": 1, **{c: i + 2 for i, c in enumerate("abcdefghijklmnopqrstuvwxyz")}}
+    with open(os.path.join(vocab_dir, "vocab.json"), "w") as f:
+        json.dump(asr_vocab, f)
+    stub_asr_processor = Wav2Vec2Processor(
+        feature_extractor=Wav2Vec2FeatureExtractor(
+            feature_size=1, sampling_rate=ASR_SAMPLE_RATE, return_attention_mask=True
+        ),
+        tokenizer=Wav2Vec2CTCTokenizer(
+            os.path.join(vocab_dir, "vocab.json"), pad_token="<pad>", word_delimiter_token="|"
+        ),
+    )
+    stub_asr = Wav2Vec2ForCTC(Wav2Vec2Config(
+        vocab_size=len(asr_vocab), hidden_size=32, num_hidden_layers=1, num_attention_heads=2,
+        intermediate_size=64, conv_dim=(16, 16), conv_stride=(5, 4), conv_kernel=(10, 4),
+        num_conv_pos_embeddings=16, num_conv_pos_embedding_groups=2,
+        feat_extract_norm="layer", do_stable_layer_norm=True,
+    )).eval()
+    return stub_asr_processor, _stub_delay(stub_asr, step_delay_s)
+
+# --- DÉMARRAGE RAPIDE (snapshots locaux, MedASR différé, warmup) ---
+# Snapshots des modèles : téléchargés une fois, puis rechargés sans accès au Hub.
+# Sur Kaggle, pointer ce dossier vers /kaggle/working (ou un dataset) pour le garder.
+MODEL_DIR = os.getenv("MEDGEMMA_MODEL_DIR", os.path.expanduser("~/.cache/medgemma/models"))
+SNAPSHOT_IGNORE = ["*.gguf", "*.onnx", "*.h5", "*.msgpack", "*.ot", "*.pth", "original/*"]
+# eager : avant de servir ; background : dans un thread au démarrage ; lazy : au 1er /transcribe.
+ASR_LOAD_MODE = os.getenv("MEDGEMMA_ASR_LOAD", "background")
+# Tokens générés au warmup (0 = pas de warmup) ; le warmup ASR transcrit 1 s de silence.
+WARMUP_TOKENS = int(os.getenv("MEDGEMMA_WARMUP_TOKENS", "8"))
+
+def local_snapshot(model_id):
+    """Dossier local du modèle (configs + safetensors), téléchargé au premier lancement seulement."""
+    local_dir = os.path.join(MODEL_DIR, model_id.replace("/", "--"))
+    marker = os.path.join(local_dir, ".complete")
+    if os.path.exists(marker):
+        return local_dir
+    ignore = list(SNAPSHOT_IGNORE)
+    if any(f.endswith(".safetensors") for f in list_repo_files(model_id, token=HF_TOKEN or None)):
+        ignore.append("*.bin")  # poids en double au format pickle
+    snapshot_download(model_id, local_dir=local_dir, ignore_patterns=ignore, token=HF_TOKEN or None)
+    open(marker, "w").close()
+    return local_dir
+
+class ModelSlot:
+    """Modèle chargé une seule fois, à la demande ou en tâche de fond, avec son état pour /ready."""
+
+    def __init__(self, name, loader, priority=0):
+        self.name = name
+        self.loader = loader
+        self.priority = priority  # résidence : les modèles prioritaires sont déchargés en dernier
+        self.residency = None     # ResidencyManager qui suit ce modèle (budget mémoire du device)
+        self.state = "pending"  # pending | loading | ready | failed
+        self.value = None
+        self.error = None
+        self.load_s = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Renvoie le modèle, en le chargeant si besoin (les appels concurrents attendent le même chargement)."""
+        if self.state != "ready":
+            with self._lock:
+                if self.state == "pending":
+                    self._load()
+        if self.state == "failed":
+            raise RuntimeError(f"{self.name} indisponible : {self.error}")
+        return self.value
+
+    def _load(self):
+        self.state = "loading"
+        start = time.perf_counter()
+        try:
+            self.value = self.loader()
+            self.state = "ready"
+        except Exception as e:
+            self.error = str(e)
+            self.state = "failed"
+        self.load_s = round(time.perf_counter() - start, 3)
+        STARTUP_TIMINGS[f"{self.name}_load_s"] = self.load_s
+        if self.state == "ready":
+            print(f"✅ {self.name} chargé en {self.load_s:.1f} s")
+            if self.residency is not None:
+                self.residency.track(self)
+        else:
+            print(f"⚠️ Erreur {self.name} : {self.error}")
+
+    def load_in_background(self):
+        def run():
+            try:
+                self.get()
+            except RuntimeError:
+                pass  # état `failed` visible sur /ready
+        threading.Thread(target=run, name=f"load-{self.name}", daemon=True).start()
+
+    def summary(self):
+        return {"state": self.state, "load_s": self.load_s, "error": self.error}
+
+# --- RÉSIDENCE DES MODÈLES (budget mémoire du device) ---
+# Gemma et MedASR partagent le device. Sous un budget, un modèle inactif est déchargé
+# (vers la RAM, ou vers un fichier relu en mmap) pour laisser la place à l'autre, puis
+# rechargé à la demande. Sans budget ni délai d'inactivité, tout reste résident.
+RESIDENCY_BUDGET_MB = float(os.getenv("MEDGEMMA_DEVICE_BUDGET_MB", "0"))  # 0 = pas de limite
+OFFLOAD_IDLE_S = float(os.getenv("MEDGEMMA_OFFLOAD_IDLE_S", "0"))         # 0 = jamais par inactivité
+OFFLOAD_TARGET = os.getenv("MEDGEMMA_OFFLOAD_TARGET", "cpu")              # cpu | disk
+OFFLOAD_DIR = os.getenv("MEDGEMMA_OFFLOAD_DIR", os.path.expanduser("~/.cache/medgemma/offload"))
+RESIDENCY_WAIT_S = float(os.getenv("MEDGEMMA_RESIDENCY_WAIT_S", "30"))
+
+def module_nbytes(model):
+    """Octets des poids et buffers d'un module (stockages partagés comptés une fois)."""
+    storages = {}
+    for tensor in [*model.parameters(), *model.buffers()]:
+        storage = tensor.untyped_storage()
+        storages[(tensor.device, storage.data_ptr())] = storage.nbytes()
+    return sum(storages.values())
+
+def slot_module(value):
+    """Le `nn.Module` d'une valeur de slot `(tokenizer | processor, modèle)`."""
+    return next(v for v in value if isinstance(v, torch.nn.Module))
+
+def offload_blocker(model):
+    """Raison pour laquelle le modèle ne peut pas quitter son device, ou None."""
+    if getattr(model, "is_quantized", False):
+        return "poids bitsandbytes non déplaçables"
+    if len(set(getattr(model, "hf_device_map", {}).values())) > 1:
+        return "modèle réparti sur plusieurs devices"
+    if any(isinstance(m, torch.ao.nn.quantized.dynamic.Linear) for m in model.modules()):
+        return "quantification dynamique CPU"
+    return None
+
+def remove_file(path):
+    with contextlib.suppress(OSError):
+        os.remove(path)
+
+@dataclass
+class Residence:
+    """Suivi d'un modèle par le `ResidencyManager`."""
+    slot: "ModelSlot"
+    model: torch.nn.Module
+    device: torch.device
+    nbytes: int
+    pinned: str = None     # raison si le modèle ne peut pas être déchargé
+    state: str = "device"  # device | moving | offloaded
+    users: int = 0
+    last_used: float = field(default_factory=time.monotonic)
+    swaps_in: int = 0
+    swaps_out: int = 0
+    swap_in_s: deque = field(default_factory=lambda: deque(maxlen=50))
+    offload_path: str = None  # cible "disk" : poids écrits au premier déchargement
+
+class ResidencyManager:
+    """Garde les modèles sur le device dans la limite d'un budget mémoire.
+
+    `with residency.use(slot) as (tokenizer, model):` garantit que le modèle est sur le
+    device pendant le bloc, en le rechargeant s'il avait été déchargé. Pour faire de la
+    place, les modèles inactifs sont déchargés, les moins prioritaires puis les moins
+    récemment utilisés d'abord. Si les autres modèles sont occupés, l'appel attend (au plus
+    `wait_s`, sinon 503) ; entre plusieurs appels en attente, le modèle le plus prioritaire
+    passe d'abord. Avec `idle_s`, un thread décharge aussi les modèles inactifs.
+
+    Les modèles sont déplacés en place : les références gardées ailleurs (scheduler,
+    sessions de dictée) restent valides.
+    """
+
+    def __init__(self, slots=(), budget_bytes=RESIDENCY_BUDGET_MB * 2**20, idle_s=OFFLOAD_IDLE_S,
+                 target=OFFLOAD_TARGET, offload_dir=OFFLOAD_DIR, wait_s=RESIDENCY_WAIT_S):
+        self.budget_bytes = budget_bytes
+        self.idle_s = idle_s
+        self.target = target
+        self.offload_dir = offload_dir
+        self.wait_s = wait_s
+        self._residences = {}  # nom du slot -> Residence
+        self._waiting = []     # priorités des appels en attente de place
+        self._cond = threading.Condition()
+        for slot in slots:
+            slot.residency = self
+            if slot.state == "ready":
+                self.track(slot)
+        if idle_s > 0:
+            threading.Thread(target=self._reap_loop, name="residency", daemon=True).start()
+
+    def track(self, slot):
+        """Prend en compte un modèle qui vient d'être chargé sur son device, puis applique le budget."""
+        model = slot_module(slot.value)
+        res = Residence(slot, model, next(model.parameters()).device, module_nbytes(model), offload_blocker(model))
+        if res.pinned and (self.budget_bytes or self.idle_s):
+            print(f"⚠️ {slot.name} restera résident : {res.pinned}")
+        with self._cond:
+            self._residences[slot.name] = res
+            victims = self._victims(0) or []
+            self._begin_moves(victims)
+        self._offload_all(victims)
+
+    @contextlib.contextmanager
+    def use(self, slot):
+        value = slot.get()
+        if slot.name not in self._residences:
+            self.track(slot)
+        res = self._acquire(slot)
+        try:
+            yield value
+        finally:
+            with self._cond:
+                res.users -= 1
+                res.last_used = time.monotonic()
+                self._cond.notify_all()
+
+    def _acquire(self, slot):
+        with self._cond:
+            res = self._residences[slot.name]
+            if res.state == "device":
+                res.users += 1
+                return res
+            start = time.perf_counter()
+            deadline = time.monotonic() + self.wait_s
+            self._waiting.append(slot.priority)
+            try:
+                while True:
+                    if res.state == "device":  # rechargé par un autre appel pendant l'attente
+                        res.users += 1
+                        return res
+                    victims = None
+                    if res.state == "offloaded" and slot.priority >= max(self._waiting):
+                        victims = self._victims(res.nbytes, exclude=res)
+                    if victims is not None:
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise ServiceUnavailable(f"{slot.name} : mémoire du device occupée", 503, 1.0,
+                                                 reason="residency")
+                    self._cond.wait(remaining)
+            finally:
+                self._waiting.remove(slot.priority)
+            self._begin_moves([*victims, res])
+            res.users += 1
+        try:
+            self._offload_all(victims)
+            self._reload(res)
+        except BaseException:
+            with self._cond:
+                res.users -= 1
+                res.state = "offloaded"
+                self._cond.notify_all()
+            raise
+        with self._cond:
+            res.state = "device"
+            self._cond.notify_all()
+        record_stage("swap_in", start, time.perf_counter(), model=slot.name)
+        return res
+
+    def _resident_total(self):
+        return sum(r.nbytes for r in self._residences.values() if r.state != "offloaded")
+
+    def _victims(self, need, exclude=None):
+        """Modèles inactifs à décharger pour que `need` octets de plus tiennent dans le budget
+        (None : pas assez de modèles inactifs pour l'instant)."""
+        if not self.budget_bytes:
+            return []
+        excess = self._resident_total() + need - self.budget_bytes
+        victims = []
+        idle = [r for r in self._residences.values()
+                if r.state == "device" and not r.users and not r.pinned and r is not exclude]
+        for res in sorted(idle, key=lambda r: (r.slot.priority, r.last_used)):
+            if excess <= 0:
+                break
+            victims.append(res)
+            excess -= res.nbytes
+        return victims if excess <= 0 else None
+
+    @staticmethod
+    def _begin_moves(residences):
+        for res in residences:
+            res.state = "moving"
+
+    def _offload_all(self, residences):
+        for res in residences:
+            try:
+                self._offload(res)
+                state = "offloaded"
+            except Exception as e:
+                print(f"⚠️ Déchargement de {res.slot.name} impossible : {e}")
+                res.pinned, state = str(e), "device"
+            with self._cond:
+                res.state = state
+                self._cond.notify_all()
+
+    def _offload(self, res):
+        start = time.perf_counter()
+        # Hors inference_mode : les poids rechargés ne doivent pas devenir des "inference tensors".
+        with torch.inference_mode(False), torch.no_grad():
+            if self.target == "disk":
+                if res.offload_path is None:
+                    os.makedirs(self.offload_dir, exist_ok=True)
+                    path = os.path.join(self.offload_dir, f"{res.slot.name}-{os.getpid()}.pt")
+                    torch.save({n: p.detach().cpu() for n, p in res.model.named_parameters()}, path)
+                    atexit.register(remove_file, path)
+                    res.offload_path = path
+                for param in res.model.parameters():
+                    param.data = torch.empty(0, dtype=param.dtype)
+            res.model.to("cpu")  # cible "disk" : ne reste que les buffers (petits)
+        if res.device.type == "cuda":
+            torch.cuda.empty_cache()
+        res.swaps_out += 1
+        MODEL_SWAP_SECONDS.observe(time.perf_counter() - start, model=res.slot.name, direction="out")
+
+    def _reload(self, res):
+        start = time.perf_counter()
+        with torch.inference_mode(False), torch.no_grad():
+            if self.target == "disk":
+                # mmap : les pages sont lues à la copie vers le device (ou à la demande sur CPU).
+                weights = torch.load(res.offload_path, mmap=True, weights_only=True)
+                for name, param in res.model.named_parameters():
+                    param.data = weights[name].to(res.device)
+            res.model.to(res.device)
+        elapsed = time.perf_counter() - start
+        res.swaps_in += 1
+        res.swap_in_s.append(elapsed)
+        MODEL_SWAP_SECONDS.observe(elapsed, model=res.slot.name, direction="in")
+        print(f"🔁 {res.slot.name} rechargé sur {res.device} en {elapsed * 1000:.0f} ms")
+
+    def _reap_loop(self):
+        while True:
+            time.sleep(min(max(self.idle_s / 4, 0.05), 5.0))
+            now = time.monotonic()
+            with self._cond:
+                idle = [r for r in self._residences.values()
+                        if r.state == "device" and not r.users and not r.pinned and now - r.last_used >= self.idle_s]
+                self._begin_moves(idle)
+            self._offload_all(idle)
+
+    def resident_bytes(self):
+        with self._cond:
+            return {(name,): res.nbytes if res.state == "device" else 0 for name, res in self._residences.items()}
+
+    def summary(self):
+        now = time.monotonic()
+        with self._cond:
+            models = {}
+            for name, res in self._residences.items():
+                swaps = sorted(res.swap_in_s)
+                models[name] = {
+                    "state": res.state, "priority": res.slot.priority, "device": str(res.device),
+                    "mb": round(res.nbytes / 2**20, 1), "users": res.users, "idle_s": round(now - res.last_used, 1),
+                    "pinned": res.pinned, "swaps_in": res.swaps_in, "swaps_out": res.swaps_out,
+                    "swap_in_p50_s": round(swaps[len(swaps) // 2], 3) if swaps else None,
+                    "swap_in_max_s": round(swaps[-1], 3) if swaps else None,
+                }
+            return {
+                "budget_mb": round(self.budget_bytes / 2**20, 1) if self.budget_bytes else None,
+                "resident_mb": round(self._resident_total() / 2**20, 1),
+                "target": self.target, "idle_s": self.idle_s or None, "models": models,
+            }
+
+def load_llm(config=INFERENCE, stub=STUB_MODELS):
+    if stub:
+        llm_tokenizer, model = load_stub_llm()
+        return llm_tokenizer, config.prepare(model.to(config.torch_dtype()))
+    path = local_snapshot(LLM_MODEL_ID)
+    llm_tokenizer = AutoTokenizer.from_pretrained(path)
+    # Les safetensors sont mappés en mémoire : les poids vont du cache disque au device
+    # sans copie intermédiaire complète en RAM.
+    model = AutoModelForCausalLM.from_pretrained(path, **config.load_kwargs())
+    return llm_tokenizer, config.prepare(model)
+
+def load_asr(config=INFERENCE, stub=STUB_MODELS):
+    if stub:
+        processor, model = load_stub_asr()
+        model = config.prepare(model.to(config.torch_dtype()))
+    else:
+        path = local_snapshot(ASR_MODEL_ID)
+        processor = AutoProcessor.from_pretrained(path)
+        model = config.prepare(AutoModelForCTC.from_pretrained(path, **config.load_kwargs()))
+    if WARMUP_TOKENS > 0:
+        transcribe_chunks([np.zeros(ASR_SAMPLE_RATE, dtype=np.float32)], processor, model)
+    return processor, model
+
+def warmup(scheduler, max_new_tokens=WARMUP_TOKENS):
+    """Première génération courte : noyaux, allocateur et cache du préfixe système prêts avant le trafic."""
+    if max_new_tokens <= 0:
+        return
+    start = time.perf_counter()
+    system_instruction = "Tu es un assistant médical. Réponds brièvement."
+    scheduler.submit(
+        build_prompt(system_instruction, "Bonjour"), max_new_tokens=max_new_tokens,
+        prefix=build_prompt_prefix(system_instruction),
+    ).result(timeout=GENERATE_TIMEOUT_S)
+    STARTUP_TIMINGS["warmup_s"] = round(time.perf_counter() - start, 3)
+
+llm_slot = ModelSlot("gemma", load_llm, priority=1)
+asr_slot = ModelSlot("medasr", load_asr, priority=0)
+residency = ResidencyManager([llm_slot, asr_slot])
+
+if __name__ == "__main__":
+    # --- AUTHENTIFICATION ---
+    if HF_TOKEN and not STUB_MODELS:
+        login(token=HF_TOKEN)
+
+    if CPU_THREADS:
+        torch.set_num_threads(CPU_THREADS)
+    print("🔄 Chargement Gemma..." if not STUB_MODELS else "🧪 Modèles factices (MEDGEMMA_STUB_MODELS=1)")
+    print(f"⚙️ Exécution : {INFERENCE.describe()}")
+    if ASR_LOAD_MODE == "background":
+        asr_slot.load_in_background()  # en parallèle de Gemma (téléchargement, lecture disque)
+    tokenizer, llm_model = llm_slot.get()
+    scheduler = BatchScheduler(llm_model, tokenizer, kv_cache=KVCacheStore(), slot=llm_slot)
+    warmup(scheduler)
+    if ASR_LOAD_MODE == "eager":
+        print("🔄 Chargement MedASR...")
+        try:
+            asr_slot.get()
+        except RuntimeError:
+            pass
+    STARTUP_TIMINGS["ready_s"] = round(time.perf_counter() - PROCESS_START, 3)
+    print(f"✅ Prêt en {STARTUP_TIMINGS['ready_s']:.1f} s depuis le lancement (MedASR : {asr_slot.state})")
 
 # --- API FLASK ---
 app = Flask(__name__)
 CORS(app)
+admission = AdmissionController()
+asr_streams = StreamSessions()
+
+def admitted(endpoint):
+    """Passe la requête par le contrôle d'admission ; le créneau est rendu à la fermeture
+    de la réponse (donc en fin de flux pour le streaming)."""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            g.deadline = request_deadline(request.headers)
+            admitted_at = admission.acquire(endpoint, g.deadline)
+            try:
+                response = app.make_response(view(*args, **kwargs))
+            except BaseException:
+                admission.release(endpoint, admitted_at)
+                raise
+            response.call_on_close(lambda: admission.release(endpoint, admitted_at))
+            return response
+        return wrapper
+    return decorator
+
+def wait_result(future):
+    """Résultat du scheduler dans l'échéance de la requête, sinon 503 (et annulation si encore en file)."""
+    try:
+        return future.result(timeout=max(0.0, g.deadline - time.monotonic()))
+    except FutureTimeoutError:
+        future.cancel()
+        raise ServiceUnavailable("Échéance dépassée", 503, scheduler.batch_s, reason="deadline")
+
+@app.errorhandler(ServiceUnavailable)
+def service_unavailable(e):
+    REJECTED.inc(endpoint=request.endpoint, reason=e.reason)
+    response = jsonify({"error": str(e), "retry_after": e.retry_after})
+    response.status_code = e.status
+    response.headers["Retry-After"] = str(e.retry_after)
+    return response
+
+@app.before_request
+def track_request_start():
+    g.inflight_endpoint = request.endpoint
+    INFLIGHT.inc(endpoint=request.endpoint)
+    g.trace = start_trace(request.headers, f"{request.method} {request.path}")
+    _active_traces.traces = [g.trace] if g.trace is not None else []
+
+@app.after_request
+def track_request_status(response):
+    REQUESTS.inc(endpoint=request.endpoint)
+    if response.status_code >= 500:
+        ERRORS.inc(endpoint=request.endpoint)
+    trace = g.get("trace")
+    if trace is not None:
+        # Spans renvoyés au client (waterfall côté app) dans les réponses JSON.
+        trace.status_code = response.status_code
+        if response.is_json and not response.is_streamed:
+            payload = response.get_json(silent=True)
+            if isinstance(payload, dict):
+                payload["trace"] = trace.export_spans()
+                response.set_data(json.dumps(payload, ensure_ascii=False))
+    return response
+
+@app.teardown_request
+def track_request_end(exc):
+    # Avec `stream_with_context`, le teardown peut être rejoué en fin de flux.
+    endpoint = g.pop("inflight_endpoint", None)
+    if endpoint is not None:
+        INFLIGHT.dec(endpoint=endpoint)
+    trace = g.pop("trace", None)
+    if trace is not None:
+        trace_exporter.export(trace.export_spans())
+    _active_traces.traces = []
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    lines = [line for metric in METRICS for line in metric.render()]
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+def sse_event(payload):
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+def stream_generation(streamer, future, deadline, trace=None):
+    """Server-sent events : un évènement par fragment de texte, l'usage en tokens (et les spans
+    si la requête est tracée), puis `[DONE]`."""
+    try:
+        for text in streamer:
+            if text:
+                yield sse_event({"token": text})
+        result = future.result(timeout=max(0.0, deadline - time.monotonic()))
+        event = {"usage": result.usage()}
+        if trace is not None:
+            trace.status_code = 200
+            event["trace"] = trace.export_spans()
+            trace_exporter.export(event["trace"])
+        yield sse_event(event)
+    except Exception as e:
+        yield sse_event({"error": str(e)})
+    yield "data: [DONE]\n\n"
 
 @app.route('/generate', methods=['POST'])
+@admitted("generate")
 def generate():
     try:
         data = request.json
-        full_prompt = f"<start_of_turn>user\n{data.get('system_instruction', '')}\n\n{data.get('prompt', '')}<end_of_turn>\n<start_of_turn>model\n"
-        inputs = tokenizer(full_prompt, return_tensors="pt").to("cuda")
-        outputs = llm_model.generate(**inputs, max_new_tokens=600, temperature=0.4, do_sample=True)
-        response = tokenizer.decode(outputs[0], skip_special_tokens=True).split("model\n")[-1].strip()
-        return jsonify({"response": response})
+        system_instruction = data.get('system_instruction', '')
+        history = data.get('history') or []
+        full_prompt = build_prompt(system_instruction, data.get('prompt', ''), history)
+        try:
+            profile = resolve_profile(data.get('generation'))
+        except (TypeError, ValueError) as e:
+            return jsonify({"error": str(e)}), 400
+        kwargs = {
+            "max_new_tokens": profile.max_new_tokens,
+            "temperature": profile.temperature,
+            "profile": profile,
+            "prefix": build_prompt_prefix(system_instruction, history),
+            "session_id": data.get('session_id'),
+            "deadline": g.deadline,
+            "trace": g.trace,
+        }
+        if data.get('stream'):
+            # Mise en file avant la réponse : une file pleine donne un vrai 503, pas un flux vide.
+            streamer, future = scheduler.submit_stream(full_prompt, **kwargs)
+            # La trace couvre tout le flux : exportée en fin de flux, pas au teardown.
+            trace = g.pop("trace", None)
+            return Response(
+                stream_with_context(stream_generation(streamer, future, g.deadline, trace)),
+                mimetype="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+            )
+        result = wait_result(scheduler.submit(full_prompt, **kwargs))
+        return jsonify({"response": result.text, "usage": result.usage()})
+    except ServiceUnavailable:
+        raise
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/prefill', methods=['POST'])
+@admitted("generate")
+def prefill():
+    """Pré-remplit le cache KV de la session avec le contexte du prochain tour, sans générer.
+
+    L'app l'appelle pendant que le patient rédige ses réponses : le rapport final ne
+    traitera plus que ces réponses.
+    """
+    try:
+        data = request.json or {}
+        session_id = data.get('session_id')
+        if not session_id or scheduler.kv_cache is None:
+            return jsonify({"prefilled": False})
+        system_instruction = data.get('system_instruction', '')
+        history = data.get('history') or []
+        # Un seul token généré : la session garde en cache exactement le contexte.
+        result = wait_result(scheduler.submit(
+            build_prompt_context(system_instruction, history), max_new_tokens=1,
+            prefix=build_prompt_prefix(system_instruction, history),
+            session_id=session_id, deadline=g.deadline, trace=g.trace,
+        ))
+        return jsonify({"prefilled": True, "input_tokens": result.input_tokens})
+    except ServiceUnavailable:
+        raise
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/batching', methods=['GET', 'POST'])
+def batching():
+    """Lit (GET) ou ajuste à chaud (POST) la fenêtre et la taille max de batch."""
+    if request.method == 'POST':
+        data = request.json or {}
+        if 'window_ms' in data:
+            scheduler.window_ms = float(data['window_ms'])
+        if 'max_batch_size' in data:
+            scheduler.max_batch_size = max(1, int(data['max_batch_size']))
+    return jsonify({**scheduler.config(), **scheduler.stats})
+
+@app.route('/admission', methods=['GET'])
+def admission_stats():
+    """Créneaux occupés / en attente par endpoint et compteurs de refus."""
+    return jsonify(admission.summary())
+
+@app.route('/kv_cache', methods=['GET'])
+def kv_cache_stats():
+    """Occupation et efficacité du cache KV (tokens pré-remplis vs réutilisés)."""
+    if scheduler.kv_cache is None:
+        return jsonify({"enabled": False})
+    return jsonify({"enabled": True, **scheduler.kv_cache.summary()})
+
 @app.route('/transcribe', methods=['POST'])
+@admitted("transcribe")
 def transcribe():
     try:
         if 'audio' not in request.files: return jsonify({"error": "No audio"}), 400
         audio_file = request.files['audio']
-        speech, _ = librosa.load(io.BytesIO(audio_file.read()), sr=16000)
-        inputs = asr_processor(speech, sampling_rate=16000, return_tensors="pt")
-        input_values = inputs.input_values.to("cuda").to(torch.float16)
-        with torch.no_grad(): logits = asr_model(input_values).logits
-        predicted_ids = torch.argmax(logits, dim=-1)
-        transcription = asr_processor.batch_decode(predicted_ids)[0]
+        speech = load_audio(audio_file.read())
+        with residency.use(asr_slot) as (asr_processor, asr_model):  # chargement paresseux au 1er appel
+            transcription = transcribe_waveforms([speech], asr_processor, asr_model)[0]
         return jsonify({"transcription": transcription})
+    except ServiceUnavailable:
+        raise
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/transcribe_stream', methods=['POST'])
+@admitted("transcribe_stream")
+def transcribe_stream():
+    """Transcription en direct : corps = morceau PCM (en-tête MGPC), éventuellement vide.
+
+    Sans `stream_id` : ouvre une session (identifiant renvoyé) ; `offset` : position du
+    morceau en échantillons (renvoi idempotent) ; `final=1` : vide la fenêtre, renvoie la
+    transcription définitive et ferme la session.
+    """
+    try:
+        stream_id = request.args.get("stream_id")
+        final = request.args.get("final") == "1"
+        body = request.get_data()
+        speech = load_audio(body) if body else np.zeros(0, dtype=np.float32)
+        with residency.use(asr_slot) as (asr_processor, asr_model):
+            if stream_id:
+                transcriber = asr_streams.get(stream_id)
+                if transcriber is None:
+                    return jsonify({"error": "Session de transcription inconnue ou expirée"}), 404
+            else:
+                stream_id, transcriber = asr_streams.open(lambda: StreamingTranscriber(asr_processor, asr_model))
+            result = transcriber.feed(speech, final=final, offset=request.args.get("offset", type=int))
+        if final:
+            asr_streams.close(stream_id)
+        return jsonify({"stream_id": stream_id, **result})
+    except ServiceUnavailable:
+        raise
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/transcribe_batch', methods=['POST'])
+@admitted("transcribe_batch")
+def transcribe_batch():
+    """Plusieurs fichiers `audio` dans une même requête : segments traités en batch commun."""
+    try:
+        files = request.files.getlist('audio')
+        if not files: return jsonify({"error": "No audio"}), 400
+        waveforms = [load_audio(f.read()) for f in files]
+        with residency.use(asr_slot) as (asr_processor, asr_model):
+            texts = transcribe_waveforms(waveforms, asr_processor, asr_model)
+        return jsonify({"transcriptions": [
+            {"filename": f.filename, "transcription": text} for f, text in zip(files, texts)
+        ]})
+    except ServiceUnavailable:
+        raise
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/residency', methods=['GET'])
+def residency_stats():
+    """Modèles résidents / déchargés, budget et latences de rechargement."""
+    return jsonify(residency.summary())
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    """Sonde de disponibilité : 200 quand Gemma est chargé et chauffé (MedASR peut charger après)."""
+    is_ready = llm_slot.state == "ready" and "ready_s" in STARTUP_TIMINGS and not admission.draining
+    return jsonify({
+        "ready": is_ready,
+        "models": {slot.name: slot.summary() for slot in (llm_slot, asr_slot)},
+        "startup": STARTUP_TIMINGS,
+        "inference": INFERENCE.describe(),
+    }), 200 if is_ready else 503
+
 @app.route('/')
 def home(): return "MedGemma API Ready"
 
-# --- LANCEMENT NGROK ---
-ngrok.set_auth_token(NGROK_AUTH_TOKEN)
-ngrok.kill()
-try:
-    public_url = ngrok.connect(5000).public_url
-    print(f"\n🚀🚀🚀 URL API : {public_url} 🚀🚀🚀\n")
-except Exception as e:
-    print(f"Erreur Ngrok : {e}")
+# --- SERVEUR DE PRODUCTION ---
+# "production" : waitress (WSGI multi-thread) + arrêt progressif ; "dev" : serveur Flask.
+SERVE_MODE = os.getenv("MEDGEMMA_SERVE_MODE", "production")
+SERVER_HOST = os.getenv("MEDGEMMA_HOST", "127.0.0.1")
+SERVER_PORT = int(os.getenv("MEDGEMMA_PORT", "5000"))
+# Doit couvrir les limites par endpoint + les requêtes en attente, sinon waitress
+# met les connexions en file avant même le contrôle d'admission.
+SERVER_THREADS = int(os.getenv("MEDGEMMA_SERVER_THREADS", "48"))
+
+def serve(app, host=SERVER_HOST, port=SERVER_PORT):
+    """Sert l'API jusqu'à SIGTERM / SIGINT, puis draine les requêtes en cours avant de s'arrêter."""
+    if SERVE_MODE == "dev":
+        app.run(host=host, port=port, threaded=True)
+        return
+    from waitress.server import create_server
+    server = create_server(app, host=host, port=port, threads=SERVER_THREADS, ident="medgemma")
+    thread = threading.Thread(target=server.run, name="waitress", daemon=True)
+    thread.start()
+    stop = threading.Event()
+    previous = {}
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            previous[sig] = signal.signal(sig, lambda *_: stop.set())
+        except ValueError:  # hors du thread principal : pas de gestion de signaux
+            pass
+    print(f"✅ Serveur prêt sur http://{host}:{port} ({SERVER_THREADS} threads)")
+    try:
+        while thread.is_alive() and not stop.wait(0.5):
+            pass
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for sig, handler in previous.items():
+            signal.signal(sig, handler)
+    print("🛑 Arrêt : drain des requêtes en cours...")
+    drained = admission.drain(DRAIN_TIMEOUT_S)
+    scheduler.stop()
+    server.close()
+    print("✅ Arrêt propre." if drained else "⚠️ Des requêtes étaient encore en cours à la fin du drain.")
+
+if __name__ == "__main__" and not STUB_MODELS:
+    # --- LANCEMENT NGROK ---
+    ngrok.set_auth_token(NGROK_AUTH_TOKEN)
+    ngrok.kill()
+    try:
+        public_url = ngrok.connect(SERVER_PORT).public_url
+        print(f"\n🚀🚀🚀 URL API : {public_url} 🚀🚀🚀\n")
+    except Exception as e:
+        print(f"Erreur Ngrok : {e}")
 
-app.run(port=5000)
+if __name__ == "__main__":
+    serve(app)
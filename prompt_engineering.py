@@ -1,6 +1,21 @@
+"""Banc d'essai des prompts système : contenu ET coût (latence, débit).
+
+Chaque couple SYSTEM_PROMPTS × TEST_CASES est envoyé en parallèle (concurrence réglable)
+à un backend : Ollama, le serveur Flask Kaggle (/generate en SSE) ou le serveur factice
+local (`stub_server.py`, hors ligne). Par requête on mesure le temps jusqu'au premier
+token (TTFT), la latence totale, le nombre de tokens générés et le débit ; par variante
+de prompt on rapporte p50/p95/p99, et l'ensemble peut être exporté en JSON / CSV.
+
+    python prompt_engineering.py --backend stub --concurrency 8 --repeat 5 --json out.json
+    python prompt_engineering.py --backend flask --url https://xxxx.ngrok-free.app --csv out.csv
+"""
 import requests
 import json
 import sys
+import argparse
+import csv
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 # Configuration
 OLLAMA_URL = "http://localhost:11434/api/generate"
@@ -48,7 +63,166 @@ def query_ollama(prompt, system_prompt):
     except requests.exceptions.RequestException as e:
         return f"Error querying Ollama: {e}"
 
+# --- BACKENDS EN STREAMING ---
+# Chaque backend produit des évènements `("token", texte)` puis éventuellement
+# `("usage", nb_tokens_générés)` ; le chronométrage est fait par `run_case`.
+
+def stream_ollama(session, url, prompt, system_prompt):
+    payload = {
+        "model": MODEL_NAME,
+        "prompt": f"{system_prompt}\n\nUser: {prompt}\nAssistant:",
+        "stream": True
+    }
+    with session.post(url, json=payload, stream=True, timeout=120) as response:
+        response.raise_for_status()
+        for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+            if not line:
+                continue
+            event = json.loads(line)
+            if event.get("response"):
+                yield "token", event["response"]
+            if event.get("done"):
+                if "eval_count" in event:
+                    yield "usage", event["eval_count"]
+                return
+
+def stream_flask(session, url, prompt, system_prompt):
+    payload = {"prompt": prompt, "system_instruction": system_prompt, "stream": True}
+    with session.post(f"{url.rstrip('/')}/generate", json=payload, stream=True, timeout=120) as response:
+        response.raise_for_status()
+        for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+            if not line or not line.startswith("data: "):
+                continue
+            data = line[len("data: "):]
+            if data == "[DONE]":
+                return
+            event = json.loads(data)
+            if "error" in event:
+                raise RuntimeError(event["error"])
+            if event.get("token"):
+                yield "token", event["token"]
+            if "usage" in event:
+                yield "usage", event["usage"]["output_tokens"]
+
+BACKENDS = {"ollama": stream_ollama, "flask": stream_flask, "stub": stream_flask}
+
+def run_case(stream_fn, session, url, variant, system_prompt, case, keep_text=False):
+    """Exécute un cas et renvoie un enregistrement de mesures (jamais d'exception)."""
+    record = {"variant": variant, "case": case, "ttft_s": None, "latency_s": None,
+              "output_tokens": 0, "tokens_per_s": None, "error": None}
+    chunks = []
+    usage_tokens = None
+    start = time.perf_counter()
+    try:
+        for kind, value in stream_fn(session, url, case, system_prompt):
+            if kind == "token":
+                if record["ttft_s"] is None:
+                    record["ttft_s"] = time.perf_counter() - start
+                chunks.append(value)
+            else:
+                usage_tokens = value
+    except Exception as e:
+        record["error"] = str(e)
+    record["latency_s"] = time.perf_counter() - start
+    # Sans compteur fourni par le backend, on compte les fragments reçus.
+    record["output_tokens"] = usage_tokens if usage_tokens is not None else len(chunks)
+    decode_time = record["latency_s"] - (record["ttft_s"] or 0)
+    if record["output_tokens"] > 1 and decode_time > 0:
+        record["tokens_per_s"] = (record["output_tokens"] - 1) / decode_time
+    if keep_text:
+        record["response"] = "".join(chunks)
+    return record
+
+def percentile(values, q):
+    """Percentile par interpolation linéaire (q entre 0 et 100)."""
+    values = sorted(v for v in values if v is not None)
+    if not values:
+        return None
+    pos = (len(values) - 1) * q / 100
+    low = int(pos)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (pos - low)
+
+def summarize(records, wall_time_s):
+    """Agrégats par variante de prompt + global."""
+    summary = {}
+    for variant in dict.fromkeys(r["variant"] for r in records):
+        rows = [r for r in records if r["variant"] == variant]
+        ok = [r for r in rows if not r["error"]]
+        summary[variant] = {
+            "requests": len(rows),
+            "errors": len(rows) - len(ok),
+            **{f"ttft_p{q}_s": percentile([r["ttft_s"] for r in ok], q) for q in (50, 95, 99)},
+            **{f"latency_p{q}_s": percentile([r["latency_s"] for r in ok], q) for q in (50, 95, 99)},
+            "mean_output_tokens": sum(r["output_tokens"] for r in ok) / len(ok) if ok else None,
+            "tokens_per_s_p50": percentile([r["tokens_per_s"] for r in ok], 50),
+        }
+    total_tokens = sum(r["output_tokens"] for r in records if not r["error"])
+    summary["_overall"] = {
+        "requests": len(records),
+        "wall_time_s": wall_time_s,
+        "requests_per_s": len(records) / wall_time_s if wall_time_s else None,
+        "output_tokens_per_s": total_tokens / wall_time_s if wall_time_s else None,
+    }
+    return summary
+
+def run_benchmark(backend="stub", url=None, concurrency=4, repeat=1, prompts=None, cases=None, keep_text=False):
+    """Lance tous les couples prompt × cas (× `repeat`) avec `concurrency` requêtes en vol."""
+    prompts = prompts or SYSTEM_PROMPTS
+    cases = cases or TEST_CASES
+    stream_fn = BACKENDS[backend]
+    stub = None
+    if backend == "stub" and not url:
+        from stub_server import start_stub_server
+        stub, url = start_stub_server()
+    url = url or OLLAMA_URL
+    jobs = [(name, sys_prompt, case) for _ in range(repeat)
+            for name, sys_prompt in prompts.items() for case in cases]
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+    session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            records = list(pool.map(
+                lambda job: run_case(stream_fn, session, url, *job, keep_text=keep_text), jobs
+            ))
+    finally:
+        session.close()
+        if stub is not None:
+            stub.shutdown()
+    return records, summarize(records, time.perf_counter() - start)
+
+def print_summary(summary):
+    def fmt(value, unit=""):
+        return "   -   " if value is None else f"{value:7.3f}{unit}"
+    print(f"{'Variante':<16}{'n':>4}{'err':>5}  {'TTFT p50':>9}{'p95':>9}{'p99':>9}  "
+          f"{'Lat p50':>9}{'p95':>9}{'p99':>9}  {'tok':>6}{'tok/s':>9}")
+    for variant, s in summary.items():
+        if variant == "_overall":
+            continue
+        mean_tokens = "   -  " if s["mean_output_tokens"] is None else f"{s['mean_output_tokens']:6.1f}"
+        print(f"{variant:<16}{s['requests']:>4}{s['errors']:>5}  "
+              f"{fmt(s['ttft_p50_s'])}  {fmt(s['ttft_p95_s'])}  {fmt(s['ttft_p99_s'])}  "
+              f"{fmt(s['latency_p50_s'])}  {fmt(s['latency_p95_s'])}  {fmt(s['latency_p99_s'])}  "
+              f"{mean_tokens}  {fmt(s['tokens_per_s_p50'])}")
+    overall = summary["_overall"]
+    print(f"\nTotal : {overall['requests']} requêtes en {overall['wall_time_s']:.2f} s "
+          f"→ {fmt(overall['requests_per_s'])} req/s, {fmt(overall['output_tokens_per_s'])} tokens/s")
+
+def write_artifacts(records, summary, json_path=None, csv_path=None, meta=None):
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump({"meta": meta or {}, "summary": summary, "records": records}, f, ensure_ascii=False, indent=2)
+    if csv_path:
+        fields = ["variant", "case", "ttft_s", "latency_s", "output_tokens", "tokens_per_s", "error"]
+        with open(csv_path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=fields, extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(records)
+
 def run_tests():
+    """Mode historique : affiche les réponses de chaque variante (Ollama, séquentiel)."""
     print(f"--- Testing Prompts with Model: {MODEL_NAME} ---\
 ")
     
@@ -63,6 +237,37 @@ def run_tests():
             print("-" * 40)
         print("\n" + "="*60 + "\n")
 
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark des prompts système (latence / débit).")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="stub",
+                        help="stub (hors ligne), flask (serveur Kaggle) ou ollama")
+    parser.add_argument("--url", help="URL du backend (défaut : Ollama local, ou stub démarré à la volée)")
+    parser.add_argument("--concurrency", type=int, default=4, help="requêtes simultanées")
+    parser.add_argument("--repeat", type=int, default=1, help="nombre de passes sur l'ensemble des cas")
+    parser.add_argument("--variants", nargs="+", choices=sorted(SYSTEM_PROMPTS), help="sous-ensemble de prompts")
+    parser.add_argument("--json", dest="json_path", help="export JSON (résumé + mesures par requête)")
+    parser.add_argument("--csv", dest="csv_path", help="export CSV des mesures par requête")
+    parser.add_argument("--show-responses", action="store_true", help="affiche aussi le texte généré")
+    parser.add_argument("--legacy", action="store_true", help="ancien mode : réponses Ollama en séquentiel")
+    args = parser.parse_args(argv)
+
+    if args.legacy:
+        run_tests()
+        return
+
+    prompts = {k: SYSTEM_PROMPTS[k] for k in args.variants} if args.variants else SYSTEM_PROMPTS
+    print(f"--- Benchmark : backend={args.backend}, concurrence={args.concurrency}, "
+          f"{len(prompts)} prompts × {len(TEST_CASES)} cas × {args.repeat} ---\n")
+    records, summary = run_benchmark(args.backend, args.url, args.concurrency, args.repeat, prompts,
+                                     keep_text=args.show_responses)
+    if args.show_responses:
+        for r in records:
+            print(f"[{r['variant']}] {r['case']}\n{(r.get('response') or r['error'] or '').strip()}\n{'-' * 40}")
+    print_summary(summary)
+    meta = {"backend": args.backend, "url": args.url, "concurrency": args.concurrency,
+            "repeat": args.repeat, "model": MODEL_NAME, "timestamp": time.time()}
+    write_artifacts(records, summary, args.json_path, args.csv_path, meta)
+
 if __name__ == "__main__":
     # Check if requests is installed, strictly for the script run
     try:
@@ -71,4 +276,4 @@ if __name__ == "__main__":
         print("Please install 'requests': pip install requests")
         sys.exit(1)
         
-    run_tests()
+    main()
@@ -1,189 +1,321 @@
 import streamlit as st
-import io
-import speech_recognition as sr
-from streamlit_mic_recorder import mic_recorder
 from datetime import datetime
-from google import genai
-from google.genai import types
-import os
-import requests
-import json
-from pydub import AudioSegment
-import shutil
-from fpdf import FPDF
-
-# Initialisation de ffmpeg pour pydub (seulement si non présent dans le système)
-if not shutil.which("ffmpeg"):
-    try:
-        import static_ffmpeg
-        static_ffmpeg.add_paths()
-    except Exception as e:
-        print(f"Note: static_ffmpeg n'a pas pu être initialisé ({e}). Assurez-vous que ffmpeg est installé manuellement.")
+import uuid
+import time
+import queue
+import contextlib
+from llm_clients import LLMError, KAGGLE_BACKEND
+from llm_router import ROUTER_BACKEND
+from resources import (
+    MODEL_NAME, get_api_key, get_clients, get_router, get_response_cache, get_prefetch_executor, setup_ffmpeg,
+    live_dictation_available,
+)
+from prefetch import Prefetcher, task_key
+from triage import (
+    SYSTEM_PROMPT_QUESTIONS, SYSTEM_PROMPT_FINAL, build_questions_prompt, build_final_history,
+    build_final_prompt, build_emergency_prompt, build_cache_args, generate_cached, QUESTIONS_GENERATION,
+    final_stage, is_valid_report,
+)
+from structured_report import parse_report, report_markdown
+from red_flags import assess
+from tracing import tracer, in_own_context
+from audio_codec import decode_to_pcm, encode_pcm_payload, LiveTranscriber, PCM_MIMETYPE, TARGET_RATE
+
+# Streamlit ré-exécute ce script à chaque interaction : les modules lourds utilisés par une
+# seule étape (micro, reconnaissance Google, PDF, WebRTC) sont importés là où ils servent ;
+# les ressources partagées (ffmpeg, clients, caches) sont définies dans resources.py.
+
+# Fragments : une interaction limitée à l'étape 1 (symptômes, description) ne ré-exécute
+# que cette étape (Streamlit ≥ 1.37 ; `experimental_fragment` avant ; sinon script entier).
+fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None) or (lambda f: f)
 
 # --- Configuration ---
-# Utilisation du modèle Gemini 2.0 Flash par défaut pour l'API officielle
-MODEL_NAME = "gemini-2.0-flash"
-
-# --- PDF Generation Class ---
-class MedGemmaPDF(FPDF):
-    def header(self):
-        self.set_font('Arial', 'B', 15)
-        self.cell(0, 10, 'Rapport de Triage MedGemma', 0, 1, 'C')
-        self.ln(5)
-
-    def footer(self):
-        self.set_y(-15)
-        self.set_font('Arial', 'I', 8)
-        self.cell(0, 10, f'Page {self.page_no()}', 0, 0, 'C')
-        self.cell(0, 10, 'Généré par MedGemma - Prototype IA', 0, 0, 'R')
-
-def create_pdf(report_text, patient_data):
-    """Génère un PDF simple avec le rapport."""
-    pdf = MedGemmaPDF()
-    pdf.add_page()
-    
-    # Méta-données
-    pdf.set_font("Arial", size=10)
-    pdf.cell(0, 5, f"Date: {datetime.now().strftime('%d/%m/%Y %H:%M')}", 0, 1)
-    pdf.ln(5)
-    
-    # Info Patient
-    pdf.set_font("Arial", 'B', 12)
-    pdf.cell(0, 8, "Informations Patient", 0, 1)
-    pdf.set_font("Arial", size=11)
-    pdf.cell(0, 6, f"Age: {patient_data.get('age')} ans", 0, 1)
-    pdf.cell(0, 6, f"Sexe: {patient_data.get('sexe')}", 0, 1)
-    
-    # Symptomes
-    symptoms_list = ", ".join(patient_data.get('symptoms', []))
-    pdf.multi_cell(0, 6, f"Symptômes: {symptoms_list}")
-    if patient_data.get('description'):
-         pdf.multi_cell(0, 6, f"Description: {patient_data.get('description')}")
-    pdf.ln(5)
-    
-    # Rapport LLM
-    pdf.set_font("Arial", 'B', 12)
-    pdf.cell(0, 8, "Analyse & Recommandations", 0, 1)
-    pdf.set_font("Arial", size=11)
-    
-    # Nettoyage basique des caractères non supportés par latin-1
-    safe_text = report_text.encode('latin-1', 'replace').decode('latin-1')
-    pdf.multi_cell(0, 6, safe_text)
-    
-    # Disclaimer
-    pdf.ln(10)
-    pdf.set_font("Arial", 'I', 9)
-    pdf.set_text_color(200, 0, 0)
-    pdf.multi_cell(0, 5, "AVERTISSEMENT: Ce rapport est généré par une IA (Gemma 2b / Gemini). Il ne remplace pas un avis médical professionnel. En cas d'urgence, appelez le 15 ou le 112.")
-    
-    return pdf.output(dest='S').encode('latin-1')
+PREDEFINED_SYMPTOMS = [
+    "Fièvre", "Maux de tête", "Toux", "Maux de gorge", "Essoufflement",
+    "Fatigue", "Douleurs musculaires", "Nausées", "Vomissements", "Diarrhée",
+    "Douleur thoracique", "Vertiges"
+]
 
-# --- System Prompts (Optimized V3 SafetyFirst) ---
-SYSTEM_PROMPT_QUESTIONS = """You are MedGemma, a medical triage expert. 
-Based on the symptoms provided, generate 3-4 essential follow-up questions to better assess the urgency.
-Focus strictly on differentiating between benign issues and potential emergencies.
-Format as a simple bulleted list in French."""
+def get_llm(backend, custom_url):
+    """Routeur en mode automatique (`custom_url` : une URL Kaggle par ligne), sinon clients directs."""
+    if backend == ROUTER_BACKEND:
+        return get_router(custom_url or "", get_api_key() is not None)
+    return get_clients()
 
-SYSTEM_PROMPT_FINAL = """You are MedGemma, a helpful medical triage assistant.
-CRITICAL: If symptoms suggest a life-threatening emergency (e.g., heart attack signs, stroke, severe bleeding, breathing difficulty), IMMEDIATELY tell the user to call emergency services (15/112) in the first line.
+def kaggle_url_for(backend, custom_url):
+    """Serveur Kaggle à utiliser hors génération (transcription, pré-remplissage), ou None."""
+    if backend == ROUTER_BACKEND:
+        return get_llm(backend, custom_url).preferred_url()
+    return custom_url if backend == KAGGLE_BACKEND else None
 
-For non-emergencies, analyze the context and provide:
-1. Urgency Level (Low, Medium, High).
-2. Possible causes (stated with caution as possibilities, not diagnosis).
-3. Immediate home care actions.
-4. Recommendation on when to see a doctor (e.g., "Within 4 hours", "Tomorrow").
+def get_prefetcher():
+    """Tâches spéculatives propres à la session (voir prefetch.py)."""
+    if 'prefetcher' not in st.session_state:
+        st.session_state.prefetcher = Prefetcher(get_prefetch_executor())
+    return st.session_state.prefetcher
 
-Keep responses concise, structured, and empathetic. Answer in French."""
+@contextlib.contextmanager
+def traced(name, **attributes):
+    """Trace d'une action utilisateur ; la dernière trace terminée alimente le panneau de débogage."""
+    with tracer.trace(name, force=st.session_state.get("trace_debug", False), **attributes) as trace:
+        yield trace
+    if trace is not None:
+        st.session_state.last_trace = trace
 
-def get_api_key():
-    """Récupère la clé API depuis les secrets ou l'environnement."""
-    if "GEMINI_API_KEY" in st.secrets:
-        return st.secrets["GEMINI_API_KEY"]
-    return os.getenv("GEMINI_API_KEY")
+def stage_name(generation):
+    return f"triage.{(generation or {}).get('profile', 'generate')}"
 
-def query_llm(prompt, system_instruction, backend="Gemini API", custom_url=None):
-    """Envoie la requête au LLM choisi (Gemini API ou Kaggle/Custom)."""
-    
-    # --- OPTION 1: KAGGLE / CUSTOM URL ---
-    if backend == "Kaggle / Local URL":
-        if not custom_url:
-            return "Erreur : URL du serveur manquante."
-        
-        endpoint = f"{custom_url.rstrip('/')}/generate"
-        payload = {
-            "prompt": prompt,
-            "system_instruction": system_instruction
-        }
+def query_llm(prompt, system_instruction, backend="Gemini API", custom_url=None, history=None, session_id=None,
+              use_cache=True, semantic=False, generation=None, semantic_lookup=False, accept=None):
+    """Envoie la requête au LLM choisi (Gemini API ou Kaggle/Custom).
+
+    `history` contient les tours précédents du triage et `session_id` permet au serveur
+    Kaggle de reprendre le cache KV de l'étape précédente au lieu de tout re-traiter.
+    Les réponses réussies passent par le cache (`semantic=True` : indexées dans le tier approché,
+    `semantic_lookup=True` : ce tier peut aussi servir la réponse).
+    `generation` : profil de l'étape (budget de tokens et critères d'arrêt).
+    `accept` : seules les réponses qu'il accepte sont mises en cache (voir `generate_cached`).
+    """
+    cache = get_response_cache() if use_cache else None
+    with traced(stage_name(generation), backend=backend, streaming=False):
         try:
-            response = requests.post(endpoint, json=payload, timeout=60)
-            if response.status_code == 200:
-                return response.json().get("response", "Erreur: Réponse vide.")
-            else:
-                return f"Erreur Serveur ({response.status_code}): {response.text}"
-        except requests.exceptions.RequestException as e:
-            return f"Erreur de connexion au serveur Kaggle : {str(e)}"
+            return generate_cached(get_llm(backend, custom_url), cache, prompt, system_instruction, backend,
+                                   custom_url, history, session_id, semantic, generation, semantic_lookup, accept)
+        except LLMError as e:
+            return str(e)
 
-    # --- OPTION 2: GOOGLE GEMINI API ---
-    else:
-        api_key = get_api_key()
-        if not api_key:
-            return "Erreur : Clé API manquante."
+def query_llm_stream(prompt, system_instruction, backend="Gemini API", custom_url=None, history=None, session_id=None,
+                     use_cache=True, semantic=False, generation=None, semantic_lookup=False):
+    """Variante générateur de `query_llm` : produit le texte au fil de la génération."""
+    return in_own_context(_query_llm_stream(prompt, system_instruction, backend, custom_url, history, session_id,
+                                            use_cache, semantic, generation, semantic_lookup))
 
+def _query_llm_stream(prompt, system_instruction, backend, custom_url, history, session_id, use_cache, semantic,
+                      generation, semantic_lookup):
+    cache = get_response_cache() if use_cache else None
+    cache_args = build_cache_args(prompt, system_instruction, backend, MODEL_NAME, history, generation)
+    with traced(stage_name(generation), backend=backend, streaming=True):
+        if cache is not None:
+            with tracer.span("cache.lookup", semantic=semantic and semantic_lookup) as span:
+                cached = cache.get(**cache_args, semantic=semantic and semantic_lookup)
+                if span is not None:
+                    span.attributes["hit"] = cached is not None
+            if cached is not None:
+                yield cached
+                return
+
+        start = time.perf_counter()
+        chunks = []
         try:
-            client = genai.Client(api_key=api_key)
-            config = types.GenerateContentConfig(
-                system_instruction=system_instruction,
-                temperature=0.4,
-                max_output_tokens=600,
-            )
-            response = client.models.generate_content(
-                model=MODEL_NAME,
-                contents=prompt,
-                config=config
-            )
-            return response.text
-        except Exception as e:
-            return f"Erreur API Gemini : {str(e)}"
+            for chunk in get_llm(backend, custom_url).generate_stream(prompt, system_instruction, backend,
+                                                                      custom_url, history, session_id, generation):
+                chunks.append(chunk)
+                yield chunk
+        except LLMError as e:
+            yield str(e)
+            return
+        if cache is not None and chunks:
+            cache.put(**cache_args, response="".join(chunks), latency=time.perf_counter() - start,
+                      semantic=semantic)
+
+def questions_task_key(prompt, backend, custom_url, use_cache, semantic_lookup):
+    return task_key(prompt, backend, custom_url, use_cache, semantic_lookup)
+
+def speculate_questions(prompt, backend, custom_url, use_cache, semantic_lookup):
+    """Lance en arrière-plan les questions de suivi pour la saisie courante."""
+    get_prefetcher().speculate(
+        "questions", questions_task_key(prompt, backend, custom_url, use_cache, semantic_lookup),
+        generate_cached, get_llm(backend, custom_url), get_response_cache() if use_cache else None,
+        prompt, SYSTEM_PROMPT_QUESTIONS, backend, custom_url,
+        session_id=st.session_state.session_id, semantic=True, generation=QUESTIONS_GENERATION,
+        semantic_lookup=semantic_lookup,
+    )
+
+def speculate_final_context(history, backend, custom_url, system_instruction=SYSTEM_PROMPT_FINAL):
+    """Pendant la saisie des réponses, pré-remplit côté Kaggle le contexte du rapport final."""
+    url = kaggle_url_for(backend, custom_url)
+    if not url:
+        return
+    get_prefetcher().speculate(
+        "final_context", task_key(history, url, st.session_state.session_id, system_instruction),
+        get_clients().prefill, system_instruction, history, url, st.session_state.session_id,
+    )
+
+def show_report(report):
+    """Rapport final : objet structuré mis en forme localement, ou texte libre tel quel."""
+    st.markdown(report_markdown(report) if isinstance(report, dict) else report)
+
+EMERGENCY_BANNER = "🚨 **URGENCE POSSIBLE : appelez immédiatement le 15 ou le 112.**"
+
+def show_red_flags(red_flags):
+    """Bandeau d'urgence (ou mise en garde) issu du pré-triage par règles, sans attendre le LLM."""
+    if red_flags is None or red_flags.level is None:
+        return
+    if red_flags.is_emergency:
+        st.error(f"{EMERGENCY_BANNER}\n\nSignes détectés : {red_flags.reasons()}")
+    else:
+        st.warning(f"⚠️ Signes à surveiller : {red_flags.reasons()}")
 
 def transcribe_audio(audio_bytes, backend="Gemini API", custom_url=None):
-    """Convertit l'audio en WAV puis transcrit via Kaggle ou Google."""
-    
+    """Décode l'audio une seule fois en PCM 16 kHz mono puis transcrit via Kaggle ou Google."""
+    with traced("transcription", backend=backend, audio_bytes=len(audio_bytes)):
+        return _transcribe_audio(audio_bytes, backend, custom_url)
+
+def _transcribe_audio(audio_bytes, backend, custom_url):
     try:
-        # --- CONVERSION UNIVERSELLE EN WAV ---
-        # On utilise pydub pour lire n'importe quel format (WebM, AAC, etc.)
-        audio_segment = AudioSegment.from_file(io.BytesIO(audio_bytes))
-        
-        # On exporte en WAV (format PCM standard)
-        wav_io = io.BytesIO()
-        audio_segment.export(wav_io, format="wav")
-        wav_io.seek(0)
-        wav_bytes = wav_io.read()
+        # --- DÉCODAGE UNIQUE EN PCM 16 kHz MONO ---
+        # ffmpeg lit n'importe quel format (WebM, AAC, etc.) et rééchantillonne en une passe.
+        setup_ffmpeg()
+        with tracer.span("audio.decode_pcm"):
+            samples = decode_to_pcm(audio_bytes, TARGET_RATE)
         
         # --- OPTION KAGGLE (MedASR) ---
-        if backend == "Kaggle / Local URL" and custom_url:
-            endpoint = f"{custom_url.rstrip('/')}/transcribe"
-            files = {'audio': ('audio.wav', wav_bytes, 'audio/wav')}
-            response = requests.post(endpoint, files=files, timeout=30)
-            if response.status_code == 200:
-                return response.json().get("transcription")
-            else:
-                st.error(f"Erreur MedASR ({response.status_code}): {response.text}")
+        # Envoi du PCM brut (en-tête de 12 octets) : le serveur n'a plus rien à décoder.
+        kaggle_url = kaggle_url_for(backend, custom_url)
+        if kaggle_url:
+            try:
+                return get_clients().transcribe(
+                    encode_pcm_payload(samples, TARGET_RATE), kaggle_url,
+                    filename="audio.pcm", mimetype=PCM_MIMETYPE
+                )
+            except LLMError as e:
+                st.error(str(e))
                 return None
 
         # --- OPTION STANDARD (Google Speech Recognition) ---
+        import speech_recognition as sr
         recognizer = sr.Recognizer()
-        wav_io.seek(0)
-        with sr.AudioFile(wav_io) as source:
-            audio_data = recognizer.record(source)
-            try:
+        audio_data = sr.AudioData(samples.tobytes(), TARGET_RATE, 2)
+        try:
+            with tracer.span("POST google.recognize", kind="client"):
                 return recognizer.recognize_google(audio_data, language="fr-FR")
-            except:
-                return None
+        except:
+            return None
             
     except Exception as e:
         st.error(f"Erreur de traitement audio : {e}")
         return None
 
+def live_dictation(kaggle_url):
+    """Dictée en direct (MedASR) : la description se remplit pendant que le patient parle.
+
+    L'audio WebRTC du navigateur est rééchantillonné en 16 kHz mono et envoyé par morceaux
+    de `LIVE_CHUNK_MS` ; à l'arrêt du micro, seule la fin de la fenêtre reste à décoder.
+    """
+    import av
+    from streamlit_webrtc import webrtc_streamer, WebRtcMode
+    ctx = webrtc_streamer(
+        key="live_dictation", mode=WebRtcMode.SENDONLY, audio_receiver_size=256,
+        media_stream_constraints={"audio": True, "video": False},
+    )
+    live = st.session_state.get("live_transcriber")
+    if not ctx.state.playing:
+        if live is not None:
+            # Micro arrêté (nouvelle exécution du script) : transcription définitive.
+            st.session_state.live_transcriber = None
+            try:
+                st.session_state.symptoms_input = live.finish() or st.session_state.symptoms_input
+            except LLMError as e:
+                st.error(str(e))
+        return
+    if live is None:
+        live = st.session_state.live_transcriber = LiveTranscriber(get_clients(), kaggle_url)
+    resampler = av.AudioResampler(format="s16", layout="mono", rate=TARGET_RATE)
+    placeholder = st.empty()
+    while ctx.state.playing and ctx.audio_receiver:
+        try:
+            frames = ctx.audio_receiver.get_frames(timeout=1)
+        except queue.Empty:
+            continue
+        try:
+            for frame in frames:
+                for resampled in resampler.resample(frame):
+                    live.feed(resampled.to_ndarray().reshape(-1))
+        except LLMError as e:
+            st.error(str(e))
+            break
+        if live.text:
+            st.session_state.symptoms_input = live.text
+            placeholder.info(f"🎙️ {live.text}")
+
+def toggle_symptom(symptom):
+    st.session_state.selected_symptoms ^= {symptom}
+
+@fragment
+def initial_input(backend_option, custom_url, live_mode, live_url, prefetch, skip_questions, use_cache,
+                  semantic_lookup):
+    """Étape 1 : les clics sur les symptômes et la saisie ne ré-exécutent que ce fragment
+    (pas la barre latérale ni les panneaux de fin de script)."""
+    st.subheader("1. Informations de base")
+    col_age, col_sex = st.columns(2)
+    with col_age:
+        age = st.number_input("Âge", min_value=0, max_value=120, value=30)
+    with col_sex:
+        sexe = st.selectbox("Sexe", ["Masculin", "Féminin", "Autre"])
+
+    st.subheader("2. Symptômes")
+    
+    # Predefined Symptoms Selection
+    # Bascule dans le callback (avant l'exécution) : un seul passage, limité au fragment.
+    st.write("Sélectionnez les symptômes présents :")
+    cols = st.columns(4)
+    for i, symptom in enumerate(PREDEFINED_SYMPTOMS):
+        is_selected = symptom in st.session_state.selected_symptoms
+        cols[i % 4].button(symptom, key=f"btn_{symptom}", use_container_width=True,
+                           type="primary" if is_selected else "secondary",
+                           on_click=toggle_symptom, args=(symptom,))
+
+    # Voice/Text Input
+    if live_mode:
+        live_dictation(live_url)
+    else:
+        from streamlit_mic_recorder import mic_recorder
+        audio = mic_recorder(start_prompt="🎤 Parler", stop_prompt="⏹️ Arrêter", key='recorder')
+        if audio:
+            transcribed = transcribe_audio(audio['bytes'], backend=backend_option, custom_url=custom_url)
+            if transcribed: st.session_state.symptoms_input = transcribed
+
+    symptoms_text = st.text_area("Description libre :", value=st.session_state.symptoms_input, height=100)
+
+    # Pré-triage par règles : quelques dizaines de µs, affiché avant tout appel LLM.
+    red_flags = assess(symptoms_text, *st.session_state.selected_symptoms)
+    show_red_flags(red_flags)
+    direct_report = skip_questions and red_flags.is_emergency
+
+    # Spéculation : chaque saisie validée (symptôme, texte, transcription) relance les
+    # questions de suivi en arrière-plan ; la précédente est remplacée.
+    if prefetch and not direct_report and (symptoms_text.strip() or st.session_state.selected_symptoms):
+        speculate_questions(
+            build_questions_prompt(age, sexe, st.session_state.selected_symptoms, symptoms_text),
+            backend_option, custom_url, use_cache, semantic_lookup,
+        )
+
+    if st.button("Suivant ➡️", type="primary"):
+        if not symptoms_text.strip() and not st.session_state.selected_symptoms:
+            st.error("Précisez vos symptômes.")
+        else:
+            st.session_state.initial_data = {
+                "age": age, "sexe": sexe, 
+                "symptoms": list(st.session_state.selected_symptoms),
+                "description": symptoms_text
+            }
+            # La génération se fait à l'étape 2 pour pouvoir afficher les questions au fil de l'eau.
+            st.session_state.questions_prompt = build_questions_prompt(age, sexe, st.session_state.selected_symptoms, symptoms_text)
+            st.session_state.followup_questions = None
+            st.session_state.red_flags = red_flags
+            if direct_report:
+                # Urgence détectée : pas de questions de suivi, rapport final immédiat.
+                st.session_state.final_history = None
+                st.session_state.final_prompt = build_emergency_prompt(
+                    st.session_state.questions_prompt, red_flags.reasons()
+                )
+                st.session_state.final_report = None
+                st.session_state.report_time = datetime.now()
+                st.session_state.step = 3
+            else:
+                st.session_state.step = 2
+            st.rerun()  # changement d'étape : ré-exécution complète
+
 # --- Interface Streamlit ---
 st.set_page_config(page_title="MedGemma Triage", page_icon="🏥")
 
@@ -197,7 +329,9 @@ with st.sidebar:
     # Choix du Backend
     backend_option = st.radio(
         "Source du Modèle :",
-        ("Gemini API", "Kaggle / Local URL")
+        ("Gemini API", "Kaggle / Local URL", ROUTER_BACKEND),
+        help="Automatique : chaque requête part vers le backend sain le plus rapide, "
+             "avec doublon vers l'autre si elle tarde."
     )
     
     custom_url = None
@@ -205,6 +339,57 @@ with st.sidebar:
         custom_url = st.text_input("URL ngrok (Kaggle) :", placeholder="https://xxxx.ngrok-free.app")
         if not custom_url:
             st.warning("⚠️ Collez l'URL ngrok ici")
+    elif backend_option == ROUTER_BACKEND:
+        custom_url = st.text_area("URLs Kaggle / locales (une par ligne) :", placeholder="https://xxxx.ngrok-free.app")
+        if not custom_url.strip() and not api_key_present:
+            st.warning("⚠️ Ajoutez au moins une URL ou une clé API Gemini")
+        # Rempli en fin de script : affiche aussi les décisions de cette exécution.
+        routing_panel = st.container()
+
+    streaming = st.toggle("Affichage progressif (streaming)", value=True)
+    structured = st.toggle(
+        "Rapport structuré", value=True,
+        help="Le rapport final est généré en JSON compact (urgence, causes, actions, consultation) "
+             "puis mis en forme localement : moins de tokens, niveau d'urgence garanti."
+    )
+    final_system_prompt, final_generation = final_stage(structured)
+    use_cache = st.toggle("Cache des réponses", value=True)
+    prefetch = st.toggle(
+        "Pré-calcul en arrière-plan", value=True,
+        help="Prépare les questions de suivi pendant la saisie des symptômes."
+    )
+    live_url = kaggle_url_for(backend_option, custom_url) if live_dictation_available() else None
+    live_mode = bool(live_url) and st.toggle(
+        "Dictée en direct (MedASR)", value=True,
+        help="La transcription s'affiche pendant que vous parlez (serveur Kaggle requis)."
+    )
+    skip_questions = st.toggle(
+        "Urgence : rapport direct", value=True,
+        help="Si des signes d'alerte vitale sont détectés, le rapport final est généré sans questions de suivi."
+    )
+    # Réglage de la session, passé à chaque lecture : le cache est partagé par toutes les sessions.
+    semantic_lookup = st.toggle(
+        "Cache sémantique (questions)", value=False, disabled=not use_cache,
+        help="Réutilise les questions de suivi d'un cas déjà traité (même âge, sexe et symptômes) dont la description est formulée autrement."
+    )
+    trace_debug = st.toggle(
+        "Traces (débogage)", value=False, key="trace_debug",
+        help="Trace chaque requête (app → HTTP → serveur) et affiche le chronogramme de la dernière."
+    )
+    # Rempli en fin de script : la trace de cette exécution n'est connue qu'après les appels.
+    trace_panel = st.container() if trace_debug else None
+    if use_cache:
+        stats = get_response_cache().summary()
+        st.caption(
+            f"Cache : {stats['exact_hits']} exacts · {stats['semantic_hits']} sémantiques · "
+            f"{stats['misses']} manqués · {stats['latency_saved_s']:.1f} s économisées"
+        )
+    if prefetch and 'prefetcher' in st.session_state:
+        pstats = st.session_state.prefetcher.stats
+        st.caption(
+            f"Pré-calcul : {pstats['hits']} repris · {pstats['superseded']} remplacés · "
+            f"{pstats['started']} lancés"
+        )
     
     st.divider() 
     
@@ -215,6 +400,8 @@ with st.sidebar:
         else:
             st.error("❌ Clé API manquante")
         st.info(f"Modèle : `{MODEL_NAME}`")
+    elif backend_option == ROUTER_BACKEND:
+        st.info("Mode : Routage automatique (Kaggle + Gemini)")
     else:
         st.info("Mode : Serveur Distant (Kaggle)")
         
@@ -227,70 +414,55 @@ if 'initial_data' not in st.session_state:
     st.session_state.initial_data = {}
 if 'followup_questions' not in st.session_state:
     st.session_state.followup_questions = ""
+if 'final_report' not in st.session_state:
+    st.session_state.final_report = ""
 if 'selected_symptoms' not in st.session_state:
     st.session_state.selected_symptoms = set()
 if 'symptoms_input' not in st.session_state:
     st.session_state.symptoms_input = ""
+if 'session_id' not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
 
 st.title("🏥 MedGemma Triage")
 st.markdown("---")
 
 # --- STEP 1: INITIAL INPUT ---
 if st.session_state.step == 1:
-    st.subheader("1. Informations de base")
-    col_age, col_sex = st.columns(2)
-    with col_age:
-        age = st.number_input("Âge", min_value=0, max_value=120, value=30)
-    with col_sex:
-        sexe = st.selectbox("Sexe", ["Masculin", "Féminin", "Autre"])
-
-    st.subheader("2. Symptômes")
-    
-    # Predefined Symptoms Selection
-    PREDEFINED_SYMPTOMS = [
-        "Fièvre", "Maux de tête", "Toux", "Maux de gorge", "Essoufflement",
-        "Fatigue", "Douleurs musculaires", "Nausées", "Vomissements", "Diarrhée",
-        "Douleur thoracique", "Vertiges"
-    ]
-
-    st.write("Sélectionnez les symptômes présents :")
-    cols = st.columns(4)
-    for i, symptom in enumerate(PREDEFINED_SYMPTOMS):
-        col = cols[i % 4]
-        is_selected = symptom in st.session_state.selected_symptoms
-        if col.button(f"{'' if is_selected else ''}{symptom}", key=f"btn_{symptom}", use_container_width=True, type="primary" if is_selected else "secondary"):
-            if is_selected: st.session_state.selected_symptoms.remove(symptom)
-            else: st.session_state.selected_symptoms.add(symptom)
-            st.rerun()
-
-    # Voice/Text Input
-    audio = mic_recorder(start_prompt="🎤 Parler", stop_prompt="⏹️ Arrêter", key='recorder')
-    if audio:
-        transcribed = transcribe_audio(audio['bytes'], backend=backend_option, custom_url=custom_url)
-        if transcribed: st.session_state.symptoms_input = transcribed
-
-    symptoms_text = st.text_area("Description libre :", value=st.session_state.symptoms_input, height=100)
-
-    if st.button("Suivant ➡️", type="primary"):
-        if not symptoms_text.strip() and not st.session_state.selected_symptoms:
-            st.error("Précisez vos symptômes.")
-        else:
-            st.session_state.initial_data = {
-                "age": age, "sexe": sexe, 
-                "symptoms": list(st.session_state.selected_symptoms),
-                "description": symptoms_text
-            }
-            with st.spinner("Analyse initiale..."):
-                prompt = f"Patient: {age} ans, {sexe}. Symptômes: {st.session_state.selected_symptoms}. Description: {symptoms_text}"
-                st.session_state.followup_questions = query_llm(prompt, SYSTEM_PROMPT_QUESTIONS, backend=backend_option, custom_url=custom_url)
-                st.session_state.step = 2
-            st.rerun()
+    initial_input(backend_option, custom_url, live_mode, live_url, prefetch, skip_questions, use_cache,
+                  semantic_lookup)
 
 # --- STEP 2: FOLLOW-UP QUESTIONS ---
 elif st.session_state.step == 2:
+    show_red_flags(st.session_state.get("red_flags"))
     st.subheader("🔍 Précisions nécessaires")
     st.info("Pour affiner le triage, veuillez répondre à ces questions :")
-    st.markdown(st.session_state.followup_questions)
+    if st.session_state.followup_questions is None:
+        prompt = st.session_state.questions_prompt
+        prefetched = None
+        if prefetch:
+            key = questions_task_key(prompt, backend_option, custom_url, use_cache, semantic_lookup)
+            if get_prefetcher().status("questions", key) == "running":
+                with st.spinner("Analyse initiale..."):
+                    prefetched = get_prefetcher().take("questions", key)
+            else:
+                prefetched = get_prefetcher().take("questions", key)
+        if prefetched is not None:
+            st.session_state.followup_questions = prefetched
+            st.markdown(prefetched)
+        elif streaming:
+            st.session_state.followup_questions = st.write_stream(query_llm_stream(prompt, SYSTEM_PROMPT_QUESTIONS, backend=backend_option, custom_url=custom_url, session_id=st.session_state.session_id, use_cache=use_cache, semantic=True, generation=QUESTIONS_GENERATION, semantic_lookup=semantic_lookup))
+        else:
+            with st.spinner("Analyse initiale..."):
+                st.session_state.followup_questions = query_llm(prompt, SYSTEM_PROMPT_QUESTIONS, backend=backend_option, custom_url=custom_url, session_id=st.session_state.session_id, use_cache=use_cache, semantic=True, generation=QUESTIONS_GENERATION, semantic_lookup=semantic_lookup)
+            st.markdown(st.session_state.followup_questions)
+    else:
+        st.markdown(st.session_state.followup_questions)
+
+    if prefetch:
+        speculate_final_context(
+            build_final_history(st.session_state.questions_prompt, st.session_state.followup_questions),
+            backend_option, custom_url, final_system_prompt,
+        )
     
     answers = st.text_area("Vos réponses :", height=150, placeholder="Ex: La douleur dure depuis 2 jours, c'est apparu après manger...")
     
@@ -301,35 +473,56 @@ elif st.session_state.step == 2:
             st.rerun()
     with col_next:
         if st.button("Obtenir le rapport final 🔍", type="primary"):
-            with st.spinner("Génération du rapport de triage..."):
-                final_prompt = f"""
-                CONTEXTE:
-                - Patient: {st.session_state.initial_data['age']} ans, {st.session_state.initial_data['sexe']}
-                - Symptômes: {st.session_state.initial_data['symptoms']}
-                - Description: {st.session_state.initial_data['description']}
-                
-                PRÉCISIONS APPORTÉES:
-                {answers}
-                """
-                st.session_state.final_report = query_llm(final_prompt, SYSTEM_PROMPT_FINAL, backend=backend_option, custom_url=custom_url)
-                st.session_state.step = 3
+            # Le contexte patient et les questions sont transmis comme tours précédents :
+            # le serveur Kaggle reprend le cache KV de l'étape 1 et ne traite que les réponses.
+            st.session_state.final_history = build_final_history(
+                st.session_state.questions_prompt, st.session_state.followup_questions
+            )
+            st.session_state.final_prompt = build_final_prompt(answers)
+            st.session_state.final_report = None
+            st.session_state.report_time = datetime.now()
+            st.session_state.step = 3
             st.rerun()
 
 # --- STEP 3: FINAL REPORT ---
 elif st.session_state.step == 3:
+    show_red_flags(st.session_state.get("red_flags"))
+    if st.session_state.final_report is None:
+        final_prompt = st.session_state.final_prompt
+        if structured:
+            # Pas de JSON brut à l'écran : le rapport complet (court) est mis en forme à réception.
+            with st.spinner("Génération du rapport de triage..."):
+                response = query_llm(final_prompt, final_system_prompt, backend=backend_option, custom_url=custom_url, history=st.session_state.final_history, session_id=st.session_state.session_id, use_cache=use_cache, generation=final_generation, accept=is_valid_report)
+            report = parse_report(response)
+            if report is None:
+                # JSON illisible ou tronqué (ou erreur du backend) : rapport en prose plutôt que la sortie brute.
+                prose_system_prompt, prose_generation = final_stage(False)
+                with st.spinner("Rapport structuré illisible, génération du rapport détaillé..."):
+                    report = query_llm(final_prompt, prose_system_prompt, backend=backend_option, custom_url=custom_url, history=st.session_state.final_history, session_id=st.session_state.session_id, use_cache=use_cache, generation=prose_generation)
+            st.session_state.final_report = report
+            show_report(st.session_state.final_report)
+        elif streaming:
+            st.session_state.final_report = st.write_stream(query_llm_stream(final_prompt, final_system_prompt, backend=backend_option, custom_url=custom_url, history=st.session_state.final_history, session_id=st.session_state.session_id, use_cache=use_cache, generation=final_generation))
+        else:
+            with st.spinner("Génération du rapport de triage..."):
+                st.session_state.final_report = query_llm(final_prompt, final_system_prompt, backend=backend_option, custom_url=custom_url, history=st.session_state.final_history, session_id=st.session_state.session_id, use_cache=use_cache, generation=final_generation)
+            st.markdown(st.session_state.final_report)
+    else:
+        show_report(st.session_state.final_report)
     st.success("✅ Analyse de triage terminée")
-    st.markdown(st.session_state.final_report)
     
     col_dl, col_new = st.columns([1, 1])
     
     with col_dl:
-        # PDF Generation
+        # PDF Generation (mémoïsé : les reruns de l'étape 3 ne reconstruisent pas le document)
         try:
-            pdf_bytes = create_pdf(st.session_state.final_report, st.session_state.initial_data)
+            from pdf_report import cached_pdf  # fpdf : importé seulement à l'étape 3
+            pdf_bytes = cached_pdf(st.session_state.final_report, st.session_state.initial_data,
+                                   st.session_state.report_time)
             st.download_button(
                 label="📄 Télécharger le Rapport (PDF)",
                 data=pdf_bytes,
-                file_name=f"Rapport_MedGemma_{datetime.now().strftime('%Y%m%d')}.pdf",
+                file_name=f"Rapport_MedGemma_{st.session_state.report_time.strftime('%Y%m%d')}.pdf",
                 mime="application/pdf"
             )
         except Exception as e:
@@ -338,12 +531,58 @@ elif st.session_state.step == 3:
     with col_new:
         if st.button("🔄 Nouvelle analyse"):
             st.session_state.step = 1
+            st.session_state.red_flags = None
             st.session_state.selected_symptoms = set()
             st.session_state.symptoms_input = ""
+            st.session_state.session_id = uuid.uuid4().hex
+            get_prefetcher().cancel()
             st.rerun()
 
 
 # Footer
 st.markdown("---")
 if not api_key_present:
-    st.warning("Configuration requise : Ajoutez votre clé API dans .streamlit/secrets.toml")
\ No newline at end of file
+    st.warning("Configuration requise : Ajoutez votre clé API dans .streamlit/secrets.toml")
+
+# --- Routage : santé des backends et dernières décisions ---
+if backend_option == ROUTER_BACKEND and (custom_url.strip() or api_key_present):
+    STATE_ICONS = {"closed": "🟢", "half_open": "🟡", "open": "🔴"}
+    with routing_panel:
+        router = get_llm(backend_option, custom_url)
+        for name, stats in router.summary().items():
+            p50, p95 = stats["generate_p50_s"] or stats["stream_p50_s"], stats["generate_p95_s"] or stats["stream_p95_s"]
+            latency = f"p50 {p50:.2f} s · p95 {p95:.2f} s" if p50 is not None else "pas encore mesuré"
+            st.caption(f"{STATE_ICONS[stats['state']]} {name} · {latency} · erreurs {stats['error_rate']:.0%}")
+        with st.expander("Décisions de routage"):
+            for d in router.decisions:
+                outcome = f"→ {d['winner']}" if d["winner"] else "→ échec"
+                hedge = f" · doublon vers {d['hedged']}" if d["hedged"] else ""
+                st.caption(f"{d['at']} · {d['primary']}{hedge} {outcome} en {d['latency_s']:.2f} s"
+                           + (f" · {len(d['errors'])} erreur(s)" if d["errors"] else ""))
+
+# --- Traces : chronogramme de la dernière requête ---
+if trace_panel is not None:
+    with trace_panel:
+        trace = st.session_state.get("last_trace")
+        if trace is None:
+            st.caption("Aucune requête tracée pour l'instant.")
+        else:
+            rows, seen = [], {}
+            for order, (depth, span, start_ms) in enumerate(trace.timeline()):
+                label = "· " * depth + span.name
+                seen[label] = seen.get(label, 0) + 1
+                if seen[label] > 1:
+                    label += f" #{seen[label]}"
+                rows.append({"span": label, "order": order, "service": span.service, "start": round(start_ms, 1),
+                             "end": round(start_ms + span.duration_ms, 1), "ms": round(span.duration_ms, 1)})
+            st.caption(f"{trace.name} · {trace.root.duration_ms:.0f} ms · {len(rows)} spans · `{trace.trace_id[:8]}`")
+            st.vega_lite_chart(rows, {
+                "mark": {"type": "bar", "cornerRadius": 2},
+                "encoding": {
+                    "y": {"field": "span", "type": "nominal", "sort": {"field": "order", "op": "min"}, "title": None},
+                    "x": {"field": "start", "type": "quantitative", "title": "ms"},
+                    "x2": {"field": "end"},
+                    "color": {"field": "service", "type": "nominal", "legend": {"orient": "bottom", "title": None}},
+                    "tooltip": [{"field": "span"}, {"field": "ms", "title": "durée (ms)"}, {"field": "service"}],
+                },
+            }, use_container_width=True)
@@ -0,0 +1,120 @@
+"""Banc d'essai de l'app Streamlit : démarrage à froid et durée des ré-exécutions.
+
+Streamlit ré-exécute `app.py` à chaque interaction. Ce script pilote l'app avec
+`AppTest` (sans navigateur) contre le serveur factice (`stub_server.py`) et mesure :
+
+- le démarrage à froid : première exécution dans un processus neuf, imports compris ;
+- un clic sur un symptôme (bouton de l'étape 1), ré-exécution(s) comprise(s) ;
+- une ré-exécution sans changement.
+
+Chaque processus mesure un démarrage à froid puis `--runs` clics et ré-exécutions :
+
+    python app_benchmark.py
+    python app_benchmark.py --processes 5 --runs 50 --json bench_app.json
+
+`AppTest` exécute toujours le script entier : pour les interactions limitées à un
+fragment, les durées mesurées sont une borne haute.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_PATH = os.path.join(APP_DIR, "app.py")
+SYMPTOMS = ["Fièvre", "Toux", "Fatigue", "Nausées"]  # sans signe d'alerte : pas de bandeau d'urgence
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def run_app(runs):
+    """Mesures dans le processus courant (appelé par le processus fils)."""
+    sys.path.insert(0, os.path.dirname(APP_DIR))
+    from stub_server import start_stub_server
+    os.environ["MEDGEMMA_CACHE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="medgemma-bench-"), "cache.sqlite3")
+    os.environ["MEDGEMMA_TRACE_SAMPLE"] = "0"
+    stub, url = start_stub_server()
+
+    start = time.perf_counter()
+    from streamlit.testing.v1 import AppTest
+    at = AppTest.from_file(APP_PATH, default_timeout=60)
+    at.secrets["GEMINI_API_KEY"] = "benchmark"
+    at.run()
+    result = {"cold_start_s": time.perf_counter() - start}
+    at.sidebar.radio[0].set_value("Kaggle / Local URL").run()
+    at.sidebar.text_input[0].set_value(url).run()
+
+    clicks, reruns = [], []
+    for i in range(runs):
+        start = time.perf_counter()
+        at.button(key=f"btn_{SYMPTOMS[i % len(SYMPTOMS)]}").click().run()
+        clicks.append(time.perf_counter() - start)
+    for _ in range(runs):
+        start = time.perf_counter()
+        at.run()
+        reruns.append(time.perf_counter() - start)
+    if at.exception:
+        raise RuntimeError(at.exception[0].value)
+    stub.shutdown()
+    return {**result, "click_s": clicks, "rerun_s": reruns}
+
+
+def run_isolated(runs):
+    """Lance les mesures dans un processus neuf (imports à froid) ; renvoie ses mesures."""
+    proc = subprocess.run([sys.executable, __file__, "--worker", "--runs", str(runs)],
+                          capture_output=True, text=True, cwd=APP_DIR)
+    for line in reversed(proc.stdout.splitlines()):
+        if line.startswith("{"):
+            return json.loads(line)
+    error = (proc.stderr.strip().splitlines() or ["échec sans message"])[-1]
+    raise RuntimeError(error)
+
+
+def summarize(results):
+    clicks = [t for r in results for t in r["click_s"]]
+    reruns = [t for r in results for t in r["rerun_s"]]
+    return {
+        "processes": len(results),
+        "cold_start_p50_s": statistics.median(r["cold_start_s"] for r in results),
+        "click_p50_s": statistics.median(clicks),
+        "click_p95_s": percentile(clicks, 0.95),
+        "rerun_p50_s": statistics.median(reruns),
+        "rerun_p95_s": percentile(reruns, 0.95),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Démarrage à froid et ré-exécutions de l'app Streamlit.")
+    parser.add_argument("--processes", type=int, default=3, help="processus neufs (un démarrage à froid chacun)")
+    parser.add_argument("--runs", type=int, default=20, help="clics et ré-exécutions mesurés par processus")
+    parser.add_argument("--json", dest="json_path", help="export JSON du résumé")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        print(json.dumps(run_app(args.runs)))
+        return
+
+    results = []
+    for i in range(args.processes):
+        print(f"⏱️  processus {i + 1}/{args.processes}...", flush=True)
+        results.append(run_isolated(args.runs))
+    summary = summarize(results)
+    print()
+    print(f"Démarrage à froid : {summary['cold_start_p50_s']:.2f} s (médiane, {summary['processes']} processus)")
+    print(f"Clic symptôme     : p50 {summary['click_p50_s'] * 1000:.0f} ms · p95 {summary['click_p95_s'] * 1000:.0f} ms")
+    print(f"Ré-exécution      : p50 {summary['rerun_p50_s'] * 1000:.0f} ms · p95 {summary['rerun_p95_s'] * 1000:.0f} ms")
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
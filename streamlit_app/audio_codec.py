@@ -0,0 +1,96 @@
+"""Chemin audio compact entre l'app et le serveur ASR.
+
+L'audio du micro (WebM, AAC...) est décodé UNE fois par ffmpeg directement en PCM
+16 kHz mono int16 (aucun WAV intermédiaire), puis envoyé tel quel derrière un en-tête
+de 12 octets. Le serveur l'enveloppe avec `np.frombuffer`, sans décodage ni
+rééchantillonnage. Format de l'en-tête (little-endian) :
+
+    b"MGPC" | uint32 fréquence | uint16 canaux | uint16 format (1 = int16, 3 = float32)
+
+Dictée en direct (`LiveTranscriber`) : le même format, envoyé par morceaux de quelques
+centaines de ms à /transcribe_stream, qui renvoie la transcription partielle à chaque morceau.
+"""
+import os
+import shutil
+import struct
+import subprocess
+
+import numpy as np
+
+PCM_MAGIC = b"MGPC"
+PCM_HEADER = struct.Struct("<4sIHH")
+PCM_FORMATS = {1: np.int16, 3: np.float32}
+PCM_MIMETYPE = "application/x-medgemma-pcm"
+TARGET_RATE = 16000
+LIVE_CHUNK_MS = int(os.getenv("MEDGEMMA_LIVE_CHUNK_MS", "250"))
+
+
+def ffmpeg_binary():
+    """ffmpeg du système, sinon celui configuré pour pydub (static_ffmpeg)."""
+    path = shutil.which("ffmpeg")
+    if path:
+        return path
+    from pydub import AudioSegment
+    return AudioSegment.converter
+
+
+def decode_to_pcm(audio_bytes, rate=TARGET_RATE):
+    """Décode n'importe quel conteneur audio en PCM mono int16 à `rate` Hz (tableau numpy)."""
+    result = subprocess.run(
+        [ffmpeg_binary(), "-loglevel", "error", "-i", "pipe:0",
+         "-f", "s16le", "-acodec", "pcm_s16le", "-ac", "1", "-ar", str(rate), "pipe:1"],
+        input=audio_bytes, capture_output=True, check=False,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg : {result.stderr.decode(errors='replace').strip()}")
+    return np.frombuffer(result.stdout, dtype=np.int16)
+
+
+def encode_pcm_payload(samples, rate=TARGET_RATE):
+    """En-tête + échantillons bruts (int16 ou float32, mono)."""
+    samples = np.ascontiguousarray(samples)
+    fmt = {np.dtype(dtype): code for code, dtype in PCM_FORMATS.items()}[samples.dtype]
+    return PCM_HEADER.pack(PCM_MAGIC, rate, 1, fmt) + samples.tobytes()
+
+
+class LiveTranscriber:
+    """Dictée en direct : accumule le PCM du micro et l'envoie à /transcribe_stream par
+    morceaux de `chunk_ms` ; `text` est la dernière transcription (partielle) reçue.
+
+    Chaque morceau porte sa position dans le flux : un morceau renvoyé par un retry est
+    ignoré par le serveur.
+    """
+
+    def __init__(self, clients, url, chunk_ms=LIVE_CHUNK_MS, rate=TARGET_RATE):
+        self.clients, self.url, self.rate = clients, url, rate
+        self.chunk = rate * chunk_ms // 1000
+        self.stream_id = None
+        self.sent = 0
+        self.text = ""
+        self.final = False
+        self._pending = []
+        self._pending_len = 0
+
+    def feed(self, samples):
+        """Ajoute des échantillons int16 mono ; envoie dès qu'un morceau est complet. Lève `LLMError`."""
+        self._pending.append(samples)
+        self._pending_len += len(samples)
+        if self._pending_len >= self.chunk:
+            self._send()
+        return self.text
+
+    def finish(self):
+        """Envoie le reste et clôt le flux : transcription définitive."""
+        if not self.final:
+            self._send(final=True)
+            self.final = True
+        return self.text
+
+    def _send(self, final=False):
+        samples = np.concatenate(self._pending) if self._pending else np.zeros(0, dtype=np.int16)
+        result = self.clients.transcribe_stream(encode_pcm_payload(samples, self.rate), self.url,
+                                                self.stream_id, self.sent, final)
+        self.stream_id = result["stream_id"]
+        self.sent += len(samples)
+        self._pending, self._pending_len = [], 0
+        self.text = result.get("transcription") or ""
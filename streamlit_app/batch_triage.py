@@ -0,0 +1,247 @@
+"""Triage par lots : le pipeline de l'app (questions de suivi → rapport final) sur un JSONL.
+
+Entrée, un cas par ligne (`id` conseillé pour la reprise, sinon numéro de ligne) :
+
+    {"id": "A12", "age": 45, "sexe": "Féminin", "symptoms": ["Fièvre", "Toux"],
+     "description": "Toux sèche depuis 3 jours", "answers": "38,5 °C le soir, pas d'essoufflement"}
+
+Chaque cas terminé est ajouté immédiatement au JSONL de sortie, qui sert aussi de point
+de reprise : relancée, la commande saute les cas déjà réussis. Les lignes de sortie
+contiennent `final_report`, `initial_data` et `generated_at`, directement exportables
+en PDF avec `pdf_export.py`. Avec `--structured`, `report` contient en plus le rapport
+structuré (urgence, causes, actions, consultation ; voir structured_report.py).
+
+    python batch_triage.py cas.jsonl -o resultats.jsonl --backend stub --concurrency 8
+    python batch_triage.py cas.jsonl -o resultats.jsonl --backend kaggle --url https://xxxx.ngrok-free.app
+    python batch_triage.py cas.jsonl -o resultats.jsonl --backend auto --url https://a.ngrok-free.app,http://localhost:5000
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
+
+from llm_cache import ResponseCache
+from llm_clients import BackendClients, LLMError, GEMINI_BACKEND, KAGGLE_BACKEND
+from llm_router import LLMRouter, ROUTER_BACKEND, build_routes
+from triage import (
+    SYSTEM_PROMPT_QUESTIONS, build_questions_prompt, build_final_history, build_final_prompt, generate_cached,
+    final_stage, is_valid_report, QUESTIONS_GENERATION,
+)
+from structured_report import parse_report, report_markdown
+
+BACKENDS = {"kaggle": KAGGLE_BACKEND, "gemini": GEMINI_BACKEND, "stub": KAGGLE_BACKEND, "auto": ROUTER_BACKEND}
+DEFAULT_ANSWERS = "Pas de précisions supplémentaires."
+
+
+def case_id(case, index):
+    return str(case.get("id") or f"case_{index:06d}")
+
+
+def load_cases(path):
+    with open(path, encoding="utf-8") as f:
+        for index, line in enumerate(f):
+            if line.strip():
+                case = json.loads(line)
+                yield case_id(case, index), case
+
+
+def load_checkpoint(output_path):
+    """Identifiants déjà traités avec succès dans un précédent lancement.
+
+    Une dernière ligne tronquée (arrêt brutal pendant l'écriture) est supprimée.
+    """
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            if record.get("status") == "ok":
+                done.add(record["id"])
+    return done
+
+
+def run_case(clients, cache, backend, url, cid, case, structured=False):
+    """Les deux étapes du triage pour un cas ; renvoie la ligne de résultat (jamais d'exception)."""
+    initial_data = {
+        "age": case.get("age"),
+        "sexe": case.get("sexe"),
+        "symptoms": list(case.get("symptoms") or []),
+        "description": case.get("description", ""),
+    }
+    record = {"id": cid, "initial_data": initial_data, "status": "ok", "error": None,
+              "questions": None, "final_report": None, "latency_s": {}}
+    session_id = uuid.uuid4().hex
+    start = time.perf_counter()
+    try:
+        questions_prompt = build_questions_prompt(
+            initial_data["age"], initial_data["sexe"], set(initial_data["symptoms"]), initial_data["description"]
+        )
+        record["questions"] = generate_cached(
+            clients, cache, questions_prompt, SYSTEM_PROMPT_QUESTIONS, backend, url,
+            session_id=session_id, semantic=True, generation=QUESTIONS_GENERATION,
+        )
+        record["latency_s"]["questions"] = time.perf_counter() - start
+
+        stage_start = time.perf_counter()
+        system_instruction, generation = final_stage(structured)
+        record["final_report"] = generate_cached(
+            clients, cache, build_final_prompt(case.get("answers") or DEFAULT_ANSWERS), system_instruction,
+            backend, url, history=build_final_history(questions_prompt, record["questions"]),
+            session_id=session_id, generation=generation, accept=is_valid_report if structured else None,
+        )
+        record["latency_s"]["final"] = time.perf_counter() - stage_start
+        if structured:
+            record["report"] = parse_report(record["final_report"])
+            if record["report"] is None:
+                record["status"], record["error"] = "error", "Rapport structuré invalide"
+            else:
+                record["final_report"] = report_markdown(record["report"])
+    except LLMError as e:
+        record["status"], record["error"] = "error", str(e)
+    except Exception as e:
+        # Tout autre échec (bug, réponse inattendue) : le cas est compté et repris au prochain lancement.
+        record["status"], record["error"] = "error", f"{type(e).__name__}: {e}"
+    record["latency_s"]["total"] = time.perf_counter() - start
+    record["generated_at"] = datetime.now().isoformat(timespec="seconds")
+    return record
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * q / 100
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def summarize(records, wall_time_s, skipped):
+    ok = [r for r in records if r["status"] == "ok"]
+    summary = {
+        "cases": len(records),
+        "ok": len(ok),
+        "errors": len(records) - len(ok),
+        "skipped": skipped,
+        "wall_time_s": wall_time_s,
+        "cases_per_s": len(records) / wall_time_s if wall_time_s else None,
+    }
+    for stage in ("questions", "final", "total"):
+        values = [r["latency_s"][stage] for r in ok if stage in r["latency_s"]]
+        for q in (50, 95, 99):
+            summary[f"{stage}_p{q}_s"] = percentile(values, q)
+    return summary
+
+
+def print_summary(summary):
+    def fmt(value):
+        return "   -   " if value is None else f"{value:7.3f}"
+    print(f"\n{summary['cases']} cas traités ({summary['ok']} ok, {summary['errors']} erreurs, "
+          f"{summary['skipped']} repris du point de reprise) en {summary['wall_time_s']:.2f} s "
+          f"→ {fmt(summary['cases_per_s'])} cas/s")
+    print(f"{'Étape':<12}{'p50 (s)':>9}{'p95':>9}{'p99':>9}")
+    for stage in ("questions", "final", "total"):
+        print(f"{stage:<12}{fmt(summary[f'{stage}_p50_s'])}  {fmt(summary[f'{stage}_p95_s'])}  "
+              f"{fmt(summary[f'{stage}_p99_s'])}")
+    for name, route in summary.get("routes", {}).items():
+        print(f"🔀 {name:<10} {route['state']:<9} {route['requests']:>5} requêtes  "
+              f"p50 {fmt(route['generate_p50_s'])}  p95 {fmt(route['generate_p95_s'])}  "
+              f"erreurs {route['error_rate']:.0%}")
+
+
+def run_batch(cases_path, output_path, backend="stub", url=None, concurrency=4, use_cache=False,
+              gemini_api_key=None, progress=True, structured=False):
+    """Traite les cas non encore réussis ; résultats ajoutés à `output_path` au fil de l'eau."""
+    stub_server = None
+    if backend == "stub" and not url:
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        from stub_server import start_stub_server
+        stub_server, url = start_stub_server()
+    gemini_api_key = gemini_api_key or os.getenv("GEMINI_API_KEY")
+    clients = BackendClients(gemini_api_key=gemini_api_key, pool_size=max(16, concurrency))
+    if backend == "auto":
+        # Plusieurs URL séparées par des virgules, plus Gemini si une clé est disponible.
+        clients = LLMRouter(clients, build_routes((url or "").split(","), gemini=bool(gemini_api_key)))
+    cache = None
+    if use_cache:
+        # Réponses factices : cache en mémoire, jamais le fichier partagé que lit l'app.
+        cache = ResponseCache(":memory:") if backend == "stub" else ResponseCache()
+    done = load_checkpoint(output_path)
+    records, skipped = [], 0
+    lock = threading.Lock()
+    start = time.perf_counter()
+    try:
+        with open(output_path, "a", encoding="utf-8") as out, ThreadPoolExecutor(concurrency) as pool:
+            def record_result(future):
+                record = future.result()
+                with lock:
+                    out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    out.flush()
+                    records.append(record)
+                    if progress:
+                        mark = "✅" if record["status"] == "ok" else "❌"
+                        print(f"{mark} {record['id']} ({record['latency_s']['total']:.2f} s)", flush=True)
+
+            in_flight = set()
+            for cid, case in load_cases(cases_path):
+                if cid in done:
+                    skipped += 1
+                    continue
+                # Nombre borné de cas soumis : l'entrée peut être arbitrairement grande.
+                if len(in_flight) >= 2 * concurrency:
+                    finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                future = pool.submit(run_case, clients, cache, BACKENDS[backend], url, cid, case, structured)
+                future.add_done_callback(record_result)
+                in_flight.add(future)
+            wait(in_flight)
+    finally:
+        clients.close()
+        if stub_server is not None:
+            stub_server.shutdown()
+    summary = summarize(records, time.perf_counter() - start, skipped)
+    if isinstance(clients, LLMRouter):
+        summary["routes"] = clients.summary()
+    return records, summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Triage par lots (questions de suivi puis rapport final) sur un JSONL.")
+    parser.add_argument("cases", help="JSONL des cas (age, sexe, symptoms, description, answers)")
+    parser.add_argument("-o", "--output", default="triage_results.jsonl", help="JSONL des résultats (et point de reprise)")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="stub",
+                        help="stub (hors ligne), kaggle (serveur Flask), gemini ou auto (routeur)")
+    parser.add_argument("--url", help="URL du serveur (défaut en stub : serveur factice démarré à la volée) ; "
+                                      "en auto, plusieurs URL séparées par des virgules")
+    parser.add_argument("--concurrency", type=int, default=4, help="cas traités simultanément")
+    parser.add_argument("--use-cache", action="store_true", help="passe par le cache des réponses de l'app (en mémoire avec --backend stub)")
+    parser.add_argument("--structured", action="store_true", help="rapport final structuré (JSON contraint)")
+    parser.add_argument("--summary-json", help="export JSON du résumé")
+    parser.add_argument("--quiet", action="store_true", help="pas de ligne par cas")
+    args = parser.parse_args(argv)
+
+    if args.backend == "kaggle" and not args.url:
+        parser.error("--url requis avec --backend kaggle")
+    try:
+        _, summary = run_batch(args.cases, args.output, args.backend, args.url, args.concurrency,
+                               args.use_cache, progress=not args.quiet, structured=args.structured)
+    except KeyboardInterrupt:
+        print("\n⏸️ Interrompu : relancez la même commande pour reprendre.")
+        return 130
+    print_summary(summary)
+    if args.summary_json:
+        with open(args.summary_json, "w") as f:
+            json.dump(summary, f, indent=2)
+    return 1 if summary["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
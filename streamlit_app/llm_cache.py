@@ -0,0 +1,201 @@
+"""Cache à deux niveaux des réponses LLM du triage.
+
+1. Exact : SQLite sur disque, clé = tuple normalisé (instruction système, prompt,
+   historique, température, max tokens, modèle), avec TTL et éviction LRU bornée.
+2. Sémantique (optionnel, demandé à chaque lecture) : index d'embeddings qui resert les
+   questions de suivi d'un cas identique (âge, sexe, symptômes cochés) dont seule la
+   description libre est formulée autrement.
+"""
+import hashlib
+import json
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+import zlib
+
+DEFAULT_CACHE_PATH = os.getenv(
+    "MEDGEMMA_CACHE_PATH", os.path.expanduser("~/.cache/medgemma/llm_responses.sqlite3")
+)
+DEFAULT_TTL_S = float(os.getenv("MEDGEMMA_CACHE_TTL_S", str(7 * 24 * 3600)))
+DEFAULT_MAX_ENTRIES = int(os.getenv("MEDGEMMA_CACHE_MAX_ENTRIES", "5000"))
+DEFAULT_SIMILARITY = float(os.getenv("MEDGEMMA_CACHE_SIMILARITY", "0.92"))
+# Sépare, dans un prompt de l'étape 1, le cas (comparé exactement) de la description libre.
+DESCRIPTION_MARKER = ". Description: "
+
+
+def normalize_text(text):
+    """Unicode NFC, minuscules, espaces compactés : deux saisies équivalentes → même clé."""
+    text = unicodedata.normalize("NFC", text or "")
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+def make_key(system_instruction, prompt, temperature, max_tokens, model, history=None):
+    parts = {
+        "system": normalize_text(system_instruction),
+        "prompt": normalize_text(prompt),
+        "history": [[t.get("role"), normalize_text(t.get("content"))] for t in history or []],
+        "temperature": round(float(temperature), 3),
+        "max_tokens": int(max_tokens),
+        "model": model,
+    }
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def semantic_parts(prompt):
+    """(partie exacte, texte comparé de façon approchée) d'un prompt pour le tier sémantique.
+
+    `Patient: 30 ans, Masculin. Symptômes: Fièvre, Toux. Description: ...` : âge, sexe et
+    symptômes doivent être identiques, seule la description est comparée aux trigrammes
+    (un symptôme de plus ou un autre âge change le cas, pas seulement la formulation).
+    """
+    head, sep, description = (prompt or "").partition(DESCRIPTION_MARKER)
+    return (normalize_text(head), description) if sep else ("", prompt or "")
+
+
+def hashed_ngram_embedding(text, dim=512):
+    """Embedding local et déterministe : trigrammes de caractères hachés, norme L2 = 1.
+
+    Suffisant pour repérer des descriptions quasi identiques sans appel réseau ; une
+    autre fonction (ex: embeddings Gemini) peut être fournie via `embed_fn`. La ponctuation
+    est ignorée : « Toux, la nuit. » et « toux la nuit » ont le même embedding.
+    """
+    text = "  " + normalize_text(re.sub(r"[^\w\s]", " ", text or "")) + "  "
+    vec = [0.0] * dim
+    for i in range(len(text) - 2):
+        vec[zlib.crc32(text[i:i + 3].encode("utf-8")) % dim] += 1.0
+    norm = math.sqrt(sum(v * v for v in vec)) or 1.0
+    return [v / norm for v in vec]
+
+
+def cosine(a, b):
+    return sum(x * y for x, y in zip(a, b))
+
+
+class ResponseCache:
+    """Cache exact (disque) + sémantique (mémoire) avec compteurs hit/miss/latence."""
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, ttl_s=DEFAULT_TTL_S, max_entries=DEFAULT_MAX_ENTRIES,
+                 similarity_threshold=DEFAULT_SIMILARITY, embed_fn=hashed_ngram_embedding):
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self.similarity_threshold = similarity_threshold
+        self.embed_fn = embed_fn
+        self.stats = {"exact_hits": 0, "semantic_hits": 0, "misses": 0, "latency_saved_s": 0.0}
+        self._lock = threading.Lock()
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY, response TEXT, latency REAL,
+                created REAL, last_access REAL, namespace TEXT, prompt TEXT)"""
+        )
+        self._db.commit()
+        # Index sémantique : (namespace, vecteur, clé) reconstruit depuis le disque. Il est
+        # alimenté par toutes les écritures `semantic=True`, que la lecture approchée soit
+        # demandée ou non (le cache est partagé par des sessions aux réglages différents).
+        self._index = []
+        self._purge_expired()
+        rows = self._db.execute("SELECT key, namespace, prompt FROM responses WHERE namespace IS NOT NULL")
+        self._index = [(ns, self.embed_fn(semantic_parts(prompt)[1]), key) for key, ns, prompt in rows]
+
+    @staticmethod
+    def namespace(system_instruction, prompt, temperature, max_tokens, model):
+        """Le tier sémantique ne compare que des prompts destinés au même appel, pour le même cas."""
+        return make_key(system_instruction, semantic_parts(prompt)[0], temperature, max_tokens, model)
+
+    def get(self, system_instruction, prompt, temperature, max_tokens, model, history=None, semantic=False):
+        """Renvoie la réponse en cache ou None. `semantic=True` autorise le tier approché."""
+        key = make_key(system_instruction, prompt, temperature, max_tokens, model, history)
+        with self._lock:
+            hit = self._fetch(key)
+            if hit is not None:
+                self.stats["exact_hits"] += 1
+            elif semantic and not history:
+                ns = self.namespace(system_instruction, prompt, temperature, max_tokens, model)
+                hit = self._nearest(ns, semantic_parts(prompt)[1])
+                if hit is not None:
+                    self.stats["semantic_hits"] += 1
+            if hit is None:
+                self.stats["misses"] += 1
+                return None
+            response, latency = hit
+            self.stats["latency_saved_s"] += latency or 0.0
+            return response
+
+    def put(self, system_instruction, prompt, temperature, max_tokens, model, response, latency,
+            history=None, semantic=False):
+        key = make_key(system_instruction, prompt, temperature, max_tokens, model, history)
+        ns = None
+        if semantic and not history:
+            ns = self.namespace(system_instruction, prompt, temperature, max_tokens, model)
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, response, latency, now, now, ns, prompt),
+            )
+            self._db.commit()
+            if ns is not None:
+                self._index = [e for e in self._index if e[2] != key]
+                self._index.append((ns, self.embed_fn(semantic_parts(prompt)[1]), key))
+            self._evict()
+
+    def summary(self):
+        with self._lock:
+            (size,) = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()
+            return {**self.stats, "entries": size}
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM responses")
+            self._db.commit()
+            self._index = []
+
+    def _fetch(self, key):
+        row = self._db.execute("SELECT response, latency, created FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        response, latency, created = row
+        if time.time() - created > self.ttl_s:
+            self._delete([key])
+            return None
+        self._db.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+        self._db.commit()
+        return response, latency
+
+    def _nearest(self, ns, text):
+        vec = self.embed_fn(text)
+        best_key, best_score = None, self.similarity_threshold
+        for entry_ns, entry_vec, key in self._index:
+            if entry_ns != ns:
+                continue
+            score = cosine(vec, entry_vec)
+            if score >= best_score:
+                best_key, best_score = key, score
+        return self._fetch(best_key) if best_key else None
+
+    def _purge_expired(self):
+        expired = [k for (k,) in self._db.execute(
+            "SELECT key FROM responses WHERE created < ?", (time.time() - self.ttl_s,))]
+        self._delete(expired)
+
+    def _evict(self):
+        (size,) = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()
+        if size <= self.max_entries:
+            return
+        oldest = [k for (k,) in self._db.execute(
+            "SELECT key FROM responses ORDER BY last_access ASC LIMIT ?", (size - self.max_entries,))]
+        self._delete(oldest)
+
+    def _delete(self, keys):
+        if not keys:
+            return
+        self._db.executemany("DELETE FROM responses WHERE key = ?", [(k,) for k in keys])
+        self._db.commit()
+        dropped = set(keys)
+        self._index = [e for e in self._index if e[2] not in dropped]
@@ -0,0 +1,352 @@
+"""Clients des backends LLM / ASR, créés une fois par processus et partagés.
+
+- Kaggle / Local URL : `requests.Session` avec pool de connexions keep-alive et retries
+  (backoff exponentiel avec jitter) sur 429/5xx, timeouts (connexion, lecture) par étape.
+  Un POST n'est rejoué que sur 429/503 (requête refusée avant traitement) : sur 500/504
+  le serveur a pu générer, et rejouer doublerait le travail GPU.
+- Gemini API : un seul `genai.Client`, avec ses propres options de retry.
+- `agenerate` : variante asyncio pour les appels en lot.
+"""
+import asyncio
+import json
+import os
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from tracing import tracer
+
+KAGGLE_BACKEND = "Kaggle / Local URL"
+GEMINI_BACKEND = "Gemini API"
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+REPLAYABLE_STATUSES = (429, 503)  # refus sans traitement (file pleine, modèle en chargement)
+GEMINI_MAX_STOP_SEQUENCES = 5
+
+# Timeouts (connexion, lecture) en secondes par étape ; surchargeables par variable d'env,
+# ex: MEDGEMMA_TIMEOUT_GENERATE="5,90".
+DEFAULT_TIMEOUTS = {
+    "generate": (5.0, 60.0),
+    "stream": (5.0, 60.0),     # lecture = délai max entre deux évènements du flux
+    "transcribe": (5.0, 30.0),
+    "transcribe_stream": (5.0, 10.0),  # un morceau de dictée en direct
+}
+
+
+class LLMError(Exception):
+    """Échec d'appel au LLM ; le message est affiché tel quel à l'utilisateur."""
+
+
+def load_timeouts():
+    timeouts = dict(DEFAULT_TIMEOUTS)
+    for stage in timeouts:
+        value = os.getenv(f"MEDGEMMA_TIMEOUT_{stage.upper()}")
+        if value:
+            connect, read = (float(v) for v in value.split(","))
+            timeouts[stage] = (connect, read)
+    return timeouts
+
+
+class PostSafeRetry(Retry):
+    """Retry urllib3 : méthodes idempotentes sur tout `RETRY_STATUSES`, POST seulement sur
+    `REPLAYABLE_STATUSES` (les erreurs de lecture d'un POST ne sont jamais rejouées)."""
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if self._is_method_retryable(method):
+            return super().is_retry(method, status_code, has_retry_after)
+        return bool(self.total) and status_code in REPLAYABLE_STATUSES
+
+
+def build_retry(max_retries, backoff_factor, jitter):
+    kwargs = dict(
+        total=max_retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUSES,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    try:
+        return PostSafeRetry(backoff_jitter=jitter, **kwargs)
+    except TypeError:  # urllib3 < 2 : pas de jitter
+        return PostSafeRetry(**kwargs)
+
+
+def genai_types():
+    """`google.genai.types`, importé au premier appel Gemini : le SDK met près d'une seconde
+    à s'importer et reste inutile quand seul le serveur Kaggle est utilisé."""
+    from google.genai import types
+    return types
+
+
+def build_gemini_contents(prompt, history=None):
+    """Ajoute les tours précédents de la conversation (rôles `user` / `model`) au prompt."""
+    if not history:
+        return prompt
+    types = genai_types()
+    contents = [
+        types.Content(role=turn["role"], parts=[types.Part.from_text(text=turn["content"])])
+        for turn in history
+    ]
+    contents.append(types.Content(role="user", parts=[types.Part.from_text(text=prompt)]))
+    return contents
+
+
+class BackendClients:
+    """Point d'accès unique aux backends, partagé par `query_llm` et `transcribe_audio`."""
+
+    def __init__(self, gemini_api_key=None, model_name="gemini-2.0-flash", timeouts=None,
+                 max_retries=3, backoff_factor=0.5, jitter=0.5, pool_size=16):
+        self.gemini_api_key = gemini_api_key
+        self.model_name = model_name
+        self.timeouts = timeouts or load_timeouts()
+        self.max_retries = max_retries
+        self.jitter = jitter
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=build_retry(max_retries, backoff_factor, jitter),
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._gemini = None
+
+    # --- GEMINI ---
+    @property
+    def gemini(self):
+        if self._gemini is None:
+            if not self.gemini_api_key:
+                raise LLMError("Erreur : Clé API manquante.")
+            from google import genai
+            self._gemini = genai.Client(api_key=self.gemini_api_key, **self._gemini_http_options())
+        return self._gemini
+
+    def _gemini_http_options(self):
+        types = genai_types()
+        try:
+            retry = types.HttpRetryOptions(
+                attempts=self.max_retries + 1,
+                jitter=self.jitter,
+                http_status_codes=list(RETRY_STATUSES),
+            )
+            timeout_ms = int(sum(self.timeouts["generate"]) * 1000)
+            return {"http_options": types.HttpOptions(retry_options=retry, timeout=timeout_ms)}
+        except AttributeError:  # SDK trop ancien : retries par défaut
+            return {}
+
+    def _gemini_config(self, system_instruction, generation=None):
+        """`generation` : profil de l'étape (budget de tokens, séquences d'arrêt, schéma JSON)."""
+        generation = generation or {}
+        schema = generation.get("schema")
+        return genai_types().GenerateContentConfig(
+            system_instruction=system_instruction,
+            temperature=0.4,
+            max_output_tokens=generation.get("max_new_tokens") or 600,
+            stop_sequences=list(generation.get("stop") or [])[:GEMINI_MAX_STOP_SEQUENCES] or None,
+            response_mime_type="application/json" if schema else None,
+            response_schema=schema,
+        )
+
+    # --- KAGGLE / LOCAL URL ---
+    def _generate_payload(self, prompt, system_instruction, history, session_id, stream=False, generation=None):
+        payload = {
+            "prompt": prompt,
+            "system_instruction": system_instruction,
+            "history": history or [],
+            "session_id": session_id,
+        }
+        if generation:
+            payload["generation"] = generation
+        if stream:
+            payload["stream"] = True
+        return payload
+
+    @staticmethod
+    def _json(response):
+        """Corps JSON d'une réponse 200 ; un corps illisible (proxy, page d'erreur) lève `LLMError`."""
+        try:
+            return response.json()
+        except ValueError:
+            raise LLMError(f"Réponse invalide du serveur ({response.status_code}): {response.text[:200]}")
+
+    @staticmethod
+    def _endpoint(custom_url, route):
+        if not custom_url:
+            raise LLMError("Erreur : URL du serveur manquante.")
+        return f"{custom_url.rstrip('/')}/{route}"
+
+    # --- API ---
+    def generate(self, prompt, system_instruction, backend=GEMINI_BACKEND, custom_url=None,
+                 history=None, session_id=None, generation=None):
+        if backend == KAGGLE_BACKEND:
+            endpoint = self._endpoint(custom_url, "generate")
+            payload = self._generate_payload(prompt, system_instruction, history, session_id, generation=generation)
+            with tracer.span("POST /generate", kind="client", url=endpoint):
+                try:
+                    response = self.session.post(endpoint, json=payload, headers=tracer.inject(),
+                                                 timeout=self.timeouts["generate"])
+                except requests.exceptions.RequestException as e:
+                    raise LLMError(f"Erreur de connexion au serveur Kaggle : {str(e)}")
+                if response.status_code != 200:
+                    raise LLMError(f"Erreur Serveur ({response.status_code}): {response.text}")
+                data = self._json(response)
+                tracer.add_remote(data.get("trace"))
+            text = data.get("response")
+            if not text:
+                raise LLMError("Erreur: Réponse vide.")
+            return text
+
+        try:
+            with tracer.span("gemini generate_content", kind="client", model=self.model_name):
+                response = self.gemini.models.generate_content(
+                    model=self.model_name,
+                    contents=build_gemini_contents(prompt, history),
+                    config=self._gemini_config(system_instruction, generation),
+                )
+            return response.text
+        except LLMError:
+            raise
+        except Exception as e:
+            raise LLMError(f"Erreur API Gemini : {str(e)}")
+
+    def generate_stream(self, prompt, system_instruction, backend=GEMINI_BACKEND, custom_url=None,
+                        history=None, session_id=None, generation=None):
+        """Générateur de fragments de texte (server-sent events côté Kaggle)."""
+        if backend == KAGGLE_BACKEND:
+            endpoint = self._endpoint(custom_url, "generate")
+            payload = self._generate_payload(prompt, system_instruction, history, session_id, stream=True,
+                                             generation=generation)
+            try:
+                with tracer.span("POST /generate (stream)", kind="client", url=endpoint), \
+                        self.session.post(endpoint, json=payload, stream=True, headers=tracer.inject(),
+                                          timeout=self.timeouts["stream"]) as response:
+                    if response.status_code != 200:
+                        raise LLMError(f"Erreur Serveur ({response.status_code}): {response.text}")
+                    for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+                        if not line or not line.startswith("data: "):
+                            continue
+                        data = line[len("data: "):]
+                        if data == "[DONE]":
+                            return
+                        try:
+                            event = json.loads(data)
+                        except ValueError:
+                            raise LLMError(f"\n\nRéponse invalide du serveur : {data[:200]}")
+                        if "error" in event:
+                            raise LLMError(f"\n\nErreur Serveur : {event['error']}")
+                        tracer.add_remote(event.get("trace"))
+                        if event.get("token"):
+                            yield event["token"]
+            except requests.exceptions.RequestException as e:
+                raise LLMError(f"Erreur de connexion au serveur Kaggle : {str(e)}")
+            return
+
+        try:
+            with tracer.span("gemini generate_content_stream", kind="client", model=self.model_name):
+                for chunk in self.gemini.models.generate_content_stream(
+                    model=self.model_name,
+                    contents=build_gemini_contents(prompt, history),
+                    config=self._gemini_config(system_instruction, generation),
+                ):
+                    if chunk.text:
+                        yield chunk.text
+        except LLMError:
+            raise
+        except Exception as e:
+            raise LLMError(f"Erreur API Gemini : {str(e)}")
+
+    def prefill(self, system_instruction, history, custom_url, session_id):
+        """Pré-remplit côté Kaggle le cache KV de la session avec le contexte du prochain tour.
+
+        Aucun texte n'est généré : le tour suivant ne traitera plus que la nouvelle saisie.
+        Renvoie False si le backend ne le permet pas (serveur sans /prefill).
+        """
+        endpoint = self._endpoint(custom_url, "prefill")
+        payload = {"system_instruction": system_instruction, "history": history or [], "session_id": session_id}
+        with tracer.span("POST /prefill", kind="client", url=endpoint):
+            try:
+                response = self.session.post(endpoint, json=payload, headers=tracer.inject(),
+                                             timeout=self.timeouts["generate"])
+            except requests.exceptions.RequestException as e:
+                raise LLMError(f"Erreur de connexion au serveur Kaggle : {str(e)}")
+            if response.status_code == 404:
+                return False
+            if response.status_code != 200:
+                raise LLMError(f"Erreur Serveur ({response.status_code}): {response.text}")
+            data = self._json(response)
+            tracer.add_remote(data.get("trace"))
+        return bool(data.get("prefilled"))
+
+    def transcribe(self, audio_bytes, custom_url, filename="audio.wav", mimetype="audio/wav"):
+        """Envoie l'audio au endpoint /transcribe (MedASR) et renvoie la transcription."""
+        endpoint = self._endpoint(custom_url, "transcribe")
+        files = {'audio': (filename, audio_bytes, mimetype)}
+        with tracer.span("POST /transcribe", kind="client", url=endpoint, audio_bytes=len(audio_bytes)):
+            try:
+                response = self.session.post(endpoint, files=files, headers=tracer.inject(),
+                                             timeout=self.timeouts["transcribe"])
+            except requests.exceptions.RequestException as e:
+                raise LLMError(f"Erreur de connexion au serveur Kaggle : {str(e)}")
+            if response.status_code != 200:
+                raise LLMError(f"Erreur MedASR ({response.status_code}): {response.text}")
+            data = self._json(response)
+            tracer.add_remote(data.get("trace"))
+        return data.get("transcription")
+
+    def transcribe_stream(self, payload, custom_url, stream_id=None, offset=0, final=False):
+        """Envoie un morceau PCM au endpoint /transcribe_stream ; renvoie la réponse JSON
+        (`stream_id`, `transcription` partielle ou définitive si `final`)."""
+        endpoint = self._endpoint(custom_url, "transcribe_stream")
+        params = {"offset": offset}
+        if stream_id:
+            params["stream_id"] = stream_id
+        if final:
+            params["final"] = 1
+        with tracer.span("POST /transcribe_stream", kind="client", url=endpoint, final=bool(final)):
+            try:
+                response = self.session.post(endpoint, params=params, data=payload,
+                                             headers=tracer.inject({"Content-Type": "application/octet-stream"}),
+                                             timeout=self.timeouts["transcribe_stream"])
+            except requests.exceptions.RequestException as e:
+                raise LLMError(f"Erreur de connexion au serveur Kaggle : {str(e)}")
+            if response.status_code != 200:
+                raise LLMError(f"Erreur MedASR ({response.status_code}): {response.text}")
+            data = self._json(response)
+            tracer.add_remote(data.pop("trace", None))
+        return data
+
+    # --- ASYNCIO (appels en lot) ---
+    async def agenerate(self, prompt, system_instruction, backend=GEMINI_BACKEND, custom_url=None,
+                        history=None, session_id=None, semaphore=None, generation=None):
+        """Variante asyncio de `generate` ; `semaphore` borne les appels simultanés.
+
+        Gemini passe par le client asynchrone natif ; Kaggle réutilise la session poolée
+        dans un thread (le pool keep-alive est dimensionné par `pool_size`).
+        """
+        async with semaphore or asyncio.Semaphore(1):
+            if backend == KAGGLE_BACKEND:
+                return await asyncio.to_thread(
+                    self.generate, prompt, system_instruction, backend, custom_url, history, session_id, generation
+                )
+            try:
+                response = await self.gemini.aio.models.generate_content(
+                    model=self.model_name,
+                    contents=build_gemini_contents(prompt, history),
+                    config=self._gemini_config(system_instruction, generation),
+                )
+                return response.text
+            except LLMError:
+                raise
+            except Exception as e:
+                raise LLMError(f"Erreur API Gemini : {str(e)}")
+
+    async def agenerate_many(self, requests_kwargs, concurrency=8):
+        """Lance plusieurs `agenerate` en parallèle ; les erreurs sont renvoyées, pas levées."""
+        semaphore = asyncio.Semaphore(concurrency)
+        return await asyncio.gather(
+            *(self.agenerate(**kwargs, semaphore=semaphore) for kwargs in requests_kwargs),
+            return_exceptions=True,
+        )
+
+    def close(self):
+        self.session.close()
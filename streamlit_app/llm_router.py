@@ -0,0 +1,336 @@
+"""Routage multi-backends : le backend sain le plus rapide, doublon (hedging) et disjoncteur.
+
+Chaque route (serveur Kaggle/ngrok, serveur local, API Gemini) garde une fenêtre
+glissante de ses latences et de ses échecs. Une requête part vers la route saine la plus
+rapide ; si elle n'a pas répondu au-delà de son p95, un doublon part vers la suivante et
+la première réponse l'emporte. En flux, le p95 porte sur le délai du premier fragment.
+Après `BREAKER_FAILURES` échecs consécutifs, le disjoncteur écarte la route pendant
+`BREAKER_COOLDOWN_S`, puis une seule requête d'essai décide de sa remise en service.
+
+Le routeur a la même interface que `BackendClients` (`generate`, `generate_stream`) :
+cache, pré-calcul et traitement par lots l'utilisent sans changement.
+"""
+import contextvars
+import math
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from dataclasses import dataclass
+from datetime import datetime
+
+from llm_clients import LLMError, GEMINI_BACKEND, KAGGLE_BACKEND
+from tracing import tracer
+
+ROUTER_BACKEND = "Automatique (routeur)"
+ROUTER_WINDOW = int(os.getenv("MEDGEMMA_ROUTER_WINDOW", "50"))
+HEDGE_MIN_S = float(os.getenv("MEDGEMMA_HEDGE_MIN_S", "0.5"))
+HEDGE_DEFAULT_S = float(os.getenv("MEDGEMMA_HEDGE_DEFAULT_S", "5"))  # tant que l'historique est trop court
+HEDGE_MIN_SAMPLES = 5
+BREAKER_FAILURES = int(os.getenv("MEDGEMMA_BREAKER_FAILURES", "3"))
+BREAKER_COOLDOWN_S = float(os.getenv("MEDGEMMA_BREAKER_COOLDOWN_S", "30"))
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+@dataclass(frozen=True)
+class Route:
+    name: str
+    backend: str
+    url: str = None
+
+
+def build_routes(kaggle_urls=(), gemini=True):
+    """Routes dans l'ordre de préférence à latence égale : serveurs Kaggle, puis Gemini."""
+    urls = [url.strip() for url in kaggle_urls if url and url.strip()]
+    routes = [
+        Route("Kaggle" if len(urls) == 1 else f"Kaggle {i}", KAGGLE_BACKEND, url)
+        for i, url in enumerate(urls, 1)
+    ]
+    if gemini:
+        routes.append(Route("Gemini", GEMINI_BACKEND))
+    return routes
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(math.ceil(q / 100 * len(values))) - 1)]
+
+
+class RouteHealth:
+    """Latences et issues récentes d'une route, et état de son disjoncteur (thread-safe)."""
+
+    def __init__(self, window=ROUTER_WINDOW, failures_to_open=BREAKER_FAILURES, cooldown_s=BREAKER_COOLDOWN_S):
+        self.failures_to_open = failures_to_open
+        self.cooldown_s = cooldown_s
+        # Latences des succès, séparées : réponse complète (`generate`) et premier fragment (`stream`).
+        self.latencies = {"generate": deque(maxlen=window), "stream": deque(maxlen=window)}
+        self.outcomes = deque(maxlen=window)
+        self.consecutive_failures = 0
+        self.state = CLOSED
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def available(self):
+        """Candidate au routage : fermée, ou ouverte depuis plus de `cooldown_s` (essai possible)."""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                return time.monotonic() - self.opened_at >= self.cooldown_s
+            return not self._probing
+
+    def begin(self):
+        """Réserve l'envoi ; en demi-ouverture, une seule requête d'essai à la fois."""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self.opened_at < self.cooldown_s:
+                return False
+            if self._probing:
+                return False
+            self.state, self._probing = HALF_OPEN, True
+            return True
+
+    def record(self, kind, latency_s, ok):
+        with self._lock:
+            self.outcomes.append(ok)
+            self._probing = False
+            if ok:
+                self.latencies[kind].append(latency_s)
+                self.consecutive_failures = 0
+                self.state = CLOSED
+                return
+            self.consecutive_failures += 1
+            if self.state == HALF_OPEN or self.consecutive_failures >= self.failures_to_open:
+                self.state, self.opened_at = OPEN, time.monotonic()
+
+    def release(self):
+        """Essai abandonné sans résultat (doublon devenu inutile) : la route reste à tester."""
+        with self._lock:
+            if self.state == HALF_OPEN and self._probing:
+                self._probing = False
+
+    def expected_latency(self, kind):
+        with self._lock:
+            return percentile(list(self.latencies[kind]), 50)
+
+    def hedge_delay(self, kind):
+        """Délai avant doublon : p95 de la route (borné), ou défaut sans historique suffisant."""
+        with self._lock:
+            values = list(self.latencies[kind])
+        if len(values) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_S
+        return max(HEDGE_MIN_S, percentile(values, 95))
+
+    def summary(self):
+        with self._lock:
+            stats = {"state": self.state, "requests": len(self.outcomes),
+                     "error_rate": (self.outcomes.count(False) / len(self.outcomes)) if self.outcomes else 0.0}
+            for kind, values in self.latencies.items():
+                stats[f"{kind}_p50_s"] = percentile(list(values), 50)
+                stats[f"{kind}_p95_s"] = percentile(list(values), 95)
+            return stats
+
+
+class LLMRouter:
+    """Envoie chaque requête vers la route saine la plus rapide, avec doublon et disjoncteur."""
+
+    def __init__(self, clients, routes, hedge=True, max_workers=64, max_decisions=20):
+        if not routes:
+            raise ValueError("Aucune route configurée")
+        self.clients = clients
+        self.routes = list(routes)
+        self.health = {route.name: RouteHealth() for route in self.routes}
+        self.hedge = hedge
+        self.model_name = clients.model_name
+        self.decisions = deque(maxlen=max_decisions)
+        # Les doublons perdants finissent en arrière-plan : pool large pour ne pas bloquer les suivants.
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="router")
+
+    def ranked(self, kind):
+        """Routes candidates, la plus rapide d'abord (sans historique : en tête, pour la mesurer)."""
+        candidates = [route for route in self.routes if self.health[route.name].available()]
+        if not candidates:
+            raise LLMError("Erreur : aucun backend disponible (disjoncteurs ouverts), réessayez dans un instant.")
+        order = {route.name: i for i, route in enumerate(self.routes)}
+        return sorted(candidates, key=lambda r: (self.health[r.name].expected_latency(kind) or 0.0, order[r.name]))
+
+    def preferred_url(self):
+        """URL du serveur Kaggle le mieux classé (transcription, pré-remplissage), ou None."""
+        try:
+            routes = self.ranked("generate")
+        except LLMError:
+            return None
+        return next((route.url for route in routes if route.backend == KAGGLE_BACKEND), None)
+
+    def _log(self, kind, primary, start, winner=None, hedged=None, errors=()):
+        self.decisions.appendleft({
+            "at": datetime.now().strftime("%H:%M:%S"),
+            "kind": kind,
+            "primary": primary.name,
+            "hedged": hedged.name if hedged else None,
+            "winner": winner.name if winner else None,
+            "latency_s": time.perf_counter() - start,
+            "errors": list(errors),
+        })
+
+    def _submit(self, fn, *args):
+        """Soumission au pool dans une copie du contexte courant : les appels concurrents
+        (doublons compris) restent rattachés au span de l'appelant."""
+        return self._pool.submit(contextvars.copy_context().run, fn, *args)
+
+    # --- API (même signature que BackendClients ; `backend` et `custom_url` sont ignorés) ---
+    def generate(self, prompt, system_instruction, backend=None, custom_url=None,
+                 history=None, session_id=None, generation=None):
+        routes = self.ranked("generate")
+        primary, remaining = routes[0], routes[1:]
+        start = time.perf_counter()
+        hedge_at = start + self.health[primary.name].hedge_delay("generate")
+        hedged, errors = None, []
+
+        def call(route):
+            health = self.health[route.name]
+            if not health.begin():
+                raise LLMError("disjoncteur ouvert")
+            t = time.perf_counter()
+            try:
+                with tracer.span("router.attempt", route=route.name, hedged=route is hedged):
+                    text = self.clients.generate(prompt, system_instruction, route.backend, route.url,
+                                                 history, session_id, generation)
+            except Exception:
+                health.record("generate", time.perf_counter() - t, ok=False)
+                raise
+            health.record("generate", time.perf_counter() - t, ok=True)
+            return text
+
+        pending = {self._submit(call, primary): primary}
+        while pending:
+            timeout = None
+            if self.hedge and remaining and hedged is None:
+                timeout = max(0.0, hedge_at - time.perf_counter())
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                # p95 dépassé : doublon vers la route suivante, la première réponse gagne.
+                hedged = remaining.pop(0)
+                pending[self._submit(call, hedged)] = hedged
+                continue
+            for future in done:
+                route = pending.pop(future)
+                try:
+                    text = future.result()
+                except Exception as e:
+                    errors.append(f"{route.name} : {e}")
+                    continue
+                self._log("generate", primary, start, route, hedged, errors)
+                return text
+            if not pending and remaining:
+                # Échec sans doublon en cours : bascule immédiate vers la route suivante.
+                route = remaining.pop(0)
+                pending[self._submit(call, route)] = route
+        self._log("generate", primary, start, hedged=hedged, errors=errors)
+        raise LLMError("Erreur : aucun backend n'a répondu.\n" + "\n".join(errors))
+
+    def generate_stream(self, prompt, system_instruction, backend=None, custom_url=None,
+                        history=None, session_id=None, generation=None):
+        """Flux de la première route qui produit un fragment ; les autres sont abandonnées.
+
+        Une erreur après le premier fragment est remontée telle quelle : le texte déjà
+        affiché ne peut pas être repris sur une autre route.
+        """
+        routes = self.ranked("stream")
+        primary, remaining = routes[0], routes[1:]
+        start = time.perf_counter()
+        hedge_at = start + self.health[primary.name].hedge_delay("stream")
+        events = queue.Queue()
+        stops = {}
+        hedged, winner, errors = None, None, []
+
+        def run(route, stop):
+            health = self.health[route.name]
+            if not health.begin():
+                events.put((route, "error", "disjoncteur ouvert"))
+                return
+            t = time.perf_counter()
+            first = True
+            with tracer.span("router.attempt", route=route.name, hedged=route is hedged):
+                chunks = self.clients.generate_stream(prompt, system_instruction, route.backend, route.url,
+                                                      history, session_id, generation)
+                try:
+                    for chunk in chunks:
+                        if first:
+                            health.record("stream", time.perf_counter() - t, ok=True)
+                            first = False
+                        if stop.is_set():
+                            return
+                        events.put((route, "chunk", chunk))
+                    if first:
+                        health.record("stream", time.perf_counter() - t, ok=True)
+                    events.put((route, "done", None))
+                except Exception as e:
+                    if stop.is_set() and first:
+                        health.release()
+                    elif not stop.is_set():
+                        health.record("stream", time.perf_counter() - t, ok=False)
+                    events.put((route, "error", str(e)))
+                finally:
+                    chunks.close()  # ferme la connexion HTTP d'un flux abandonné
+
+        def launch(route):
+            stops[route.name] = threading.Event()
+            self._submit(run, route, stops[route.name])
+
+        launch(primary)
+        live = 1
+        try:
+            while True:
+                timeout = None
+                if winner is None and self.hedge and remaining and hedged is None:
+                    timeout = max(0.0, hedge_at - time.perf_counter())
+                try:
+                    route, kind, payload = events.get(timeout=timeout)
+                except queue.Empty:
+                    hedged = remaining.pop(0)
+                    launch(hedged)
+                    live += 1
+                    continue
+                if winner is not None and route != winner:
+                    continue
+                if winner is None and kind in ("chunk", "done"):
+                    winner = route
+                    for name, stop in stops.items():
+                        if name != route.name:
+                            stop.set()
+                    self._log("stream", primary, start, winner, hedged, errors)
+                if kind == "chunk":
+                    yield payload
+                elif kind == "done":
+                    return
+                elif winner is not None:
+                    raise LLMError(payload)
+                else:
+                    errors.append(f"{route.name} : {payload}")
+                    live -= 1
+                    if live == 0 and remaining:
+                        launch(remaining.pop(0))
+                        live += 1
+                    elif live == 0:
+                        self._log("stream", primary, start, hedged=hedged, errors=errors)
+                        raise LLMError("Erreur : aucun backend n'a répondu.\n" + "\n".join(errors))
+        finally:
+            for stop in stops.values():
+                stop.set()
+
+    def summary(self):
+        return {route.name: {"backend": route.backend, **self.health[route.name].summary()}
+                for route in self.routes}
+
+    def close(self):
+        """Arrête le pool et ferme les clients (routeur propriétaire, ex: traitement par lots)."""
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        self.clients.close()
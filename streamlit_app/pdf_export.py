@@ -0,0 +1,199 @@
+"""Export en lot des rapports de triage en PDF, rendus en parallèle (pool de processus).
+
+Entrée JSONL, un rapport par ligne (mêmes champs que la session Streamlit) :
+
+    {"id": "A12", "final_report": "...", "generated_at": "2026-10-17T09:30:00",
+     "initial_data": {"age": 45, "sexe": "Féminin", "symptoms": ["Fièvre"], "description": "..."}}
+
+Les PDF sont écrits au fil de l'eau dans une archive .zip ou un dossier, avec un nombre
+borné de lots en vol (mémoire constante quelle que soit la taille de l'entrée).
+
+    python pdf_export.py rapports.jsonl -o rapports.zip --workers 8
+    python pdf_export.py --benchmark 500 --workers 0 1 2 4 8
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from pdf_report import create_pdf
+
+DEFAULT_CHUNK_SIZE = 16
+
+
+def iter_records(path):
+    """Lit le JSONL ligne à ligne (`-` = entrée standard) ; les cas en erreur de batch_triage sont ignorés."""
+    handle = sys.stdin if path == "-" else open(path, encoding="utf-8")
+    try:
+        for line in handle:
+            if line.strip():
+                record = json.loads(line)
+                if record.get("status", "ok") == "ok":
+                    yield record
+    finally:
+        if handle is not sys.stdin:
+            handle.close()
+
+
+def record_filename(record, index):
+    name = re.sub(r"[^\w.-]+", "_", str(record.get("id") or f"rapport_{index:06d}"))
+    return f"{name}.pdf"
+
+
+def render_record(record, index=0):
+    """(nom de fichier, octets du PDF) pour un enregistrement."""
+    generated_at = record.get("generated_at")
+    generated_at = datetime.fromisoformat(generated_at) if generated_at else datetime.now()
+    report = record.get("report") or record.get("final_report", "")  # rapport structuré de préférence
+    pdf_bytes = create_pdf(report, record.get("initial_data", {}), generated_at)
+    return record_filename(record, index), pdf_bytes
+
+
+def render_chunk(chunk):
+    """Unité de travail d'un processus : plusieurs rapports par aller-retour (moins de pickling)."""
+    return [render_record(record, index) for index, record in chunk]
+
+
+def chunked(records, size):
+    chunk = []
+    for index, record in enumerate(records):
+        chunk.append((index, record))
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class ReportWriter:
+    """Destination des PDF : archive zip (PDF déjà compressés → stockés tels quels) ou dossier."""
+
+    def __init__(self, output):
+        self.output = output
+        self.is_zip = output.endswith(".zip")
+        self._names = set()
+        if self.is_zip:
+            self._zip = zipfile.ZipFile(output, "w", compression=zipfile.ZIP_STORED)
+        else:
+            os.makedirs(output, exist_ok=True)
+
+    def _unique(self, name):
+        base, ext = os.path.splitext(name)
+        candidate, n = name, 1
+        while candidate in self._names:
+            candidate, n = f"{base}_{n}{ext}", n + 1
+        self._names.add(candidate)
+        return candidate
+
+    def write(self, name, data):
+        name = self._unique(name)
+        if self.is_zip:
+            self._zip.writestr(name, data)
+        else:
+            with open(os.path.join(self.output, name), "wb") as f:
+                f.write(data)
+
+    def close(self):
+        if self.is_zip:
+            self._zip.close()
+
+
+def export_reports(records, output, workers=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Rend `records` (itérable) en PDF vers `output` (.zip ou dossier) ; renvoie les statistiques.
+
+    `workers=0` : rendu dans le processus courant (référence sans pool).
+    """
+    workers = os.cpu_count() if workers is None else workers
+    writer = ReportWriter(output)
+    stats = {"reports": 0, "bytes": 0, "workers": workers}
+    start = time.perf_counter()
+
+    def consume(results):
+        for name, data in results:
+            writer.write(name, data)
+            stats["reports"] += 1
+            stats["bytes"] += len(data)
+
+    try:
+        if workers == 0:
+            for chunk in chunked(records, chunk_size):
+                consume(render_chunk(chunk))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                in_flight = deque()
+                for chunk in chunked(records, chunk_size):
+                    in_flight.append(pool.submit(render_chunk, chunk))
+                    if len(in_flight) >= 2 * workers:  # borne la mémoire, garde l'ordre d'entrée
+                        consume(in_flight.popleft().result())
+                while in_flight:
+                    consume(in_flight.popleft().result())
+    finally:
+        writer.close()
+    stats["seconds"] = time.perf_counter() - start
+    stats["reports_per_s"] = stats["reports"] / stats["seconds"] if stats["seconds"] else 0.0
+    return stats
+
+
+def synthetic_records(count):
+    """Rapports représentatifs (longueur et accents d'un vrai rapport) pour le benchmark."""
+    report = (
+        "1. Niveau d'urgence : Moyen.\n"
+        "2. Causes possibles : infection virale bénigne, bronchite, à confirmer par un médecin.\n"
+        "3. Actions immédiates : repos, hydratation, paracétamol si fièvre > 38,5 °C.\n"
+        "4. Consultation : dans les 24 heures, ou immédiatement si gêne respiratoire (15/112).\n"
+    ) * 3
+    for i in range(count):
+        yield {
+            "id": f"bench_{i:06d}",
+            "final_report": report,
+            "generated_at": "2026-01-01T09:00:00",
+            "initial_data": {
+                "age": 20 + i % 60, "sexe": "Féminin" if i % 2 else "Masculin",
+                "symptoms": ["Fièvre", "Toux", "Fatigue"],
+                "description": "Toux sèche depuis trois jours, fièvre le soir.",
+            },
+        }
+
+
+def run_benchmark(count, workers_list, chunk_size=DEFAULT_CHUNK_SIZE):
+    print(f"{'workers':>8}{'rapports':>10}{'durée (s)':>11}{'rapports/s':>12}{'Mo/s':>8}")
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for workers in workers_list:
+            stats = export_reports(synthetic_records(count), os.path.join(tmp, f"bench_{workers}.zip"),
+                                   workers=workers, chunk_size=chunk_size)
+            results.append(stats)
+            print(f"{workers:>8}{stats['reports']:>10}{stats['seconds']:>11.2f}"
+                  f"{stats['reports_per_s']:>12.1f}{stats['bytes'] / stats['seconds'] / 2**20:>8.2f}")
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export en lot des rapports de triage en PDF.")
+    parser.add_argument("input", nargs="?", help="fichier JSONL des rapports (- = entrée standard)")
+    parser.add_argument("-o", "--output", default="rapports.zip", help="archive .zip ou dossier de sortie")
+    parser.add_argument("--workers", type=int, nargs="+", default=[os.cpu_count()],
+                        help="processus de rendu (0 = sans pool) ; plusieurs valeurs en benchmark")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="rapports par tâche")
+    parser.add_argument("--benchmark", type=int, metavar="N", help="rend N rapports synthétiques et mesure le débit")
+    args = parser.parse_args(argv)
+
+    if args.benchmark:
+        run_benchmark(args.benchmark, args.workers, args.chunk_size)
+        return
+    if not args.input:
+        parser.error("fichier d'entrée requis (ou --benchmark N)")
+    stats = export_reports(iter_records(args.input), args.output, args.workers[0], args.chunk_size)
+    print(f"✅ {stats['reports']} rapports → {args.output} en {stats['seconds']:.2f} s "
+          f"({stats['reports_per_s']:.1f} rapports/s)")
+
+
+if __name__ == "__main__":
+    main()
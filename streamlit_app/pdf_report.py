@@ -0,0 +1,148 @@
+"""Rapport de triage au format PDF (FPDF), avec mémoïsation par empreinte du contenu.
+
+Le document ne dépend que du rapport, des données patient et de la date affichée :
+deux rendus au contenu identique (ex: reruns Streamlit de l'étape 3) renvoient les
+mêmes octets sans reconstruire le PDF.
+"""
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+from fpdf import FPDF
+
+from structured_report import EMERGENCY_LINE, report_sections
+
+PDF_CACHE_SIZE = int(os.getenv("MEDGEMMA_PDF_CACHE_SIZE", "64"))
+
+
+# --- PDF Generation Class ---
+class MedGemmaPDF(FPDF):
+    def header(self):
+        self.set_font('Arial', 'B', 15)
+        self.cell(0, 10, 'Rapport de Triage MedGemma', 0, 1, 'C')
+        self.ln(5)
+
+    def footer(self):
+        self.set_y(-15)
+        self.set_font('Arial', 'I', 8)
+        self.cell(0, 10, f'Page {self.page_no()}', 0, 0, 'C')
+        self.cell(0, 10, 'Généré par MedGemma - Prototype IA', 0, 0, 'R')
+
+
+def latin1(text):
+    """Nettoyage basique des caractères non supportés par latin-1 (polices PDF de base)."""
+    return text.encode('latin-1', 'replace').decode('latin-1')
+
+
+def write_structured_report(pdf, report):
+    """Rubriques du rapport structuré (voir structured_report.py), mises en forme localement."""
+    if report["emergency"]:
+        pdf.set_font("Arial", 'B', 11)
+        pdf.set_text_color(200, 0, 0)
+        pdf.multi_cell(0, 6, EMERGENCY_LINE)
+        pdf.set_text_color(0, 0, 0)
+        pdf.ln(2)
+    for title, value in report_sections(report):
+        pdf.set_font("Arial", 'B', 11)
+        if isinstance(value, list):
+            pdf.cell(0, 6, f"{title} :", 0, 1)
+            pdf.set_font("Arial", size=11)
+            for item in value:
+                pdf.multi_cell(0, 6, latin1(f"  - {item}"))
+        else:
+            pdf.cell(pdf.get_string_width(f"{title} : ") + 1, 6, f"{title} : ", 0, 0)
+            pdf.set_font("Arial", size=11)
+            pdf.multi_cell(0, 6, latin1(value))
+        pdf.ln(1)
+
+
+def create_pdf(report_text, patient_data, generated_at=None):
+    """Génère un PDF simple avec le rapport (texte libre, ou objet du rapport structuré).
+    `generated_at` : date affichée (défaut : maintenant)."""
+    generated_at = generated_at or datetime.now()
+    pdf = MedGemmaPDF()
+    pdf.add_page()
+
+    # Méta-données
+    pdf.set_font("Arial", size=10)
+    pdf.cell(0, 5, f"Date: {generated_at.strftime('%d/%m/%Y %H:%M')}", 0, 1)
+    pdf.ln(5)
+
+    # Info Patient
+    pdf.set_font("Arial", 'B', 12)
+    pdf.cell(0, 8, "Informations Patient", 0, 1)
+    pdf.set_font("Arial", size=11)
+    pdf.cell(0, 6, f"Age: {patient_data.get('age')} ans", 0, 1)
+    pdf.cell(0, 6, f"Sexe: {patient_data.get('sexe')}", 0, 1)
+
+    # Symptomes
+    symptoms_list = ", ".join(patient_data.get('symptoms', []))
+    pdf.multi_cell(0, 6, f"Symptômes: {symptoms_list}")
+    if patient_data.get('description'):
+         pdf.multi_cell(0, 6, f"Description: {patient_data.get('description')}")
+    pdf.ln(5)
+
+    # Rapport LLM
+    pdf.set_font("Arial", 'B', 12)
+    pdf.cell(0, 8, "Analyse & Recommandations", 0, 1)
+    pdf.set_font("Arial", size=11)
+
+    if isinstance(report_text, dict):
+        write_structured_report(pdf, report_text)
+    else:
+        pdf.multi_cell(0, 6, latin1(report_text))
+
+    # Disclaimer
+    pdf.ln(10)
+    pdf.set_font("Arial", 'I', 9)
+    pdf.set_text_color(200, 0, 0)
+    pdf.multi_cell(0, 5, "AVERTISSEMENT: Ce rapport est généré par une IA (Gemma 2b / Gemini). Il ne remplace pas un avis médical professionnel. En cas d'urgence, appelez le 15 ou le 112.")
+
+    return pdf.output(dest='S').encode('latin-1')
+
+
+def report_key(report_text, patient_data, generated_at):
+    """Empreinte SHA-256 de tout ce qui apparaît dans le PDF (date à la minute près)."""
+    payload = {
+        "report": report_text,
+        "patient": {k: list(v) if isinstance(v, set) else v for k, v in patient_data.items()},
+        "date": generated_at.strftime('%d/%m/%Y %H:%M'),
+    }
+    encoded = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+class PdfCache:
+    """LRU borné : empreinte du contenu → octets du PDF (partagé entre sessions, thread-safe)."""
+
+    def __init__(self, max_entries=PDF_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.stats = {"hits": 0, "misses": 0}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def render(self, report_text, patient_data, generated_at):
+        key = report_key(report_text, patient_data, generated_at)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return self._entries[key]
+            self.stats["misses"] += 1
+        pdf_bytes = create_pdf(report_text, patient_data, generated_at)
+        with self._lock:
+            self._entries[key] = pdf_bytes
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return pdf_bytes
+
+
+_default_cache = PdfCache()
+
+
+def cached_pdf(report_text, patient_data, generated_at):
+    """`create_pdf` mémoïsé : même contenu → mêmes octets, sans nouveau rendu."""
+    return _default_cache.render(report_text, patient_data, generated_at)
@@ -0,0 +1,94 @@
+"""Exécution spéculative en arrière-plan pour le parcours de triage.
+
+Dès que les entrées d'une étape sont stables, l'appel LLM de l'étape suivante part dans
+un thread ; au clic, le résultat est repris immédiatement (ou attendu s'il est en cours,
+ce qui reste plus court qu'un nouvel appel). Chaque « slot » (ex: "questions") n'a
+qu'une tâche courante : une nouvelle saisie la remplace. Une tâche remplacée pendant
+son délai de stabilisation est annulée avant tout appel réseau ; au-delà, son résultat
+est simplement ignoré (il reste disponible dans le cache des réponses).
+"""
+import hashlib
+import json
+import os
+import threading
+
+SETTLE_S = float(os.getenv("MEDGEMMA_PREFETCH_SETTLE_S", "0.5"))
+
+
+def task_key(*parts):
+    """Empreinte stable des entrées d'une tâche spéculative."""
+    payload = json.dumps(parts, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class Prefetcher:
+    """Une tâche spéculative par slot, exécutée sur un pool de threads partagé.
+
+    Les fonctions lancées ne doivent pas appeler Streamlit (pas de contexte de script
+    dans les threads) : on leur passe les clients / caches déjà résolus.
+    """
+
+    def __init__(self, executor, settle_s=SETTLE_S):
+        self.executor = executor
+        self.settle_s = settle_s
+        self.stats = {"started": 0, "superseded": 0, "hits": 0, "misses": 0}
+        self._tasks = {}  # slot -> (clé, future, évènement d'annulation)
+        self._lock = threading.Lock()
+
+    def speculate(self, slot, key, fn, *args, **kwargs):
+        """Lance `fn(*args, **kwargs)` pour `key`, sauf si c'est déjà la tâche courante du slot."""
+        with self._lock:
+            current = self._tasks.get(slot)
+            if current is not None and current[0] == key:
+                return current[1]
+            if current is not None:
+                self._cancel(current)
+                self.stats["superseded"] += 1
+            cancel = threading.Event()
+            future = self.executor.submit(self._run, cancel, fn, args, kwargs)
+            self._tasks[slot] = (key, future, cancel)
+            self.stats["started"] += 1
+            return future
+
+    def take(self, slot, key, timeout=None):
+        """Résultat spéculé pour `key` (attendu s'il est en cours) ; None si absent ou en échec."""
+        with self._lock:
+            current = self._tasks.get(slot)
+        if current is None or current[0] != key:
+            self.stats["misses"] += 1
+            return None
+        try:
+            result = current[1].result(timeout=timeout)
+        except Exception:
+            result = None
+        self.stats["hits" if result is not None else "misses"] += 1
+        return result
+
+    def status(self, slot, key):
+        """"ready", "running" ou None : pour indiquer dans l'interface ce qui est déjà prêt."""
+        with self._lock:
+            current = self._tasks.get(slot)
+        if current is None or current[0] != key:
+            return None
+        return "ready" if current[1].done() else "running"
+
+    def cancel(self, slot=None):
+        """Abandonne la tâche d'un slot (ou de tous)."""
+        with self._lock:
+            slots = [slot] if slot is not None else list(self._tasks)
+            for name in slots:
+                task = self._tasks.pop(name, None)
+                if task is not None:
+                    self._cancel(task)
+
+    @staticmethod
+    def _cancel(task):
+        _, future, cancel = task
+        cancel.set()
+        future.cancel()
+
+    def _run(self, cancel, fn, args, kwargs):
+        # Délai de stabilisation : une saisie qui change encore annule avant l'appel réseau.
+        if cancel.wait(self.settle_s):
+            return None
+        return fn(*args, **kwargs)
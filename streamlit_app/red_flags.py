@@ -0,0 +1,349 @@
+"""Pré-triage instantané par règles : signes d'alerte vitale repérés avant tout appel LLM.
+
+Un automate d'Aho-Corasick, compilé une fois sur un lexique FR/EN de signes d'alerte,
+parcourt la saisie de l'étape 1 en un seul passage (quelques dizaines de microsecondes
+pour une description courante). Texte et lexique sont normalisés de la même façon
+(minuscules, sans accents, ponctuation → séparateur) et les termes ne correspondent qu'à
+des mots entiers ; un terme précédé d'une négation dans la même proposition
+(« pas de », « sans », « no »…) est ignoré.
+
+Chaque terme a une catégorie et un poids : 2 = urgence à lui seul, 1 = signe qui devient
+une urgence associé à un signe différent de la même catégorie (douleur thoracique + bras
+gauche engourdi). Un signe isolé de poids 1 donne une simple mise en garde. Poids 0 :
+symptôme trop courant pour alerter seul (fièvre), qui ne compte qu'à côté d'un signe de
+poids 1 de la même catégorie (fièvre + nuque raide).
+
+    python red_flags.py "Douleur thoracique, et mon bras gauche est engourdi"
+    python red_flags.py --benchmark
+"""
+import argparse
+import random
+import re
+import sys
+import time
+import unicodedata
+from collections import deque
+from dataclasses import dataclass, field
+
+EMERGENCY, WARNING = "emergency", "warning"
+
+CATEGORY_LABELS = {
+    "cardiaque": "atteinte cardiaque",
+    "avc": "AVC",
+    "respiratoire": "détresse respiratoire",
+    "hemorragie": "hémorragie",
+    "conscience": "trouble de la conscience",
+    "anaphylaxie": "réaction allergique grave",
+    "meningite": "méningite",
+    "psychiatrique": "risque suicidaire ou intoxication",
+}
+
+# (catégorie, poids, termes). Amorcé avec les symptômes prédéfinis de l'app (Douleur
+# thoracique, Essoufflement, Vertiges, Fièvre) et le cas critique de prompt_engineering.py.
+LEXICON = [
+    ("cardiaque", 2, [
+        "arrêt cardiaque", "crise cardiaque", "infarctus", "arrêt du cœur", "douleur thoracique écrasante",
+        "douleur écrasante", "heart attack", "cardiac arrest", "crushing pain", "crushing chest pain",
+    ]),
+    ("cardiaque", 1, [
+        "douleur thoracique", "douleur à la poitrine", "douleur dans la poitrine", "mal à la poitrine",
+        "oppression thoracique", "serrement dans la poitrine", "poitrine serrée", "bras gauche",
+        "engourdissement du bras", "douleur dans la mâchoire", "sueurs froides", "essoufflement",
+        "chest pain", "pain in my chest", "chest tightness", "tight chest", "left arm", "arm is numb",
+        "jaw pain", "cold sweat", "shortness of breath",
+    ]),
+    ("avc", 2, [
+        "avc", "accident vasculaire", "paralysie", "paralysé", "paralysée", "bouche de travers",
+        "visage qui tombe", "n'arrive plus à parler", "ne peut plus parler", "difficulté à parler",
+        "stroke", "face drooping", "slurred speech", "paralysis", "paralyzed", "can't speak",
+    ]),
+    ("avc", 1, [
+        "engourdissement", "faiblesse d'un côté", "perte de la vue", "vision trouble soudaine",
+        "pire mal de tête", "mal de tête brutal", "maux de tête violents", "confusion",
+        "numbness", "weakness on one side", "worst headache", "sudden vision loss",
+    ]),
+    ("respiratoire", 2, [
+        "ne respire plus", "ne peut plus respirer", "n'arrive pas à respirer", "n'arrive plus à respirer",
+        "je m'étouffe", "s'étouffe", "lèvres bleues", "can't breathe", "cannot breathe", "not breathing",
+        "choking", "blue lips",
+    ]),
+    ("respiratoire", 1, [
+        "essoufflement", "difficulté à respirer", "difficultés à respirer", "gêne respiratoire",
+        "respiration sifflante", "shortness of breath", "short of breath", "difficulty breathing", "wheezing",
+    ]),
+    ("hemorragie", 2, [
+        "hémorragie", "saigne abondamment", "saignement abondant", "saignement qui ne s'arrête pas",
+        "vomit du sang", "vomissements de sang", "crache du sang", "severe bleeding", "heavy bleeding",
+        "bleeding heavily", "vomiting blood", "coughing up blood",
+    ]),
+    ("hemorragie", 1, ["saignement", "sang dans les selles", "bleeding", "blood in stool"]),
+    ("conscience", 2, [
+        "perte de connaissance", "sans connaissance", "inconscient", "inconsciente", "évanoui", "évanouie",
+        "convulsions", "crise d'épilepsie", "ne se réveille pas", "unconscious", "fainted", "passed out",
+        "seizure", "unresponsive",
+    ]),
+    ("conscience", 1, ["vertiges", "malaise", "confusion", "dizziness", "confused"]),
+    ("anaphylaxie", 2, [
+        "gonflement de la gorge", "gorge qui gonfle", "langue gonflée", "choc anaphylactique",
+        "anaphylaxie", "throat swelling", "swollen throat", "swollen tongue", "anaphylaxis",
+    ]),
+    ("anaphylaxie", 1, ["urticaire", "gonflement du visage", "hives", "swollen face"]),
+    ("meningite", 2, ["purpura", "taches violacées", "taches qui ne s'effacent pas"]),
+    ("meningite", 1, ["raideur de la nuque", "nuque raide", "stiff neck"]),
+    ("meningite", 0, ["fièvre", "mal de tête", "maux de tête", "fever", "headache"]),
+    ("psychiatrique", 2, [
+        "idées suicidaires", "envie de mourir", "me suicider", "suicide", "suicidal", "kill myself",
+        "overdose", "surdose",
+    ]),
+]
+
+NEGATIONS = frozenset({"pas", "sans", "aucun", "aucune", "ni", "jamais", "no", "not", "without", "never", "denies"})
+CLAUSE_BREAKS = frozenset({"mais", "et", "avec", "puis", "but", "and", "with", "then"})
+NEGATION_WINDOW = 4  # mots examinés avant le terme
+
+# Table d'octets : lettres et chiffres gardés, ponctuation de phrase → `|`, reste → espace.
+_WORD_CHARS = b"abcdefghijklmnopqrstuvwxyz0123456789"
+_TABLE = bytes(
+    c if c in _WORD_CHARS else ord("|") if chr(c) in ".,;:!?()[]\n\r" else ord(" ") for c in range(256)
+)
+
+
+def normalize(text):
+    """Mots en minuscules sans accents ; ponctuation de phrase → mot `|` (fin de proposition)."""
+    text = text.lower()
+    if not text.isascii():
+        text = unicodedata.normalize("NFKD", text.replace("œ", "oe").replace("æ", "ae"))
+    return text.encode("ascii", "ignore").translate(_TABLE).replace(b"|", b" | ").decode("ascii").split()
+
+
+class AhoCorasick:
+    """Automate multi-motifs sur des suites de mots, avec table de transitions complète.
+
+    Travailler mot à mot plutôt que caractère par caractère divise le nombre de pas par
+    la longueur moyenne d'un mot, et un mot absent du lexique ramène directement à la
+    racine : seules les suites de mots connus sont parcourues.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = [tuple(pattern) for pattern in patterns]
+        self.vocab = {}
+        for pattern in self.patterns:
+            for word in pattern:
+                self.vocab.setdefault(word, len(self.vocab))
+        goto, out = [{}], [[]]
+        for index, pattern in enumerate(self.patterns):
+            node = 0
+            for code in map(self.vocab.__getitem__, pattern):
+                if code not in goto[node]:
+                    goto.append({})
+                    out.append([])
+                    goto[node][code] = len(goto) - 1
+                node = goto[node][code]
+            out[node].append(index)
+
+        # Parcours en largeur : liens d'échec, puis transitions manquantes complétées.
+        fail = [0] * len(goto)
+        delta = [None] * len(goto)
+        delta[0] = [goto[0].get(code, 0) for code in range(len(self.vocab))]
+        pending = deque(goto[0].values())
+        while pending:
+            node = pending.popleft()
+            out[node].extend(out[fail[node]])
+            delta[node] = [goto[node].get(code, delta[fail[node]][code]) for code in range(len(self.vocab))]
+            for code, child in goto[node].items():
+                fail[child] = delta[fail[node]][code]
+                pending.append(child)
+        self._delta = delta
+        self._out = [tuple(o) for o in out]
+
+    def finditer(self, words):
+        """`(indice du dernier mot, indice du motif)` pour chaque occurrence (chevauchements compris)."""
+        delta, out, vocab = self._delta, self._out, self.vocab
+        node, previous = 0, -2
+        # Filtrage en compréhension (rapide) : seuls les mots du lexique entrent dans la boucle.
+        for i, code in [(i, vocab[w]) for i, w in enumerate(words) if w in vocab]:
+            if i != previous + 1:
+                node = 0  # un mot inconnu s'intercalait : retour à la racine
+            previous = i
+            node = delta[node][code]
+            if out[node]:
+                for index in out[node]:
+                    yield i, index
+
+
+@dataclass(frozen=True)
+class RedFlag:
+    term: str
+    category: str
+    weight: int
+
+
+@dataclass
+class Assessment:
+    level: str = None                               # EMERGENCY, WARNING ou None
+    flags: list = field(default_factory=list)       # RedFlag retenus (hors négations)
+    categories: list = field(default_factory=list)  # catégories en urgence
+
+    @property
+    def is_emergency(self):
+        return self.level == EMERGENCY
+
+    def reasons(self):
+        """Résumé lisible : `atteinte cardiaque (douleur thoracique + bras gauche)`."""
+        shown = self.categories or sorted({flag.category for flag in self.flags})
+        parts = []
+        for category in shown:
+            terms = list(dict.fromkeys(flag.term for flag in self.flags if flag.category == category))
+            parts.append(f"{CATEGORY_LABELS[category]} ({' + '.join(terms)})")
+        return " ; ".join(parts)
+
+
+class RedFlagMatcher:
+    def __init__(self, lexicon=LEXICON):
+        self.entries = [RedFlag(term, category, weight) for category, weight, terms in lexicon for term in terms]
+        patterns = {}
+        for index, entry in enumerate(self.entries):
+            patterns.setdefault(tuple(normalize(entry.term)), []).append(index)
+        self._patterns = list(patterns.items())
+        self._automaton = AhoCorasick(pattern for pattern, _ in self._patterns)
+
+    @staticmethod
+    def _negated(words, start):
+        for word in reversed(words[max(0, start - NEGATION_WINDOW):start]):
+            if word in NEGATIONS:
+                return True
+            if word in CLAUSE_BREAKS or word == "|":
+                return False
+        return False
+
+    def matches(self, text):
+        """`(premier mot, dernier mot + 1, RedFlag)` non niés, dans un texte brut."""
+        words = normalize(text)
+        found = []
+        for last, index in self._automaton.finditer(words):
+            pattern, entries = self._patterns[index]
+            start = last - len(pattern) + 1
+            if self._negated(words, start):
+                continue
+            found.extend((start, last + 1, self.entries[i]) for i in entries)
+        return found
+
+    def assess(self, *texts):
+        """Niveau d'alerte de la saisie (description libre, symptômes cochés…)."""
+        by_category = {}
+        for text_index, text in enumerate(texts):
+            for start, end, flag in self.matches(text or ""):
+                by_category.setdefault(flag.category, []).append((text_index, start, end, flag))
+
+        assessment = Assessment()
+        for category, found in by_category.items():
+            # Termes imbriqués (« douleur thoracique » dans « douleur thoracique écrasante ») :
+            # seul le plus long compte.
+            found.sort(key=lambda m: (m[0], m[1], -(m[2] - m[1])))
+            kept, last = [], None
+            for text_index, start, end, flag in found:
+                if last and last[0] == text_index and start < last[1]:
+                    if flag.weight > kept[-1].weight:
+                        kept[-1] = flag
+                    continue
+                kept.append(flag)
+                last = (text_index, end)
+            # Un même terme répété (symptôme coché et repris dans la description) reste un seul signe.
+            kept = list(dict.fromkeys(kept))
+            strongest = max(flag.weight for flag in kept)
+            if strongest == 0:
+                continue  # symptômes courants seuls : pas d'alerte
+            assessment.flags.extend(kept)
+            if strongest >= 2 or len(kept) >= 2:
+                assessment.categories.append(category)
+        if assessment.categories:
+            assessment.level = EMERGENCY
+        elif assessment.flags:
+            assessment.level = WARNING
+        return assessment
+
+
+_default_matcher = None
+
+
+def assess(*texts):
+    """Pré-triage avec le lexique par défaut (automate compilé au premier appel)."""
+    global _default_matcher
+    if _default_matcher is None:
+        _default_matcher = RedFlagMatcher()
+    return _default_matcher.assess(*texts)
+
+
+# --- Benchmark ---
+FILLER = (
+    "Depuis trois jours je me sens fatigué, j'ai un peu mal au ventre après les repas et "
+    "je dors mal. I also have a mild cough in the morning and some back pain. "
+)
+
+
+def synthetic_text(size, seed=0):
+    """Description de `size` caractères : texte anodin avec quelques signes d'alerte dispersés."""
+    rng = random.Random(seed)
+    terms = [term for _, _, group in LEXICON for term in group]
+    parts, length = [], 0
+    while length < size:
+        part = FILLER if rng.random() > 0.05 else f"{rng.choice(terms)}. "
+        parts.append(part)
+        length += len(part)
+    return "".join(parts)[:size]
+
+
+def naive_assess(text):
+    """Référence : recherche de chaque terme normalisé, un par un."""
+    normalized = f" {' '.join(normalize(text))} "
+    return [term for _, _, terms in LEXICON for term in terms if f" {' '.join(normalize(term))} " in normalized]
+
+
+def run_benchmark(sizes=(200, 2_000, 20_000, 200_000, 1_000_000), repeat=5):
+    matcher = RedFlagMatcher()
+    regex = re.compile(r"\b(?:" + "|".join(sorted((re.escape(" ".join(normalize(t))) for _, _, ts in LEXICON
+                                                    for t in ts), key=len, reverse=True)) + r")\b")
+    print(f"{len(matcher.entries)} termes, {len(matcher._automaton.vocab)} mots, "
+          f"{len(matcher._automaton._delta)} états")
+    print(f"{'caractères':>11}{'Aho-Corasick':>15}{'regex':>12}{'naïf':>12}{'signes':>8}")
+    results = []
+    for size in sizes:
+        text = synthetic_text(size)
+        timings = {}
+        for name, fn in (("aho_corasick", lambda: matcher.assess(text)),
+                         ("regex", lambda: regex.findall(" ".join(normalize(text)))),
+                         ("naive", lambda: naive_assess(text))):
+            best = float("inf")
+            for _ in range(repeat):
+                start = time.perf_counter()
+                fn()
+                best = min(best, time.perf_counter() - start)
+            timings[name] = best
+        flags = len(matcher.assess(text).flags)
+        results.append({"chars": size, "flags": flags, **timings})
+        print(f"{size:>11}" + "".join(f"{timings[k] * 1e6:>12.0f} µs" for k in ("aho_corasick",))
+              + "".join(f"{timings[k] * 1e6:>9.0f} µs" for k in ("regex", "naive")) + f"{flags:>8}")
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pré-triage par règles (signes d'alerte vitale).")
+    parser.add_argument("text", nargs="*", help="description à analyser")
+    parser.add_argument("--benchmark", action="store_true", help="mesure sur des descriptions de taille croissante")
+    args = parser.parse_args(argv)
+    if args.benchmark:
+        run_benchmark()
+        return 0
+    if not args.text:
+        parser.error("texte à analyser requis (ou --benchmark)")
+    assess("")  # compilation de l'automate, hors mesure
+    start = time.perf_counter()
+    result = assess(" ".join(args.text))
+    elapsed = time.perf_counter() - start
+    icon = {EMERGENCY: "🚨", WARNING: "⚠️"}.get(result.level, "✅")
+    print(f"{icon} {result.level or 'aucun signe d alerte'} ({elapsed * 1e6:.0f} µs) {result.reasons()}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
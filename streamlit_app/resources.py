@@ -0,0 +1,71 @@
+"""Ressources partagées par toutes les sessions de l'app, créées une fois par processus.
+
+Définies hors de `app.py` : Streamlit ré-exécute le script à chaque interaction, et un
+`st.cache_resource` déclaré dans le script est ré-enregistré (source de la fonction
+relue et hachée) à chaque passage ; importé d'ici, il ne l'est qu'une fois.
+"""
+import importlib.util
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import streamlit as st
+
+from llm_cache import ResponseCache
+from llm_clients import BackendClients
+from llm_router import LLMRouter, build_routes
+
+# Utilisation du modèle Gemini 2.0 Flash par défaut pour l'API officielle
+MODEL_NAME = "gemini-2.0-flash"
+
+
+@st.cache_resource
+def setup_ffmpeg():
+    """ffmpeg pour le décodage audio : celui du système, sinon static_ffmpeg (une fois par processus)."""
+    if shutil.which("ffmpeg"):
+        return True
+    try:
+        import static_ffmpeg
+        static_ffmpeg.add_paths()
+        return True
+    except Exception as e:
+        print(f"Note: static_ffmpeg n'a pas pu être initialisé ({e}). Assurez-vous que ffmpeg est installé manuellement.")
+        return False
+
+
+@st.cache_resource
+def live_dictation_available():
+    """Dictée en direct (optionnelle, `pip install streamlit-webrtc av`, voir requirements.txt) :
+    sans elle, l'audio est transcrit en une fois à la fin de l'enregistrement."""
+    return all(importlib.util.find_spec(name) is not None for name in ("av", "streamlit_webrtc"))
+
+
+def get_api_key():
+    """Récupère la clé API depuis les secrets ou l'environnement."""
+    if "GEMINI_API_KEY" in st.secrets:
+        return st.secrets["GEMINI_API_KEY"]
+    return os.getenv("GEMINI_API_KEY")
+
+
+@st.cache_resource
+def get_clients():
+    """Clients backend (session HTTP poolée, client Gemini) créés une fois par processus."""
+    return BackendClients(gemini_api_key=get_api_key(), model_name=MODEL_NAME)
+
+
+@st.cache_resource
+def get_router(kaggle_urls, use_gemini):
+    """Routeur partagé par toutes les sessions : l'historique de santé des routes est commun."""
+    return LLMRouter(get_clients(), build_routes(kaggle_urls.splitlines(), use_gemini))
+
+
+@st.cache_resource
+def get_response_cache():
+    """Cache des réponses partagé par toutes les sessions (voir llm_cache.py)."""
+    return ResponseCache()
+
+
+@st.cache_resource
+def get_prefetch_executor():
+    """Threads partagés par toutes les sessions pour les appels spéculatifs."""
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix="prefetch")
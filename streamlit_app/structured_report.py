@@ -0,0 +1,77 @@
+"""Rapport de triage structuré : schéma JSON, validation et rendu local.
+
+Le rapport final peut être demandé sous forme d'objet JSON compact (décodage contraint
+côté serveur Kaggle, `response_schema` côté Gemini) au lieu de prose libre :
+
+    {"urgency": "high", "emergency": true, "causes": ["..."], "actions": ["..."], "consult": "..."}
+
+L'app et le PDF le mettent en forme localement ; aucune dépendance externe.
+"""
+import json
+
+URGENCY_LABELS = {"low": "Faible", "medium": "Moyen", "high": "Élevé"}
+MAX_CAUSES = 3
+MAX_ACTIONS = 4
+
+# Sous-ensemble commun au décodage contraint du serveur et au `response_schema` de Gemini.
+TRIAGE_REPORT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "urgency": {"type": "string", "enum": list(URGENCY_LABELS)},
+        "emergency": {"type": "boolean"},
+        "causes": {"type": "array", "items": {"type": "string", "maxLength": 100}, "maxItems": MAX_CAUSES},
+        "actions": {"type": "array", "items": {"type": "string", "maxLength": 100}, "maxItems": MAX_ACTIONS},
+        "consult": {"type": "string", "maxLength": 80},
+    },
+    "required": ["urgency", "emergency", "causes", "actions", "consult"],
+    "propertyOrdering": ["urgency", "emergency", "causes", "actions", "consult"],
+}
+
+EMERGENCY_LINE = "URGENCE VITALE : appelez immédiatement le 15 ou le 112."
+
+
+def parse_report(text):
+    """Objet rapport validé, ou None si `text` n'est pas un rapport structuré conforme."""
+    if isinstance(text, dict):
+        data = text
+    else:
+        text = (text or "").strip()
+        if text.startswith("```"):  # bloc de code éventuel autour du JSON
+            text = text.strip("`").removeprefix("json").strip()
+        try:
+            data = json.loads(text)
+        except ValueError:
+            return None
+    if not isinstance(data, dict) or data.get("urgency") not in URGENCY_LABELS:
+        return None
+    lists = {key: data.get(key) for key in ("causes", "actions")}
+    if not all(isinstance(v, list) and all(isinstance(s, str) for s in v) for v in lists.values()):
+        return None
+    return {
+        "urgency": data["urgency"],
+        "emergency": data.get("emergency") is True,
+        "causes": [s.strip() for s in lists["causes"] if s.strip()][:MAX_CAUSES],
+        "actions": [s.strip() for s in lists["actions"] if s.strip()][:MAX_ACTIONS],
+        "consult": str(data.get("consult") or "").strip(),
+    }
+
+
+def report_sections(report):
+    """(titre, texte ou liste) dans l'ordre du rapport en prose : partagé par l'app et le PDF."""
+    return [
+        ("Niveau d'urgence", URGENCY_LABELS[report["urgency"]]),
+        ("Causes possibles (à confirmer par un médecin)", report["causes"]),
+        ("Actions immédiates", report["actions"]),
+        ("Consultation", report["consult"]),
+    ]
+
+
+def report_markdown(report):
+    lines = [f"🚨 **{EMERGENCY_LINE}**", ""] if report["emergency"] else []
+    for i, (title, value) in enumerate(report_sections(report), 1):
+        if isinstance(value, list):
+            lines.append(f"{i}. **{title} :**")
+            lines.extend(f"    - {item}" for item in value)
+        else:
+            lines.append(f"{i}. **{title} :** {value}")
+    return "\n".join(lines)
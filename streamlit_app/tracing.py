@@ -0,0 +1,286 @@
+"""Traçage de bout en bout : app Streamlit → HTTP → serveur d'inférence.
+
+Chaque appel tracé (questions, rapport, transcription) ouvre une trace ; les étapes
+imbriquées (cache, décodage audio, appel HTTP...) sont des spans enfants. Le contexte
+part vers le serveur dans l'en-tête W3C `traceparent` ; le serveur renvoie ses propres
+spans (file d'attente, pré-remplissage, décodage...) dans la réponse, rattachés au span
+HTTP qui les a demandés.
+
+Échantillonnage à la racine, désactivé par défaut (`MEDGEMMA_TRACE_SAMPLE`, ou `force=True`
+depuis le panneau de débogage) : les spans portent des attributs issus de la saisie du
+patient. Une trace non échantillonnée ne crée aucun span, le coût se limite à une lecture
+de `ContextVar`. Les traces terminées partent vers un exportateur : JSONL (une ligne
+OTLP/JSON par trace dans `MEDGEMMA_TRACE_DIR`, relisible par un collecteur OpenTelemetry),
+OTLP/HTTP, ou rien.
+"""
+import contextlib
+import contextvars
+import json
+import os
+import queue
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+
+TRACE_SAMPLE_RATE = float(os.getenv("MEDGEMMA_TRACE_SAMPLE", "0"))
+TRACE_EXPORTER = os.getenv("MEDGEMMA_TRACE_EXPORTER", "jsonl")  # jsonl | otlp | none
+TRACE_DIR = os.getenv("MEDGEMMA_TRACE_DIR", os.path.expanduser("~/.cache/medgemma/traces"))
+TRACE_FILE = os.getenv("MEDGEMMA_TRACE_FILE", os.path.join(TRACE_DIR, "medgemma_traces.jsonl"))
+OTLP_ENDPOINT = os.getenv("MEDGEMMA_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+SERVICE_NAME = "medgemma-app"
+SPAN_KINDS = {"internal": 1, "server": 2, "client": 3}
+
+_current = contextvars.ContextVar("medgemma_span", default=None)  # (trace, span) courant
+
+
+def otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def from_otlp_value(value):
+    if "intValue" in value:
+        return int(value["intValue"])
+    return next(iter(value.values()), None)
+
+
+@dataclass
+class Span:
+    trace_id: str
+    span_id: str
+    parent_id: str
+    name: str
+    start_ns: int
+    end_ns: int = None
+    kind: str = "internal"
+    service: str = SERVICE_NAME
+    attributes: dict = field(default_factory=dict)
+    error: bool = False
+
+    @property
+    def duration_ms(self):
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def to_otlp(self):
+        return {
+            "traceId": self.trace_id, "spanId": self.span_id, "parentSpanId": self.parent_id or "",
+            "name": self.name, "kind": SPAN_KINDS.get(self.kind, 1),
+            "startTimeUnixNano": str(self.start_ns), "endTimeUnixNano": str(self.end_ns or self.start_ns),
+            "attributes": [{"key": k, "value": otlp_value(v)} for k, v in self.attributes.items()],
+            "status": {"code": 2 if self.error else 0},
+        }
+
+    @classmethod
+    def from_otlp(cls, data, service):
+        kinds = {v: k for k, v in SPAN_KINDS.items()}
+        attributes = {a["key"]: from_otlp_value(a["value"]) for a in data.get("attributes", [])}
+        return cls(
+            data["traceId"], data["spanId"], data.get("parentSpanId") or None, data["name"],
+            int(data["startTimeUnixNano"]), int(data["endTimeUnixNano"]), kinds.get(data.get("kind"), "internal"),
+            attributes.pop("service.name", service), attributes, data.get("status", {}).get("code") == 2,
+        )
+
+
+class Trace:
+    """Spans d'une trace (locaux et distants), dans l'ordre de création."""
+
+    def __init__(self, name):
+        self.trace_id = os.urandom(16).hex()
+        self.name = name
+        self.spans = []
+
+    @property
+    def root(self):
+        return self.spans[0] if self.spans else None
+
+    def timeline(self):
+        """Lignes du waterfall : (profondeur, span, début en ms depuis la racine).
+
+        Les horloges de l'app et du serveur ne sont pas synchronisées : la racine serveur est
+        centrée dans le span HTTP client qui l'a appelée (latence réseau supposée symétrique).
+        """
+        children = {}
+        for span in self.spans:
+            children.setdefault(span.parent_id, []).append(span)
+        rows = []
+
+        def visit(span, depth, shift):
+            parent = next((s for s in self.spans if s.span_id == span.parent_id), None)
+            if parent is not None and span.service != parent.service:
+                shift = parent.start_ns + shift + (parent.duration_ms - span.duration_ms) * 1e6 / 2 - span.start_ns
+            rows.append((depth, span, (span.start_ns + shift - self.root.start_ns) / 1e6))
+            for child in sorted(children.get(span.span_id, []), key=lambda s: s.start_ns):
+                visit(child, depth + 1, shift)
+
+        if self.root is not None:
+            visit(self.root, 0, 0)
+        return rows
+
+    def to_otlp(self):
+        """Requête d'export OTLP/JSON, une ressource par service (app, serveur)."""
+        by_service = {}
+        for span in self.spans:
+            by_service.setdefault(span.service, []).append(span.to_otlp())
+        return {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": service}}]},
+            "scopeSpans": [{"scope": {"name": "medgemma"}, "spans": spans}],
+        } for service, spans in by_service.items()]}
+
+
+class JsonlExporter:
+    """Une ligne OTLP/JSON par trace terminée, ajoutée au fichier."""
+
+    def __init__(self, path=TRACE_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, trace):
+        line = json.dumps(trace.to_otlp(), ensure_ascii=False)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+
+class OtlpHttpExporter:
+    """Envoi OTLP/HTTP (JSON) à un collecteur OpenTelemetry, depuis un thread dédié."""
+
+    def __init__(self, endpoint=OTLP_ENDPOINT):
+        import requests
+        self.endpoint = endpoint
+        self._session = requests.Session()
+        self._queue = queue.Queue(maxsize=1000)
+        threading.Thread(target=self._loop, name="otlp-exporter", daemon=True).start()
+
+    def export(self, trace):
+        try:
+            self._queue.put_nowait(trace.to_otlp())
+        except queue.Full:
+            pass  # collecteur injoignable : on perd des traces plutôt que de ralentir l'app
+
+    def _loop(self):
+        while True:
+            payload = self._queue.get()
+            try:
+                self._session.post(self.endpoint, json=payload, timeout=5)
+            except Exception as e:
+                print(f"⚠️ Export OTLP : {e}")
+
+
+class NullExporter:
+    def export(self, trace):
+        pass
+
+
+def build_exporter(kind=TRACE_EXPORTER):
+    return {"jsonl": JsonlExporter, "otlp": OtlpHttpExporter}.get(kind, NullExporter)()
+
+
+class Tracer:
+    def __init__(self, exporter=None, sample_rate=TRACE_SAMPLE_RATE):
+        self.exporter = exporter if exporter is not None else build_exporter()
+        self.sample_rate = sample_rate
+
+    @contextlib.contextmanager
+    def trace(self, name, force=False, **attributes):
+        """Trace racine ; produit la `Trace`, ou None si elle n'est pas échantillonnée.
+
+        Dans une trace déjà ouverte, se comporte comme un simple span.
+        """
+        if _current.get() is not None:
+            with self.span(name, **attributes):
+                yield _current.get()[0]
+            return
+        if not force and random.random() >= self.sample_rate:
+            yield None
+            return
+        trace = Trace(name)
+        try:
+            with self._span(trace, None, name, "internal", attributes):
+                yield trace
+        finally:
+            self.exporter.export(trace)
+
+    @contextlib.contextmanager
+    def span(self, name, kind="internal", **attributes):
+        """Span enfant du span courant ; sans trace active, ne fait rien (produit None)."""
+        current = _current.get()
+        if current is None:
+            yield None
+            return
+        trace, parent = current
+        with self._span(trace, parent.span_id, name, kind, attributes) as span:
+            yield span
+
+    @contextlib.contextmanager
+    def _span(self, trace, parent_id, name, kind, attributes):
+        span = Span(trace.trace_id, os.urandom(8).hex(), parent_id, name, time.time_ns(), kind=kind,
+                    attributes=attributes)
+        trace.spans.append(span)
+        token = _current.set((trace, span))
+        try:
+            yield span
+        except BaseException as e:
+            span.error = True
+            span.attributes["error"] = str(e)[:200]
+            raise
+        finally:
+            span.end_ns = time.time_ns()
+            try:
+                _current.reset(token)
+            except ValueError:  # générateur refermé depuis un autre contexte
+                pass
+
+    def inject(self, headers=None):
+        """En-têtes HTTP avec le contexte W3C `traceparent` du span courant (s'il y en a un)."""
+        headers = dict(headers or {})
+        current = _current.get()
+        if current is not None:
+            trace, span = current
+            headers["traceparent"] = f"00-{trace.trace_id}-{span.span_id}-01"
+        return headers
+
+    def add_remote(self, otlp_spans, service="medgemma-server"):
+        """Rattache à la trace courante les spans renvoyés par le serveur (format OTLP/JSON)."""
+        current = _current.get()
+        if current is None or not otlp_spans:
+            return
+        for data in otlp_spans:
+            try:
+                current[0].spans.append(Span.from_otlp(data, service))
+            except (KeyError, TypeError, ValueError):
+                continue
+
+    @staticmethod
+    def current_trace():
+        current = _current.get()
+        return current[0] if current is not None else None
+
+
+def in_own_context(iterator):
+    """Itère `iterator` dans une copie du contexte courant.
+
+    Un générateur qui ouvre un span le garde actif entre deux `yield` : sans isolation, le
+    code de l'appelant (rendu Streamlit) s'y rattacherait, et un flux abandonné en cours de
+    route laisserait le span courant en place pour les exécutions suivantes.
+    """
+    context = contextvars.copy_context()
+    try:
+        while True:
+            try:
+                item = context.run(next, iterator)
+            except StopIteration:
+                return
+            yield item
+    finally:
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            context.run(close)
+
+
+tracer = Tracer()
@@ -0,0 +1,138 @@
+"""Pipeline de triage en deux étapes : questions de suivi, puis rapport final.
+
+Prompts système et construction des messages, partagés par l'app Streamlit et le
+traitement par lots (`batch_triage.py`) ; aucune dépendance à Streamlit.
+"""
+import os
+import time
+
+from llm_cache import DESCRIPTION_MARKER
+from llm_clients import GEMINI_BACKEND
+from llm_router import ROUTER_BACKEND
+from structured_report import TRIAGE_REPORT_SCHEMA, parse_report
+from tracing import tracer
+
+# --- System Prompts (Optimized V3 SafetyFirst) ---
+SYSTEM_PROMPT_QUESTIONS = """You are MedGemma, a medical triage expert. 
+Based on the symptoms provided, generate 3-4 essential follow-up questions to better assess the urgency.
+Focus strictly on differentiating between benign issues and potential emergencies.
+Format as a simple bulleted list in French."""
+
+SYSTEM_PROMPT_FINAL = """You are MedGemma, a helpful medical triage assistant.
+CRITICAL: If symptoms suggest a life-threatening emergency (e.g., heart attack signs, stroke, severe bleeding, breathing difficulty), IMMEDIATELY tell the user to call emergency services (15/112) in the first line.
+
+For non-emergencies, analyze the context and provide:
+1. Urgency Level (Low, Medium, High).
+2. Possible causes (stated with caution as possibilities, not diagnosis).
+3. Immediate home care actions.
+4. Recommendation on when to see a doctor (e.g., "Within 4 hours", "Tomorrow").
+
+Keep responses concise, structured, and empathetic. Answer in French."""
+
+# Rapport structuré : même consigne, réponse sous forme d'objet JSON (voir structured_report.py).
+SYSTEM_PROMPT_FINAL_STRUCTURED = """You are MedGemma, a helpful medical triage assistant.
+Assess the patient's situation and answer ONLY with a compact JSON object:
+- urgency: "low", "medium" or "high";
+- emergency: true if symptoms suggest a life-threatening emergency (e.g., heart attack signs, stroke, severe bleeding, breathing difficulty) requiring an immediate call to 15/112;
+- causes: up to 3 possible causes, stated with caution as possibilities, not diagnosis;
+- actions: up to 4 immediate home care actions;
+- consult: when to see a doctor (e.g., "Dans les 4 heures", "Demain").
+Short phrases, in French."""
+
+
+# --- Profils de génération par étape ---
+# Envoyés au serveur Kaggle (critères d'arrêt : fin de la 4e question, fin de la rubrique 4)
+# et traduits en `max_output_tokens` pour Gemini. Budgets surchargeables par variable d'env.
+QUESTIONS_GENERATION = {
+    "profile": "questions",
+    "max_new_tokens": int(os.getenv("MEDGEMMA_QUESTIONS_MAX_TOKENS", "200")),
+}
+FINAL_GENERATION = {
+    "profile": "final",
+    "max_new_tokens": int(os.getenv("MEDGEMMA_FINAL_MAX_TOKENS", "600")),
+}
+# Sortie contrainte au schéma : quelques phrases courtes au lieu de 600 tokens de prose.
+FINAL_STRUCTURED_GENERATION = {
+    "profile": "final",
+    "max_new_tokens": int(os.getenv("MEDGEMMA_STRUCTURED_MAX_TOKENS", "320")),
+    "schema": TRIAGE_REPORT_SCHEMA,
+}
+
+
+def final_stage(structured):
+    """(instruction système, profil de génération) du rapport final."""
+    if structured:
+        return SYSTEM_PROMPT_FINAL_STRUCTURED, FINAL_STRUCTURED_GENERATION
+    return SYSTEM_PROMPT_FINAL, FINAL_GENERATION
+
+
+def is_valid_report(text):
+    """Critère `accept` du rapport structuré : JSON conforme au schéma."""
+    return parse_report(text) is not None
+
+
+def cache_model_name(backend, model_name):
+    if backend == GEMINI_BACKEND:
+        return model_name
+    return "router" if backend == ROUTER_BACKEND else "kaggle"
+
+
+def build_questions_prompt(age, sexe, symptoms, description):
+    """Prompt de l'étape 1. Symptômes triés : le prompt (et donc la clé de cache) ne dépend pas
+    de l'ordre d'un `set`, qui change d'un processus à l'autre."""
+    return f"Patient: {age} ans, {sexe}. Symptômes: {', '.join(sorted(symptoms))}{DESCRIPTION_MARKER}{description}"
+
+
+def build_final_history(questions_prompt, followup_questions):
+    """Contexte patient et questions transmis comme tours précédents du rapport final."""
+    return [
+        {"role": "user", "content": questions_prompt, "system_instruction": SYSTEM_PROMPT_QUESTIONS},
+        {"role": "model", "content": followup_questions},
+    ]
+
+
+def build_emergency_prompt(questions_prompt, red_flags):
+    """Rapport final direct, sans questions de suivi, quand le pré-triage détecte une urgence."""
+    return f"{questions_prompt}\nSignes d'alerte vitale détectés : {red_flags}."
+
+
+def build_final_prompt(answers):
+    return f"""
+            PRÉCISIONS APPORTÉES (réponses du patient aux questions ci-dessus):
+            {answers}
+            """
+
+
+def build_cache_args(prompt, system_instruction, backend, model_name, history=None, generation=None):
+    """Clé de cache d'un appel : le budget de l'étape en fait partie."""
+    return dict(system_instruction=system_instruction, prompt=prompt, temperature=0.4,
+                max_tokens=(generation or {}).get("max_new_tokens", 600),
+                model=cache_model_name(backend, model_name), history=history)
+
+
+def generate_cached(clients, cache, prompt, system_instruction, backend=GEMINI_BACKEND, custom_url=None,
+                    history=None, session_id=None, semantic=False, generation=None, semantic_lookup=False,
+                    accept=None):
+    """Appel LLM à travers le cache (`cache=None` : appel direct). Lève `LLMError`.
+
+    `semantic` : la réponse alimente le tier sémantique ; `semantic_lookup` : ce tier peut
+    aussi servir la lecture (réglage propre à l'appelant, le cache étant partagé).
+    `accept(text)` : une réponse refusée (JSON illisible) n'est ni servie depuis le cache
+    ni mise en cache, pour ne pas rejouer la même sortie invalide à chaque relance.
+
+    Sans Streamlit : utilisable depuis un thread (pré-calcul, traitement par lots).
+    """
+    cache_args = build_cache_args(prompt, system_instruction, backend, clients.model_name, history, generation)
+    if cache is not None:
+        with tracer.span("cache.lookup", semantic=semantic and semantic_lookup) as span:
+            cached = cache.get(**cache_args, semantic=semantic and semantic_lookup)
+            if span is not None:
+                span.attributes["hit"] = cached is not None
+        if cached is not None and (accept is None or accept(cached)):
+            return cached
+
+    start = time.perf_counter()
+    text = clients.generate(prompt, system_instruction, backend, custom_url, history, session_id, generation)
+    if cache is not None and (accept is None or accept(text)):
+        cache.put(**cache_args, response=text, latency=time.perf_counter() - start, semantic=semantic)
+    return text
@@ -0,0 +1,217 @@
+"""Serveur factice imitant le serveur Kaggle (/generate, /prefill, /transcribe[_stream]) et l'API Ollama.
+
+Uniquement la bibliothèque standard : permet de lancer les benchmarks et les pipelines
+hors ligne, sans GPU ni modèle. Les réponses sont des textes de triage canoniques émis
+mot par mot, avec une latence configurable (délai avant premier token + délai par token).
+
+    python stub_server.py --port 5000 --ttft 0.2 --token-delay 0.02
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+STUB_QUESTIONS = """- Depuis combien de temps les symptômes sont-ils présents ?
+- Avez-vous une douleur dans la poitrine ou une gêne respiratoire ?
+- Avez-vous pris votre température, et quelle était la valeur ?
+- Avez-vous des antécédents médicaux ou des traitements en cours ?"""
+
+STUB_TRANSCRIPTION = "j'ai de la fièvre et je tousse depuis deux jours"
+STUB_WORDS_PER_S = 2.5  # débit de parole simulé par /transcribe_stream
+PCM_HEADER_SIZE = 12    # en-tête MGPC, suivi de PCM int16 16 kHz
+
+STUB_REPORT = """1. Niveau d'urgence : Moyen.
+2. Causes possibles : infection virale bénigne, à confirmer par un médecin.
+3. Actions immédiates : repos, hydratation, paracétamol si fièvre.
+4. Consultation : dans les 24 heures, ou immédiatement si aggravation (15/112)."""
+
+# Réponse à une requête avec `generation.schema` (rapport structuré, JSON compact).
+STUB_STRUCTURED_REPORT = json.dumps({
+    "urgency": "medium", "emergency": False,
+    "causes": ["infection virale bénigne", "bronchite"],
+    "actions": ["repos", "hydratation", "paracétamol si fièvre"],
+    "consult": "dans les 24 heures",
+}, ensure_ascii=False, separators=(",", ":"))
+
+
+def stub_response(system_instruction):
+    """Questions de suivi ou rapport final selon l'instruction système reçue."""
+    return STUB_QUESTIONS if "follow-up questions" in (system_instruction or "") else STUB_REPORT
+
+
+def split_tokens(text):
+    """Découpe en « tokens » (mots + espaces) pour simuler un flux."""
+    words = text.split(" ")
+    return [w + (" " if i < len(words) - 1 else "") for i, w in enumerate(words)]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive + flux en `Transfer-Encoding: chunked`
+    ttft_s = 0.05
+    token_delay_s = 0.005
+    error_rate = 0.0
+    streams = {}  # stream_id → échantillons reçus
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        try:
+            return json.loads(body or b"{}")
+        except ValueError:
+            return {}
+
+    def _send_json(self, payload, status=200):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _start_chunked(self, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def _write_chunk(self, text):
+        data = text.encode("utf-8")
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def _end_chunked(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def _tokens(self, system_instruction, max_tokens=None, structured=False):
+        """Flux de « tokens », tronqué au budget `max_tokens` comme le vrai serveur."""
+        time.sleep(self.ttft_s)
+        text = STUB_STRUCTURED_REPORT if structured else stub_response(system_instruction)
+        for i, token in enumerate(split_tokens(text)):
+            if max_tokens is not None and i >= max_tokens:
+                return
+            if i:
+                time.sleep(self.token_delay_s)
+            yield token
+
+    def do_GET(self):
+        if self.path == "/":
+            body = "MedGemma API Ready (stub)".encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self._send_json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        if self.error_rate and random.random() < self.error_rate:
+            self._send_json({"error": "stub: erreur simulée"}, 503)
+            return
+        if self.path.startswith("/transcribe_stream"):
+            self._transcribe_stream()
+        elif self.path == "/generate":
+            self._generate(self._read_json())
+        elif self.path == "/api/generate":
+            self._ollama_generate(self._read_json())
+        elif self.path == "/prefill":
+            data = self._read_json()
+            time.sleep(self.ttft_s)
+            self._send_json({"prefilled": bool(data.get("session_id"))})
+        elif self.path == "/transcribe":
+            self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            time.sleep(self.ttft_s)
+            self._send_json({"transcription": STUB_TRANSCRIPTION})
+        else:
+            self._send_json({"error": "not found"}, 404)
+
+    def _transcribe_stream(self):
+        """Transcription en direct : les mots apparaissent au rythme de l'audio reçu."""
+        query = {k: v[0] for k, v in parse_qs(urlsplit(self.path).query).items()}
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        samples = max(0, len(body) - PCM_HEADER_SIZE) // 2
+        stream_id = query.get("stream_id") or uuid.uuid4().hex
+        if query.get("stream_id") and stream_id not in self.streams:
+            self._send_json({"error": "Session de transcription inconnue ou expirée"}, 404)
+            return
+        offset = int(query.get("offset", self.streams.get(stream_id, 0)))
+        received = self.streams[stream_id] = max(self.streams.get(stream_id, 0), offset + samples)
+        final = query.get("final") == "1"
+        if final:
+            del self.streams[stream_id]
+        words = STUB_TRANSCRIPTION.split(" ")
+        shown = len(words) if final else min(len(words), int(received / 16000 * STUB_WORDS_PER_S))
+        text = " ".join(words[:shown])
+        self._send_json({"stream_id": stream_id, "transcription": text, "committed": text,
+                         "final": final, "audio_s": received / 16000})
+
+    def _generate(self, data):
+        generation = data.get("generation") or {}
+        tokens = self._tokens(data.get("system_instruction"), generation.get("max_new_tokens"),
+                              structured=bool(generation.get("schema")))
+        if not data.get("stream"):
+            tokens = list(tokens)
+            self._send_json({"response": "".join(tokens).strip(),
+                             "usage": {"input_tokens": len(data.get("prompt", "").split()),
+                                       "output_tokens": len(tokens)}})
+            return
+        self._start_chunked("text/event-stream; charset=utf-8")
+        count = 0
+        try:
+            for token in tokens:
+                count += 1
+                self._write_chunk(f"data: {json.dumps({'token': token}, ensure_ascii=False)}\n\n")
+            usage = {"input_tokens": len(data.get("prompt", "").split()), "output_tokens": count}
+            self._write_chunk(f"data: {json.dumps({'usage': usage})}\n\ndata: [DONE]\n\n")
+            self._end_chunked()
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True  # flux abandonné par le client (ex: doublon perdant)
+
+    def _ollama_generate(self, data):
+        tokens = self._tokens(data.get("system") or data.get("prompt"))
+        if not data.get("stream", True):
+            tokens = list(tokens)
+            self._send_json({"response": "".join(tokens), "done": True, "eval_count": len(tokens)})
+            return
+        self._start_chunked("application/x-ndjson")
+        count = 0
+        for token in tokens:
+            count += 1
+            self._write_chunk(json.dumps({"response": token, "done": False}) + "\n")
+        self._write_chunk(json.dumps({"response": "", "done": True, "eval_count": count}) + "\n")
+        self._end_chunked()
+
+
+def start_stub_server(port=0, ttft_s=0.05, token_delay_s=0.005, error_rate=0.0, host="127.0.0.1"):
+    """Démarre le serveur factice dans un thread ; renvoie `(serveur, url)`."""
+    handler = type("ConfiguredStubHandler", (StubHandler,), {
+        "ttft_s": ttft_s, "token_delay_s": token_delay_s, "error_rate": error_rate,
+    })
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="stub-server", daemon=True).start()
+    return server, f"http://{host}:{server.server_port}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--ttft", type=float, default=0.05, help="délai avant le premier token (s)")
+    parser.add_argument("--token-delay", type=float, default=0.005, help="délai entre tokens (s)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="part de réponses 503 simulées")
+    args = parser.parse_args()
+    server, url = start_stub_server(args.port, args.ttft, args.token_delay, args.error_rate, args.host)
+    print(f"🧪 Serveur factice prêt : {url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,7 @@
+"""Tests CPU : modules de l'app (`streamlit_app/`) et serveur (`kaggle_server_script.py`, modèles factices)."""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "streamlit_app"))
@@ -0,0 +1,86 @@
+import pytest
+
+pytest.importorskip("transformers")
+import kaggle_server_script as k  # noqa: E402
+
+SYSTEM = "You are MedGemma, a medical triage expert."
+
+
+@pytest.fixture(scope="module")
+def stub_llm():
+    return k.load_stub_llm(0)
+
+
+@pytest.fixture
+def scheduler_factory(stub_llm):
+    schedulers = []
+
+    def make(**kwargs):
+        tokenizer, model = stub_llm
+        scheduler = k.BatchScheduler(model, tokenizer, **kwargs)
+        schedulers.append(scheduler)
+        return scheduler
+
+    yield make
+    for scheduler in schedulers:
+        scheduler.stop()
+
+
+def test_concurrent_requests_share_a_batch(stub_llm, scheduler_factory):
+    tokenizer, _ = stub_llm
+    scheduler = scheduler_factory(window_ms=200, max_batch_size=4)
+    prompts = [k.build_prompt(SYSTEM, "toux " * (i + 1)) for i in range(4)]
+    futures = [scheduler.submit(prompt, max_new_tokens=5) for prompt in prompts]
+    results = [future.result(timeout=60) for future in futures]
+    assert scheduler.stats["requests"] == 4
+    assert scheduler.stats["max_batch_seen"] >= 2
+    # Padding à gauche : chaque appelant récupère sa propre tranche, prompt compté sans padding.
+    for prompt, result in zip(prompts, results):
+        assert result.input_tokens == len(tokenizer(prompt).input_ids)
+        assert result.output_tokens <= 5
+
+
+def test_different_parameters_are_not_batched_together(scheduler_factory):
+    scheduler = scheduler_factory(window_ms=200, max_batch_size=4)
+    futures = [scheduler.submit("a", max_new_tokens=3), scheduler.submit("b", max_new_tokens=4)]
+    for future in futures:
+        future.result(timeout=60)
+    assert scheduler.stats["batches"] == 2
+
+
+def test_system_prefix_is_reused(scheduler_factory):
+    store = k.KVCacheStore()
+    scheduler = scheduler_factory(kv_cache=store)
+    prefix = k.build_prompt_prefix(SYSTEM)
+    for text in ("fièvre et toux", "mal de gorge"):
+        scheduler.submit(k.build_prompt(SYSTEM, text), max_new_tokens=4, prefix=prefix).result(timeout=60)
+    summary = store.summary()
+    assert summary["prefixes"] == 1
+    assert summary["hits"] == 2
+    assert summary["reused_tokens"] > 0
+
+
+def test_session_cache_is_reused_on_next_turn(stub_llm, scheduler_factory):
+    tokenizer, _ = stub_llm
+    store = k.KVCacheStore()
+    scheduler = scheduler_factory(kv_cache=store)
+    first = k.build_prompt(SYSTEM, "fièvre et toux")
+    reply = scheduler.submit(first, max_new_tokens=6, session_id="s1").result(timeout=60)
+    history = [{"role": "user", "content": "fièvre et toux", "system_instruction": SYSTEM},
+               {"role": "model", "content": reply.text}]
+    reused_before = store.stats["reused_tokens"]
+    scheduler.submit(k.build_prompt(SYSTEM, "depuis hier", history), max_new_tokens=4,
+                     session_id="s1").result(timeout=60)
+    # Tout le premier tour vient du cache de la session : seule la suite est pré-remplie.
+    assert store.stats["reused_tokens"] - reused_before >= len(tokenizer(first).input_ids)
+    assert store.summary()["sessions"] == 1
+
+
+def test_kv_store_evicts_sessions_first():
+    from transformers import DynamicCache
+    store = k.KVCacheStore(max_sessions=1)
+    store.put("prefix", "sys", [1, 2], DynamicCache())
+    store.put("session", "a", [1, 2, 3], DynamicCache())
+    store.put("session", "b", [1, 2, 4], DynamicCache())
+    summary = store.summary()
+    assert (summary["prefixes"], summary["sessions"], summary["evictions"]) == (1, 1, 1)
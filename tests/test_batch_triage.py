@@ -0,0 +1,71 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("requests")
+from batch_triage import run_case  # noqa: E402
+from llm_clients import BackendClients, KAGGLE_BACKEND  # noqa: E402
+
+CASE = {"age": 45, "sexe": "Féminin", "symptoms": ["Fièvre", "Toux"], "description": "toux sèche"}
+
+
+class HtmlHandler(BaseHTTPRequestHandler):
+    """Serveur qui répond 200 avec une page HTML (proxy, page d'erreur ngrok...)."""
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        body = b"<html>ngrok</html>"
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def html_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), HtmlHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+
+def test_non_json_response_is_a_failed_case(html_url):
+    record = run_case(BackendClients(), None, KAGGLE_BACKEND, html_url, "A1", CASE)
+    assert record["status"] == "error"
+    assert "Réponse invalide" in record["error"]
+    assert "total" in record["latency_s"]
+
+
+def test_unexpected_exception_is_a_failed_case():
+    class BrokenClients:
+        model_name = "kaggle"
+
+        def generate(self, *args, **kwargs):
+            raise RuntimeError("boom")
+
+    record = run_case(BrokenClients(), None, KAGGLE_BACKEND, "http://unused", "A2", CASE)
+    assert record["status"] == "error"
+    assert record["error"] == "RuntimeError: boom"
+
+
+def test_stub_run_never_uses_the_shared_cache(tmp_path, monkeypatch):
+    import batch_triage
+    response_cache, paths = batch_triage.ResponseCache, []
+
+    def recording_cache(path=":shared:", **kwargs):
+        paths.append(path)
+        return response_cache(":memory:")
+
+    monkeypatch.setattr(batch_triage, "ResponseCache", recording_cache)
+    cases = tmp_path / "cases.jsonl"
+    cases.write_text('{"id": "A1", "age": 45, "sexe": "Féminin", "symptoms": ["Toux"]}\n', encoding="utf-8")
+    _, summary = batch_triage.run_batch(str(cases), str(tmp_path / "out.jsonl"), backend="stub", use_cache=True,
+                                        progress=False)
+    assert summary["ok"] == 1
+    # Réponses factices : jamais le cache sur disque que lit l'app.
+    assert paths == [":memory:"]
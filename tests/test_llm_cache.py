@@ -0,0 +1,49 @@
+from llm_cache import ResponseCache
+
+ARGS = dict(system_instruction="sys", temperature=0.4, max_tokens=200, model="kaggle")
+PROMPT = "Patient: 30 ans, Masculin. Symptômes: Fièvre, Toux. Description: toux sèche, surtout la nuit"
+NEAR = "Patient: 30 ans, Masculin. Symptômes: Fièvre, Toux. Description: Toux sèche surtout la nuit."
+
+
+def test_exact_hit():
+    cache = ResponseCache(":memory:")
+    cache.put(prompt=PROMPT, response="questions", latency=1.0, **ARGS)
+    assert cache.get(prompt=PROMPT, **ARGS) == "questions"
+
+
+def test_semantic_lookup_is_chosen_per_call():
+    # Le cache est partagé par les sessions : le tier approché est demandé à chaque lecture.
+    cache = ResponseCache(":memory:")
+    cache.put(prompt=PROMPT, response="questions", latency=1.0, semantic=True, **ARGS)
+    assert cache.get(prompt=NEAR, **ARGS) is None
+    assert cache.get(prompt=NEAR, semantic=True, **ARGS) == "questions"
+    assert cache.get(prompt=NEAR, **ARGS) is None
+    assert cache.summary()["semantic_hits"] == 1
+
+
+def case(age=30, sexe="Masculin", symptoms="Fièvre, Toux", description="toux sèche depuis deux jours, surtout la nuit"):
+    return f"Patient: {age} ans, {sexe}. Symptômes: {symptoms}. Description: {description}"
+
+
+def test_semantic_tier_matches_a_rephrased_description():
+    cache = ResponseCache(":memory:")
+    cache.put(prompt=case(), response="questions", latency=1.0, semantic=True, **ARGS)
+    assert cache.get(prompt=case(description="Toux seche depuis deux jours surtout la nuit."), semantic=True, **ARGS) == "questions"
+
+
+def test_semantic_tier_never_crosses_cases():
+    # Un autre cas clinique (symptôme ajouté ou changé, âge, sexe) n'est jamais servi par le tier approché.
+    cache = ResponseCache(":memory:")
+    cache.put(prompt=case(), response="questions", latency=1.0, semantic=True, **ARGS)
+    for other in (case(symptoms="Douleur thoracique, Fièvre, Toux"), case(symptoms="Fièvre, Vertiges"),
+                  case(age=3), case(sexe="Féminin")):
+        assert cache.get(prompt=other, semantic=True, **ARGS) is None, other
+    assert cache.summary()["semantic_hits"] == 0
+
+
+def test_semantic_index_is_rebuilt_from_disk(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    ResponseCache(path).put(prompt=case(), response="questions", latency=1.0, semantic=True, **ARGS)
+    cache = ResponseCache(path)
+    assert cache.get(prompt=case(description="Toux seche depuis deux jours surtout la nuit."), semantic=True, **ARGS) == "questions"
+    assert cache.get(prompt=case(age=3), semantic=True, **ARGS) is None
@@ -0,0 +1,48 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("requests")
+from llm_clients import BackendClients  # noqa: E402
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    """Répond toujours le statut demandé dans le chemin (`/500`, `/503`) et compte les appels."""
+
+    calls = []
+
+    def _reply(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.calls.append((self.command, self.path))
+        self.send_response(int(self.path.strip("/")))
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    do_GET = do_POST = _reply
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def status_url():
+    StatusHandler.calls = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StatusHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+
+@pytest.mark.parametrize("method, status, attempts", [
+    ("POST", 500, 1),  # le serveur a pu générer : pas de deuxième génération
+    ("POST", 504, 1),
+    ("POST", 503, 3),  # refus avant traitement : rejoué
+    ("POST", 429, 3),
+    ("GET", 500, 3),
+])
+def test_post_is_only_replayed_when_refused(status_url, method, status, attempts):
+    session = BackendClients(max_retries=2, backoff_factor=0, jitter=0).session
+    response = session.request(method, f"{status_url}/{status}", json={}, timeout=5)
+    assert response.status_code == status
+    assert len(StatusHandler.calls) == attempts
@@ -0,0 +1,41 @@
+from red_flags import EMERGENCY, WARNING, assess
+
+
+def test_two_distinct_signs_make_an_emergency():
+    result = assess("Douleur thoracique, et mon bras gauche est engourdi")
+    assert result.level == EMERGENCY
+    assert result.categories == ["cardiaque"]
+
+
+def test_single_strong_sign_is_an_emergency():
+    assert assess("il a fait un AVC").level == EMERGENCY
+
+
+def test_negated_sign_is_ignored():
+    assert assess("pas de douleur thoracique").level is None
+
+
+def test_selected_symptom_repeated_in_description_is_one_sign():
+    # Symptôme coché + même symptôme dans la description (étape 1 de l'app).
+    for description, symptom in (("la nuque raide depuis hier", "Nuque raide"), ("vertiges le matin", "Vertiges")):
+        result = assess(description, symptom)
+        assert result.level == WARNING, (description, symptom)
+        assert not result.categories
+
+
+def test_repeated_term_in_one_text_is_one_sign():
+    result = assess("nuque raide hier soir, encore la nuque raide ce matin")
+    assert result.level == WARNING
+    assert [flag.term for flag in result.flags] == ["nuque raide"]
+
+
+def test_common_symptoms_alone_raise_no_meningitis_flag():
+    for description, symptom in (("", "Fièvre"), ("de la fièvre et mal de tête", "Fièvre"), ("headache", "")):
+        result = assess(description, symptom)
+        assert not any(flag.category == "meningite" for flag in result.flags), (description, symptom)
+
+
+def test_selected_symptom_plus_other_sign_is_an_emergency():
+    result = assess("et j'ai la nuque raide", "Fièvre")
+    assert result.level == EMERGENCY
+    assert result.categories == ["meningite"]
@@ -0,0 +1,115 @@
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("transformers")
+import numpy as np  # noqa: E402
+import torch  # noqa: E402
+
+import kaggle_server_script as k  # noqa: E402
+
+
+def states(manager):
+    return {name: model["state"] for name, model in manager.summary()["models"].items()}
+
+
+@pytest.fixture(params=["cpu", "disk"])
+def models(request, tmp_path):
+    """Gemma et MedASR factices sous un budget où un seul des deux tient sur le device."""
+    llm = k.ModelSlot("gemma", lambda: k.load_stub_llm(0), priority=1)
+    asr = k.ModelSlot("medasr", lambda: k.load_stub_asr(0), priority=0)
+    llm.get()
+    asr.get()
+    budget = 1.1 * max(k.module_nbytes(k.slot_module(slot.value)) for slot in (llm, asr))
+    manager = k.ResidencyManager([llm, asr], budget_bytes=budget, target=request.param,
+                                 offload_dir=str(tmp_path), wait_s=0.5)
+    return manager, llm, asr
+
+
+def test_over_budget_model_is_offloaded_at_startup(models):
+    manager, _, _ = models
+    assert sorted(states(manager).values()) == ["device", "offloaded"]
+
+
+def test_models_swap_under_budget(models):
+    manager, llm, asr = models
+    with manager.use(asr):
+        assert states(manager) == {"gemma": "offloaded", "medasr": "device"}
+    with manager.use(llm):
+        assert states(manager) == {"gemma": "device", "medasr": "offloaded"}
+    summary = manager.summary()
+    assert summary["resident_mb"] <= summary["budget_mb"]
+    assert summary["models"]["gemma"]["swaps_in"] >= 1
+
+
+def test_reloaded_weights_give_the_same_outputs(models):
+    manager, llm, asr = models
+    tokenizer, model = llm.value
+    input_ids = tokenizer("bonjour", return_tensors="pt").input_ids
+    speech = np.random.default_rng(0).normal(0, 0.3, 16000).astype(np.float32)
+    with manager.use(llm), torch.inference_mode():
+        reference = model(input_ids).logits
+    with manager.use(asr) as (processor, asr_model):
+        transcription = k.transcribe_waveforms([speech], processor, asr_model)[0]
+    with manager.use(llm), torch.inference_mode():
+        assert torch.allclose(model(input_ids).logits, reference)
+    with manager.use(asr) as (processor, asr_model):
+        assert k.transcribe_waveforms([speech], processor, asr_model)[0] == transcription
+
+
+def test_scheduler_reloads_its_model(models):
+    manager, llm, asr = models
+    tokenizer, model = llm.value
+    scheduler = k.BatchScheduler(model, tokenizer, slot=llm)
+    try:
+        with manager.use(asr):
+            pass
+        assert states(manager)["gemma"] == "offloaded"
+        result = scheduler.submit(k.build_prompt("sys", "bonjour"), max_new_tokens=4).result(timeout=60)
+        assert result.input_tokens > 0
+        assert states(manager) == {"gemma": "device", "medasr": "offloaded"}
+    finally:
+        scheduler.stop()
+
+
+def test_busy_model_blocks_swap_until_released(models):
+    manager, llm, asr = models
+    release = threading.Event()
+
+    def hold_llm():
+        with manager.use(llm):
+            release.wait()
+
+    holder = threading.Thread(target=hold_llm)
+    holder.start()
+    time.sleep(0.05)
+    assert states(manager) == {"gemma": "device", "medasr": "offloaded"}
+    try:
+        # Gemma occupé : MedASR n'a pas la place et renonce après `wait_s` (503).
+        with pytest.raises(k.ServiceUnavailable) as error:
+            with manager.use(asr):
+                pass
+        assert (error.value.status, error.value.reason) == (503, "residency")
+
+        # Libéré pendant l'attente : MedASR passe.
+        threading.Timer(0.1, release.set).start()
+        with manager.use(asr):
+            assert states(manager)["medasr"] == "device"
+    finally:
+        release.set()
+        holder.join()
+
+
+def test_idle_model_is_offloaded_without_budget():
+    llm = k.ModelSlot("gemma", lambda: k.load_stub_llm(0), priority=1)
+    llm.get()
+    manager = k.ResidencyManager([llm], budget_bytes=0, idle_s=0.1)
+    with manager.use(llm):
+        pass
+    deadline = time.monotonic() + 5
+    while states(manager)["gemma"] != "offloaded" and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert states(manager)["gemma"] == "offloaded"
+    with manager.use(llm):
+        assert states(manager)["gemma"] == "device"
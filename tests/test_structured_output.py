@@ -0,0 +1,52 @@
+import json
+import time
+
+import pytest
+
+pytest.importorskip("transformers")
+import kaggle_server_script as k  # noqa: E402
+from structured_report import TRIAGE_REPORT_SCHEMA, parse_report  # noqa: E402
+
+SHORT_STRINGS = {
+    "type": "object",
+    "properties": {
+        "a": {"type": "string", "maxLength": 5},
+        "b": {"type": "array", "items": {"type": "string", "maxLength": 3}, "maxItems": 2},
+    },
+}
+
+
+@pytest.fixture(scope="module")
+def scheduler():
+    tokenizer, model = k.load_stub_llm(0)
+    scheduler = k.BatchScheduler(model, tokenizer)
+    yield scheduler
+    scheduler.stop()
+
+
+def generate(scheduler, schema, max_new_tokens, prompt="bonjour", **kwargs):
+    profile = k.resolve_profile({"profile": "final", "max_new_tokens": max_new_tokens, "schema": schema})
+    return scheduler.submit(k.build_prompt("sys", prompt), profile.max_new_tokens, 1.0, profile=profile,
+                            **kwargs).result()
+
+
+@pytest.mark.parametrize("max_new_tokens", [320, 120, 5])
+def test_document_is_closed_within_token_budget(scheduler, max_new_tokens):
+    minimal = len(k.json_minimal(TRIAGE_REPORT_SCHEMA))  # tokenizer factice : un caractère par token
+    for i in range(3):
+        result = generate(scheduler, TRIAGE_REPORT_SCHEMA, max_new_tokens, prompt=f"cas {i}")
+        assert parse_report(result.text) is not None, result.text
+        assert result.output_tokens <= max(max_new_tokens, minimal + 1)
+
+
+def test_document_is_closed_before_deadline(scheduler):
+    start = time.monotonic()
+    result = generate(scheduler, TRIAGE_REPORT_SCHEMA, 10_000, deadline=start + 0.5)
+    assert parse_report(result.text) is not None, result.text
+
+
+def test_strings_respect_max_length(scheduler):
+    for i in range(5):
+        data = json.loads(generate(scheduler, SHORT_STRINGS, 200, prompt=f"cas {i}").text)
+        assert len(data["a"]) <= 5
+        assert 1 <= len(data["b"]) <= 2 and all(len(s) <= 3 for s in data["b"])
@@ -0,0 +1,21 @@
+import json
+
+from tracing import JsonlExporter, Tracer, tracer
+
+
+def test_sampling_is_off_by_default():
+    # Les spans portent des attributs issus de la saisie : pas de trace sans demande explicite.
+    with tracer.trace("triage.questions") as trace:
+        assert trace is None
+
+
+def test_forced_trace_is_exported_under_trace_dir(tmp_path):
+    path = tmp_path / "traces" / "medgemma_traces.jsonl"
+    local = Tracer(exporter=JsonlExporter(str(path)), sample_rate=0)
+    with local.trace("triage.final", force=True) as trace:
+        with local.span("cache.lookup"):
+            pass
+    assert trace is not None
+    payload = json.loads(path.read_text(encoding="utf-8"))
+    spans = payload["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    assert [s["name"] for s in spans] == ["triage.final", "cache.lookup"]
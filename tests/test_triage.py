@@ -0,0 +1,43 @@
+import pytest
+
+pytest.importorskip("requests")
+from llm_cache import ResponseCache  # noqa: E402
+from triage import build_cache_args, build_questions_prompt, generate_cached, is_valid_report  # noqa: E402
+
+
+class ScriptedClients:
+    """Client LLM factice : renvoie les réponses prévues, dans l'ordre."""
+
+    model_name = "test-model"
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    def generate(self, *args):
+        self.calls += 1
+        return self.responses.pop(0)
+
+
+def test_questions_prompt_does_not_depend_on_symptom_order():
+    a = build_questions_prompt(30, "Féminin", {"Toux", "Fièvre", "Fatigue"}, "depuis hier")
+    b = build_questions_prompt(30, "Féminin", ["Fatigue", "Fièvre", "Toux"], "depuis hier")
+    assert a == b
+    assert "Symptômes: Fatigue, Fièvre, Toux." in a
+
+
+def test_cache_args_stable_across_symptom_order():
+    prompts = [build_questions_prompt(40, "Masculin", symptoms, "") for symptoms in (("Toux", "Vertiges"),
+                                                                                    ("Vertiges", "Toux"))]
+    args = [build_cache_args(p, "sys", "Kaggle / Local URL", "gemini-2.0-flash") for p in prompts]
+    assert args[0] == args[1]
+
+
+def test_rejected_structured_response_is_not_cached():
+    cache = ResponseCache(":memory:")
+    clients = ScriptedClients('{"niveau_urgence": "Moy', '{"niveau_urgence": "Moy')
+    for _ in range(2):
+        text = generate_cached(clients, cache, "réponses", "sys", accept=is_valid_report)
+        assert not is_valid_report(text)
+    assert clients.calls == 2
+    assert cache.summary()["entries"] == 0